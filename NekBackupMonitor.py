@@ -1,19 +1,18 @@
 #!/usr/bin/python3
 
+# Only what every command needs is imported here. Everything else is imported
+# by the methods that use it, so that e.g. add does not pay for croniter or
+# the email packages.
 import argparse;
 import sqlite3;
 import datetime;
 import time;
 import sys;
 import os;
-import configparser;
 from enum import Enum;
-from email.mime.text import MIMEText;
-from email.mime.multipart import MIMEMultipart;
-from subprocess import Popen, PIPE;
-from croniter import croniter;
-from urllib.request import pathname2url;
-import shutil;
+import json;
+import io;
+import itertools;
 
 class NekBackupMonitor(object):
 
@@ -21,92 +20,484 @@ class NekBackupMonitor(object):
   sqlite_file = currentPath + '/NekBackupMonitor.db';
   tableSchedules = 'schedules';
   tableReports = 'reports';
+  tableMessages = 'report_messages';
+  tableDayStatus = 'schedule_day_status';
+  tableOutbox = 'notification_outbox';
+  tableScheduleVersion = 'schedule_version';
+  tableSearch = 'report_search';
   settings_file = currentPath + '/settings.conf';
+  socket_file = currentPath + '/NekBackupMonitor.sock';
+
+  # seconds that add waits for the report server before adding the report directly
+  forwardTimeout = 30;
+  # seconds that the report server waits for the next data of a client. It
+  # handles one client at a time, a stuck one must not hold up the others
+  requestTimeout = 10;
+
+  # defaults of the [Messages] settings, in bytes
+  defaultMessageChunkSize = 65536;
+  defaultMaxMessageSize = 64 * 1024 * 1024;
+
+  # the search index has one row per message chunk, with the rowid
+  # report id * searchChunkFactor + chunk. Chunks beyond that are not indexed.
+  searchChunkFactor = 1 << 20;
+  # the unfinished last line of a chunk, up to this many characters, is
+  # indexed with the next chunk, so that the words and phrases of a line are
+  # found even if the line crosses chunks. A longer one is split between words.
+  searchCarryChars = 4096;
+  # maximum length of the snippet of a search result, in characters
+  searchSnippetChars = 160;
+
+  # number of message lines included in the immediate error email, and per
+  # report in a digest of several errors
+  emailMessageLines = 200;
+  digestMessageLines = 20;
+
+  # defaults of the [Email] settings
+  defaultDelivery = 'sendmail';
+  defaultSmtpHost = 'localhost';
+  defaultSmtpSecurity = 'none';
+  defaultSmtpTimeout = 30;
+  defaultSmtpRetries = 3;
+
+  # defaults of the [Notifications] settings, in seconds
+  defaultDigestWindow = 60;
+  defaultFlushInterval = 10;
+  # a notification that a flush claimed, but neither sent nor released, e.g.
+  # because the process was killed, can be claimed again after this long
+  notificationClaimTimeout = 600;
+
+  # defaults of the [Database] settings
+  defaultBusyTimeout = 10000;
+  defaultSynchronous = 'NORMAL';
+  defaultWriteRetries = 8;
+
+  # backoff between retries of a write that found the database locked, in seconds
+  writeRetryDelay = 0.05;
+  writeRetryMaxDelay = 2.0;
+
+  # defaults of the [Retention] settings
+  defaultArchiveDir = 'archive';
+  defaultPruneBatchSize = 500;
+  # pages freed per write transaction by the incremental vacuum after prune
+  vacuumPagesPerStep = 1000;
+
+  # defaults of the [Stats] settings
+  defaultStatsWindowDays = 30;
+  defaultAnomalyBaselineDays = 30;
+  defaultAnomalyThreshold = 3;
+  defaultAnomalyMinRuns = 5;
+  defaultAnomalyMinSeconds = 60;
+
+  # default of the [Metrics] ErrorWindowDays setting
+  defaultErrorWindowDays = 7;
+
+  # default of the [Check] EarlyTolerance setting: how many seconds before its
+  # scheduled time a run may start and still count for that time, in seconds
+  defaultEarlyTolerance = 300;
+
+  # defaults of the [Watch] settings, in seconds
+  defaultWatchGrace = 1800;
+  defaultWatchPollInterval = 60;
 
-  # read configuration file
-
-  config = configparser.ConfigParser()
+  NOTIFY_OK = 1;
+  NOTIFY_ERROR = 2;
 
-  if(os.path.exists(settings_file) == False):
-    print("ERROR: settings file settings.conf does not exist", file=sys.stderr);
-    exit(2);
+  # Style of the status cells of the tables. A status is looked up by its
+  # whole text, and else by its first word (e.g. "MISSING 2/3 runs").
+  statusStyles = {
+    'OK': 'ok',
+    'OK AND VERIFIED': 'ok',
+    'VERIFIED': 'ok',
+    'OK (unverified)': 'warning',
+    'OK (with retries)': 'warning',
+    'NO': 'warning',
+    'ERROR': 'fail',
+    'VERIFICATION ERROR': 'fail',
+    'Tried with ERROR': 'fail',
+    'MISSING': 'fail',
+  };
+  # style -> HTML color
+  htmlColors = {'ok': 'green', 'warning': 'darkorange', 'fail': 'red'};
+
+  # the methods timed with --profile. Generators aren't, their call only
+  # creates them.
+  profiledMethods = ['readConfig', 'connect', 'migrateSchema', 'getSchedule', 'scheduleExists', 'storeReport',
+                     'storeMessage', 'unindexMessages', 'readMessage', 'insertReports', 'updateDayStatus', 'loadDayStatus', 'loadDayReports',
+                     'expectedRuns', 'expectedRunsOfDays', 'evaluateSchedule', 'evaluateDays', 'dayAnomalies', 'findDurationAnomalies', 'computeStats',
+                     'collectMetrics', 'renderCheckReport', 'renderRow', 'sendEmail', 'flushNotifications', 'searchReports'];
+
+  # day result of the check -> its cell in the matrix of a range check
+  matrixSymbols = {
+    'OK': '.',
+    'OK (with retries)': 'r',
+    'VERIFICATION ERROR': 'v',
+    'ERROR': 'E',
+    'MISSING': 'M',
+    'Tried with ERROR': 'T',
+    'Not scheduled': '-',
+  };
+  # a range check evaluates at least this many days per process
+  minDaysPerJob = 7;
+
+  # report result -> its name in add -r and in the --format output
+  resultNames = {0: 'failed', 1: 'done', 2: 'done-and-verified', 3: 'done-but-verify-error'};
+
+  # fields of the --format output of each command
+  scheduleFields = ['id', 'title', 'interval', 'source_host', 'destination_host', 'source_dir', 'destination_dir', 'type'];
+  reportFields = ['id', 'schedule_id', 'schedule_title', 'starting_timestamp', 'result', 'duration_in_seconds'];
+  searchFields = reportFields + ['score', 'snippet'];
+  statsFields = ['schedule_id', 'title', 'reports', 'failure_rate', 'runs', 'p50', 'p95', 'p99', 'mean',
+                 'trend_seconds_per_day', 'anomalies'];
+  checkFields = ['schedule_id', 'title', 'source_host', 'destination_host', 'interval', 'scheduled_for', 'runs',
+                 'result', 'verified', 'duration_in_seconds', 'ok', 'failed_runs'];
+
+  # Schema migrations. Each entry is a list of statements that upgrades the
+  # schema by one version, tracked with PRAGMA user_version. Only ever append
+  # to this list, never change or reorder existing entries.
+  schemaMigrations = [
+    # 1: day-window scans in check and list-reports
+    ['CREATE INDEX IF NOT EXISTS reports_date ON reports (date)'],
+    # 2: per-schedule lookups (list-reports -s, delete-schedule)
+    ['CREATE INDEX IF NOT EXISTS reports_schedule_date ON reports (Schedule, date)'],
+    # 3: covering index for the per-schedule day status used by check
+    ['CREATE INDEX IF NOT EXISTS reports_schedule_date_result_duration ON reports (Schedule, date, Result, duration)'],
+    # 4: report messages move out of the reports table, compressed and in chunks
+    ["""
+      CREATE TABLE IF NOT EXISTS report_messages (
+          "Report" INTEGER NOT NULL,
+          "chunk" INTEGER NOT NULL,
+          "size" INTEGER NOT NULL,
+          "data" BLOB NOT NULL,
+          PRIMARY KEY ("Report", "chunk")
+      ) WITHOUT ROWID
+     """,
+     lambda self, conn: self.moveInlineMessages(conn)],
+    # 5: per schedule and day rollup of the reports, used by check
+    ["""
+      CREATE TABLE IF NOT EXISTS schedule_day_status (
+          "Schedule" INTEGER NOT NULL,
+          "day" INTEGER NOT NULL,
+          "attempts" INTEGER NOT NULL,
+          "successes" INTEGER NOT NULL,
+          "errors" INTEGER NOT NULL,
+          "verification" INTEGER NOT NULL,
+          "totalDuration" REAL NOT NULL,
+          "lastDuration" REAL,
+          PRIMARY KEY ("Schedule", "day")
+      ) WITHOUT ROWID
+     """,
+     lambda self, conn: self.rebuildDayStatus(conn)],
+    # 6: error notifications wait here until they are sent, as digests per destination host
+    ["""
+      CREATE TABLE IF NOT EXISTS notification_outbox (
+          "id" INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL,
+          "Report" INTEGER NOT NULL,
+          "Schedule" INTEGER NOT NULL,
+          "DestinationHost" TEXT,
+          "created" INTEGER NOT NULL
+      )
+     """],
+    # 7: check reads the daily status of all schedules of a day, without the schedules table
+    ['CREATE INDEX IF NOT EXISTS schedule_day_status_day ON schedule_day_status (day)'],
+    # 8: a counter of the changes of the schedules, so that the schedule cache
+    # of a long running process notices the changes made by other processes
+    ['CREATE TABLE IF NOT EXISTS schedule_version ("id" INTEGER PRIMARY KEY CHECK (id = 1), "version" INTEGER NOT NULL)',
+     'INSERT OR IGNORE INTO schedule_version (id, version) VALUES (1, 0)',
+     'CREATE TRIGGER IF NOT EXISTS schedules_insert_version AFTER INSERT ON schedules BEGIN UPDATE schedule_version SET version = version + 1; END',
+     'CREATE TRIGGER IF NOT EXISTS schedules_update_version AFTER UPDATE ON schedules BEGIN UPDATE schedule_version SET version = version + 1; END',
+     'CREATE TRIGGER IF NOT EXISTS schedules_delete_version AFTER DELETE ON schedules BEGIN UPDATE schedule_version SET version = version + 1; END'],
+    # 9: full-text search over the report messages. The index keeps no copy of
+    # the text, the messages stay compressed in report_messages. Without FTS5
+    # in SQLite there is no index, and search-reports says so.
+    [lambda self, conn: self.createSearchIndex(conn)],
+    # 10: a flush claims the notifications it sends, so that the report server
+    # and flush-notifications never send the same one
+    ['ALTER TABLE notification_outbox ADD COLUMN "claimed" INTEGER'],
+    # 11: the search index rows keep the lines that cross chunks together
+    [lambda self, conn: self.rebuildSearchIndex(conn)],
+  ];
 
-  config.read(settings_file);
-  
-  if(not 'General' in config):
-    print("ERROR: settings file does not contain a [General] section", file=sys.stderr);
-    exit(3);
-
-  if(not 'ToEmail' in config['General']):
-    print("ERROR: The settings file does not contain a ToEmail setting under the [General] section", file=sys.stderr);
-    exit(3);
-  if(not 'FromEmail' in config['General']):
-    print("ERROR: The settings file does not contain a FromEmail setting under the [General] section", file=sys.stderr);
-    exit(3);
-  if(not 'SendEmailImmediatelyOnErrorReport' in config['General']):
-    print("ERROR: The settings file does not contain a SendEmailImmediatelyOnErrorReport setting under the [General] section", file=sys.stderr);
-    exit(3);
-
-  sendEmailImmediatelyOnErrorReport = False;
-  if(config['General']['SendEmailImmediatelyOnErrorReport'] == "yes"):
-    sendEmailImmediatelyOnErrorReport = True;
-
-  toEmail = config['General']['ToEmail'];
-  fromEmail = config['General']['FromEmail']
-
-  if(not toEmail):
-    print("ERROR: The ToEmail setting is empty", file=sys.stderr);
-    exit(3);
-  if(not fromEmail):
-    print("ERROR: The FromEmail setting is empty", file=sys.stderr);
-    exit(3);
+  def __init__(self):
+    # the settings and the database connection are loaded on first use
+    self.config = None;
+    self.emailSettingsLoaded = False;
+    self._conn = None;
+    # (interval, day start) -> expected run timestamps of that day
+    self.expectedRunsCache = {};
+    # when the report server sends the pending notifications next
+    self.nextNotificationFlush = 0;
+    # the email delivery backend, created on the first email
+    self.mailer = None;
+    # the Profiler of --profile
+    self.profiler = None;
+    self._repository = None;
+    # whether SQLite has FTS5, checked on first use
+    self.fts5Available = None;
+
+  @property
+  def conn(self):
+    if(self._conn == None):
+      self._conn = self.connect();
+    return self._conn;
+
+  @property
+  def repository(self):
+    if(self._repository == None):
+      self._repository = Repository(self);
+    return self._repository;
+
+  # Reads the configuration file on first use.
+  def readConfig(self):
+    if(self.config != None):
+      return self.config;
+
+    import configparser;
+    config = configparser.ConfigParser()
+
+    if(os.path.exists(self.settings_file) == False):
+      print("ERROR: settings file settings.conf does not exist", file=sys.stderr);
+      exit(2);
+
+    config.read(self.settings_file);
+    
+    if(not 'General' in config):
+      print("ERROR: settings file does not contain a [General] section", file=sys.stderr);
+      exit(3);
 
-  NOTIFY_OK = 1;
-  NOTIFY_ERROR = 2;
+    self.config = config;
+    return config;
 
-  # check if sendmail exists
-  sendmail = shutil.which("sendmail");
-  if sendmail == None:
-    print("ERROR: sendmail does not exist", file=sys.stderr);
-    exit(2);
+  # Returns an optional integer setting, or the default if it is not set.
+  def getIntSetting(self, section, name, default):
+    config = self.readConfig();
+    try:
+      return config.getint(section, name, fallback=default);
+    except ValueError:
+      print("ERROR: The {n} setting under the [{s}] section must be an integer".format(n=name, s=section), file=sys.stderr);
+      exit(3);
+
+  # Reads and validates the email settings. Only commands that send email
+  # need them.
+  def loadSettings(self):
+    if(self.emailSettingsLoaded == True):
+      return;
 
-  # Connecting to the database file
+    config = self.readConfig();
+
+    if(not 'ToEmail' in config['General']):
+      print("ERROR: The settings file does not contain a ToEmail setting under the [General] section", file=sys.stderr);
+      exit(3);
+    if(not 'FromEmail' in config['General']):
+      print("ERROR: The settings file does not contain a FromEmail setting under the [General] section", file=sys.stderr);
+      exit(3);
+    if(not 'SendEmailImmediatelyOnErrorReport' in config['General']):
+      print("ERROR: The settings file does not contain a SendEmailImmediatelyOnErrorReport setting under the [General] section", file=sys.stderr);
+      exit(3);
+
+    self.sendEmailImmediatelyOnErrorReport = False;
+    if(config['General']['SendEmailImmediatelyOnErrorReport'] == "yes"):
+      self.sendEmailImmediatelyOnErrorReport = True;
+
+    self.toEmail = config['General']['ToEmail'];
+    self.fromEmail = config['General']['FromEmail']
+
+    if(not self.toEmail):
+      print("ERROR: The ToEmail setting is empty", file=sys.stderr);
+      exit(3);
+    if(not self.fromEmail):
+      print("ERROR: The FromEmail setting is empty", file=sys.stderr);
+      exit(3);
+
+    self.emailSettingsLoaded = True;
+
+  # Escapes a file path for an SQLite URI filename. Only %, ? and # have a
+  # meaning in the path of such a URI, quoting just those saves importing
+  # urllib.parse on every add
+  def uriPath(self, path):
+    return path.replace('%', '%25').replace('?', '%3f').replace('#', '%23');
+
+  # Connects to the database file, creating the schema if it does not exist,
+  # and migrates the schema to the latest version.
+  def connect(self):
+    # wait this long for the lock of another writer before failing
+    busyTimeout = self.getIntSetting('Database', 'BusyTimeout', self.defaultBusyTimeout);
+    synchronous = self.readConfig().get('Database', 'Synchronous', fallback=self.defaultSynchronous).upper();
+    if(not synchronous in ['OFF', 'NORMAL', 'FULL', 'EXTRA']):
+      print("ERROR: The Synchronous setting under the [Database] section must be one of OFF, NORMAL, FULL or EXTRA", file=sys.stderr);
+      exit(3);
+    self.writeRetries = self.getIntSetting('Database', 'WriteRetries', self.defaultWriteRetries);
+
+    # check if db file exists
+    try:
+      dburi = 'file:{}?mode=rw'.format(self.uriPath(self.sqlite_file));
+      conn = sqlite3.connect(dburi, uri=True, timeout=busyTimeout / 1000.0, factory=self.connectionFactory());
+    except sqlite3.OperationalError:
+      # db doesn't exist. create the schema
+      conn = sqlite3.connect(self.sqlite_file, timeout=busyTimeout / 1000.0, factory=self.connectionFactory());
+      # only takes effect before the first table is created. prune then gives
+      # the free space back without the full VACUUM of prune --vacuum
+      conn.execute('PRAGMA auto_vacuum = INCREMENTAL');
+      conn.execute("""
+        CREATE TABLE IF NOT EXISTS "Schedules" (
+            "id" INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL,
+            "Title" TEXT NOT NULL,
+            "Interval" INTEGER NOT NULL DEFAULT (1),
+            "SourceHost" TEXT NOT NULL,
+            "DestinationHost" TEXT NOT NULL,
+            "SourceDir" TEXT NOT NULL,
+            "DestinationDir" TEXT NOT NULL,
+            "Type" INTEGER NOT NULL
+        );
+      """);
+      conn.execute("""
+        CREATE TABLE reports (
+            "id" INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL,
+            "Schedule" INTEGER NOT NULL,
+            "date" INTEGER NOT NULL,
+            "Result" INTEGER NOT NULL,
+            "message" TEXT,
+            "duration" INTEGER
+        );
+      """);
+
+    # WAL lets readers and the writer proceed without blocking each other. The
+    # journal mode is stored in the database file, so it is only switched once.
+    if(conn.execute('PRAGMA journal_mode').fetchone()[0].lower() != 'wal'):
+      try:
+        conn.execute('PRAGMA journal_mode = WAL');
+      except sqlite3.OperationalError as e:
+        if(not self.isLockedError(e)):
+          raise;
+    conn.execute('PRAGMA synchronous = ' + synchronous);
+
+    self.migrateSchema(conn);
+    conn.row_factory = sqlite3.Row;
+    return conn;
+
+  # Connects to the database file read-only, for check --sites. Nothing is
+  # written to the database, not even the journal mode or a schema migration,
+  # as the database belongs to another site and may run another version of
+  # NekBackupMonitor. Raises ValueError if its schema is not the current one.
+  def connectReadOnly(self):
+    busyTimeout = self.getIntSetting('Database', 'BusyTimeout', self.defaultBusyTimeout);
+    dburi = 'file:{}?mode=ro'.format(self.uriPath(self.sqlite_file));
+    conn = sqlite3.connect(dburi, uri=True, timeout=busyTimeout / 1000.0, factory=self.connectionFactory());
+    schemaVersion = conn.execute('PRAGMA user_version').fetchone()[0];
+    if(schemaVersion != len(self.schemaMigrations)):
+      conn.close();
+      if(schemaVersion < len(self.schemaMigrations)):
+        raise ValueError("the database schema version {v} is older than this version of NekBackupMonitor needs ({s}). Upgrade NekBackupMonitor at that site".format(v=schemaVersion, s=len(self.schemaMigrations)));
+      raise ValueError("the database schema version {v} is newer than this version of NekBackupMonitor supports ({s})".format(v=schemaVersion, s=len(self.schemaMigrations)));
+    conn.row_factory = sqlite3.Row;
+    return conn;
+
+  # The connection class to use: with --profile one that times every statement.
+  def connectionFactory(self):
+    if(self.profiler == None):
+      return sqlite3.Connection;
+    return self.profiler.connectionClass();
+
+  # Times the profiledMethods and every SQL statement from now on.
+  def startProfiling(self, profiler):
+    self.profiler = profiler;
+    profiler.instrument(self, self.profiledMethods);
+
+  def migrateSchema(self, conn):
+    schemaVersion = conn.execute('PRAGMA user_version').fetchone()[0];
+    if(schemaVersion > len(self.schemaMigrations)):
+      print("ERROR: The database schema version {v} is newer than this version of NekBackupMonitor supports ({s})".format(v=schemaVersion, s=len(self.schemaMigrations)), file=sys.stderr);
+      exit(2);
+    while(schemaVersion < len(self.schemaMigrations)):
+      try:
+        self.beginWrite(conn.cursor());
+        # another process may have migrated while we waited for the lock
+        schemaVersion = conn.execute('PRAGMA user_version').fetchone()[0];
+        if(schemaVersion >= len(self.schemaMigrations)):
+          conn.rollback();
+          break;
+        schemaVersion = schemaVersion + 1;
+        for statement in self.schemaMigrations[schemaVersion - 1]:
+          if(callable(statement)):
+            statement(self, conn);
+          else:
+            conn.execute(statement);
+        conn.execute('PRAGMA user_version = {v:d}'.format(v=schemaVersion));
+        conn.commit();
+      except sqlite3.Error as e:
+        conn.rollback();
+        print("ERROR: Failed to migrate the database schema to version {v}: {e}".format(v=schemaVersion, e=e.args[0]), file=sys.stderr);
+        exit(2);
+
+  def isLockedError(self, e):
+    message = str(e).lower();
+    return 'locked' in message or 'busy' in message;
+
+  # Starts a write transaction. BEGIN IMMEDIATE takes the write lock up front,
+  # waiting up to BusyTimeout for it, and is retried with exponential backoff
+  # while other writers keep the database locked. Once the lock is held the
+  # statements of the transaction and its commit do not run into it anymore.
+  def beginWrite(self, c):
+    import random;
+
+    attempt = 0;
+    while True:
+      try:
+        c.execute('BEGIN IMMEDIATE');
+        return;
+      except sqlite3.OperationalError as e:
+        if(not self.isLockedError(e) or attempt >= self.writeRetries):
+          raise;
+      attempt = attempt + 1;
+      delay = min(self.writeRetryMaxDelay, self.writeRetryDelay * (2 ** attempt));
+      time.sleep(delay * random.uniform(0.5, 1.5));
+
+  # Migration 4: moves the messages stored inline in reports.message to the
+  # report_messages table. The old column is kept but left empty.
+  def moveInlineMessages(self, conn):
+    c = conn.cursor();
+    reportIds = [row[0] for row in conn.execute('SELECT id FROM reports WHERE message IS NOT NULL')];
+    for reportId in reportIds:
+      message = conn.execute('SELECT message FROM reports WHERE id = ?', (reportId,)).fetchone()[0];
+      # the search index does not exist yet, it is built from all messages later
+      self.storeMessage(c, reportId, message, None, False);
+    conn.execute('UPDATE reports SET message = NULL WHERE message IS NOT NULL');
+
+  def hasFts5(self, conn):
+    if(self.fts5Available == None):
+      self.fts5Available = conn.execute("SELECT sqlite_compileoption_used('ENABLE_FTS5')").fetchone()[0] == 1;
+    return self.fts5Available;
+
+  # Whether the messages are indexed for search-reports: the index exists and
+  # this SQLite can write to it.
+  def hasSearchIndex(self, conn):
+    if(not self.hasFts5(conn)):
+      return False;
+    return conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = :ts", {'ts': self.tableSearch}).fetchone() != None;
 
-  # check if db file exists
-  try:
-    dburi = 'file:{}?mode=rw'.format(pathname2url(sqlite_file));
-    conn = sqlite3.connect(dburi, uri=True);
-  except sqlite3.OperationalError:
-    # db doesn't exist. create the schema
-    conn = sqlite3.connect(sqlite_file);
-    conn.execute("""
-      CREATE TABLE IF NOT EXISTS "Schedules" (
-          "id" INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL,
-          "Title" TEXT NOT NULL,
-          "Interval" INTEGER NOT NULL DEFAULT (1),
-          "SourceHost" TEXT NOT NULL,
-          "DestinationHost" TEXT NOT NULL,
-          "SourceDir" TEXT NOT NULL,
-          "DestinationDir" TEXT NOT NULL,
-          "Type" INTEGER NOT NULL
-      );
-    """);
-    conn.execute("""
-      CREATE TABLE reports (
-          "id" INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL,
-          "Schedule" INTEGER NOT NULL,
-          "date" INTEGER NOT NULL,
-          "Result" INTEGER NOT NULL,
-          "message" TEXT,
-          "duration" INTEGER
-      );
-    """);
+  # Creates the empty search index, if SQLite has FTS5.
+  def createSearchIndex(self, conn):
+    if(self.hasFts5(conn)):
+      conn.execute("CREATE VIRTUAL TABLE IF NOT EXISTS {ts} USING fts5(message, content='')".format(ts=self.tableSearch));
 
-  conn.row_factory = sqlite3.Row;
+  # Indexes the messages of all reports for search-reports, from scratch.
+  def rebuildSearchIndex(self, conn):
+    import zlib;
+    if(not self.hasSearchIndex(conn)):
+      return;
 
-  def __init__(self):
+    conn.execute("INSERT INTO {ts} ({ts}) VALUES ('delete-all')".format(ts=self.tableSearch));
+    rows = conn.execute('SELECT Report, chunk, data FROM {tm} ORDER BY Report, chunk'.format(tm=self.tableMessages));
+    searchRows = ((reportId * self.searchChunkFactor + chunkIndex, text)
+                  for reportId, chunks in itertools.groupby(rows, key=lambda row: row[0])
+                  for chunkIndex, text in self.iterSearchRows((chunkIndex, zlib.decompress(data)) for _, chunkIndex, data in chunks)
+                  if chunkIndex < self.searchChunkFactor);
+    conn.executemany('INSERT INTO {ts} (rowid, message) VALUES (?, ?)'.format(ts=self.tableSearch), searchRows);
 
+  def run(self):
     parser = argparse.ArgumentParser(prog='nekbackupmonitor.py');
+    parser.add_argument('--profile', action="store_true", help='Print the time spent in each phase and in each SQL statement to stderr.');
+    parser.add_argument('--profile-json', type=str, metavar='FILE', help='Write the time spent in each phase and in each SQL statement to FILE as JSON.');
 
     p_report = argparse.ArgumentParser(add_help=False);
     p_report.add_argument('-s', '--schedule-id', type=int, help='the Schedule ID of the running task');
@@ -115,6 +506,31 @@ class NekBackupMonitor(object):
     p_report.add_argument('-d', '--duration-in-seconds', type=float, help='(optional) the duration of the running task in seconds');
     p_report.add_argument('-m', '--message', help='A detailed message (e.g. output log) associated with the running of the task.');
     p_report.add_argument('--stdin-message', action="store_true", help='Read the associated detailed message from the stdin. For messages that exceed 1000 chars use this method, instead of the -m option above.');
+    p_report.add_argument('--socket', type=str, help='(optional) the Unix socket of the report server. The report is sent to the server if it is running, otherwise it is added directly. Defaults to NekBackupMonitor.sock next to this script.');
+
+    p_add_batch = argparse.ArgumentParser(add_help=False);
+    p_add_batch.add_argument('FILE', type=str, nargs='?', default='-', help='file with one JSON report per line, with the fields schedule_id, starting_timestamp, result, duration_in_seconds and message. Reads stdin if omitted or -.');
+    p_add_batch.add_argument('-c', '--chunk-size', type=int, default=5000, help='Number of reports inserted per transaction. Default is 5000.');
+
+    p_prune = argparse.ArgumentParser(add_help=False);
+    p_prune.add_argument('-b', '--days', type=int, help='Number of days. Prune the reports older than that. Defaults to the KeepDays setting.');
+    p_prune.add_argument('--batch-size', type=int, help='Number of reports deleted per transaction. Defaults to the PruneBatchSize setting.');
+    p_prune.add_argument('--vacuum', action="store_true", help='Switch the database to incremental vacuum first, if needed. That takes a one-time full VACUUM, which locks the database for as long as it takes.');
+    p_prune.add_argument('--no-vacuum', action="store_true", help='Do not give the free space back to the file system afterwards.');
+
+    p_flush_notifications = argparse.ArgumentParser(add_help=False);
+    p_flush_notifications.add_argument('-a', '--all', action="store_true", help='Send all pending notifications, also the ones still within the DigestWindow.');
+
+    p_stats = argparse.ArgumentParser(add_help=False);
+    p_stats.add_argument('-b', '--days', type=int, help='Number of days. The statistics of the last that many days, today included. Defaults to the WindowDays setting.');
+    p_stats.add_argument('-s', '--schedule', type=int, help='ID of schedule. Only the statistics of this schedule.');
+
+    p_export_metrics = argparse.ArgumentParser(add_help=False);
+    p_export_metrics.add_argument('-o', '--output', type=str, help='Write the metrics to this file instead of stdout, e.g. for the textfile collector of node_exporter.');
+    p_export_metrics.add_argument('--listen', type=str, help='[HOST:]PORT. Serve the metrics over HTTP on /metrics instead.');
+
+    p_serve = argparse.ArgumentParser(add_help=False);
+    p_serve.add_argument('--socket', type=str, help='The Unix socket to listen on. Defaults to NekBackupMonitor.sock next to this script.');
 
     p_delete_report = argparse.ArgumentParser(add_help=False);
     p_delete_report.add_argument('ID', type=int, help='report ID');
@@ -131,10 +547,43 @@ class NekBackupMonitor(object):
     p_delete_schedule = argparse.ArgumentParser(add_help=False);
     p_delete_schedule.add_argument('ID', type=int, help='schedule ID');
 
+    p_schedule_file = argparse.ArgumentParser(add_help=False);
+    p_schedule_file.add_argument('--format', choices=['json', 'ndjson', 'csv'], help='File format. Defaults to the extension of FILE, json otherwise.');
+
+    p_export_schedules = argparse.ArgumentParser(add_help=False);
+    p_export_schedules.add_argument('FILE', type=str, nargs='?', default='-', help='file to write the schedules to, with the fields of list-schedules --format. Writes to stdout if omitted or -.');
+
+    p_import_schedules = argparse.ArgumentParser(add_help=False);
+    p_import_schedules.add_argument('FILE', type=str, help='file with the schedules, as written by export-schedules, or - for stdin. A schedule is matched by its id, or by its title if it has no id.');
+    p_import_schedules.add_argument('--delete', action="store_true", help='Also delete the schedules that are not in the file, with their reports.');
+    p_import_schedules.add_argument('-n', '--dry-run', action="store_true", help='Only show the changes.');
+
+    p_search_reports = argparse.ArgumentParser(add_help=False);
+    p_search_reports.add_argument('QUERY', type=str, help='Words to find in the report messages. A report matches if its message has all of them, in any order.');
+    p_search_reports.add_argument('--match', action="store_true", help='Read QUERY as an FTS5 query instead, e.g. \'"no space left" OR ENOSPC\', \'rsync NOT warning\' or \'timeout*\'.');
+    p_search_reports.add_argument('-s', '--schedule', type=int, help='ID of schedule. Only search the reports of a schedule.');
+    p_search_reports.add_argument('-r', '--result', action='append', choices=['done', 'done-and-verified', 'done-but-verify-error', 'failed'], help='Only search the reports with this result. Can be given several times.');
+    p_search_reports.add_argument('-d', '--date', type=str, help='Date. Only search the reports of a specific date. The format is YYYY-mm-dd (e.g. 2015-03-16)');
+    p_search_reports.add_argument('-f', '--fromdate', type=str, help='From Date. Only search the reports from a specific date. The format is YYYY-mm-dd (e.g. 2015-03-16)');
+    p_search_reports.add_argument('-t', '--todate', type=str, help='To Date. Only search the reports up until a specific date. The format is YYYY-mm-dd (e.g. 2015-03-16)');
+    p_search_reports.add_argument('-b', '--days', type=int, help='Number of days. Only search the reports of the last that many days.');
+    p_search_reports.add_argument('-l', '--limit', type=int, default=20, help='Maximum number of reports to show, the best matches first. Default is 20.');
+
+    p_watch = argparse.ArgumentParser(add_help=False);
+    p_watch.add_argument('--grace', type=int, help='Seconds after its scheduled time that a run has to report before it is overdue. Defaults to the Grace setting.');
+
     p_check = argparse.ArgumentParser(add_help=False);
     p_check.add_argument('-d', '--date', type=str, help='Date. The format is YYYY-mm-dd (e.g. 2015-03-16)');
     p_check.add_argument('-m', '--email', action="store_true", help='Also email the report.');
     p_check.add_argument('-b', '--days', type=str, help='Number of days prior. Do a check for the date that is that many days prior.');
+    p_check.add_argument('--sites', action="store_true", help='Check the databases of all sites of the [Sites] section in parallel, in one report.');
+    p_check.add_argument('--from', dest='date_from', type=str, help='First date of a range check, with a schedule x day matrix. The format is YYYY-mm-dd (e.g. 2015-03-16)');
+    p_check.add_argument('--to', dest='date_to', type=str, help='Last date of a range check. The format is YYYY-mm-dd (e.g. 2015-03-16). Defaults to yesterday.');
+    p_check.add_argument('-j', '--jobs', type=int, help='Number of processes evaluating the days of a range check. Defaults to the number of CPUs.');
+
+    # machine readable output, written row by row
+    p_format = argparse.ArgumentParser(add_help=False);
+    p_format.add_argument('--format', choices=['text', 'json', 'ndjson', 'csv'], default='text', help='Output format. Default is text.');
 
     p_schedules = argparse.ArgumentParser(add_help=False);
     p_schedules.add_argument('-f', '--full', action="store_true", help='List with full details.');
@@ -146,20 +595,51 @@ class NekBackupMonitor(object):
     p_reports.add_argument('-f', '--fromdate', type=str, help='From Date. List reports from a specific date. The format is YYYY-mm-dd (e.g. 2015-03-16)');
     p_reports.add_argument('-t', '--todate', type=str, help='To Date. List reports up until a specific date. The format is YYYY-mm-dd (e.g. 2015-03-16)');
     p_reports.add_argument('-b', '--days', type=str, help='Number of days. List reports up from that amount of days.');
+    p_reports.add_argument('-l', '--limit', type=int, help='Maximum number of reports to list.');
+    p_reports.add_argument('-a', '--after-id', type=int, help='ID of report. List the reports that come after this report, e.g. the last ID of the previous --limit page.');
+    p_reports.add_argument('--head', type=int, help='Number of lines. With -r, only show the first lines of the message.');
+    p_reports.add_argument('--tail', type=int, help='Number of lines. With -r, only show the last lines of the message.');
 
     sp = parser.add_subparsers();
-    sp_list_schedules = sp.add_parser('list-schedules', parents=[p_schedules], help='Lists schedules by default from 7 days prior');
+    sp_list_schedules = sp.add_parser('list-schedules', parents=[p_schedules, p_format], help='Lists schedules by default from 7 days prior');
     sp_list_schedules.set_defaults(which='list-schedules');
 
-    sp_list_reports = sp.add_parser('list-reports', parents=[p_reports], help='Lists reports');
+    sp_list_reports = sp.add_parser('list-reports', parents=[p_reports, p_format], help='Lists reports');
     sp_list_reports.set_defaults(which='list-reports');
 
-    sp_check = sp.add_parser('check', parents=[p_check], help='Check reports');
+    sp_search_reports = sp.add_parser('search-reports', parents=[p_search_reports, p_format], help='Search the report messages, the best matches first, with a snippet of each');
+    sp_search_reports.set_defaults(which='search-reports');
+
+    sp_check = sp.add_parser('check', parents=[p_check, p_format], help='Check reports');
     sp_check.set_defaults(which='check');
 
+    sp_watch = sp.add_parser('watch', parents=[p_watch], help='Watch the schedules and email an alert as soon as a run is overdue');
+    sp_watch.set_defaults(which='watch');
+
     sp_add = sp.add_parser('add', parents=[p_report], help='Add backup report');
     sp_add.set_defaults(which='add');
 
+    sp_add_batch = sp.add_parser('add-batch', parents=[p_add_batch], help='Add backup reports in bulk. No error emails are sent for them.');
+    sp_add_batch.set_defaults(which='add-batch');
+
+    sp_prune = sp.add_parser('prune', parents=[p_prune], help='Move old reports into monthly archives. The daily status that check uses is kept.');
+    sp_prune.set_defaults(which='prune');
+
+    sp_stats = sp.add_parser('stats', parents=[p_stats, p_format], help='Show the duration percentiles, failure rate, trend and unusual durations of the schedules');
+    sp_stats.set_defaults(which='stats');
+
+    sp_export_metrics = sp.add_parser('export-metrics', parents=[p_export_metrics], help='Export the health of the schedules as Prometheus metrics');
+    sp_export_metrics.set_defaults(which='export-metrics');
+
+    sp_rebuild_status = sp.add_parser('rebuild-status', help='Rebuild the daily status of the schedules, that check uses, from the reports');
+    sp_rebuild_status.set_defaults(which='rebuild-status');
+
+    sp_flush_notifications = sp.add_parser('flush-notifications', parents=[p_flush_notifications], help='Send the queued error emails, one digest per destination host');
+    sp_flush_notifications.set_defaults(which='flush-notifications');
+
+    sp_serve = sp.add_parser('serve', parents=[p_serve], help='Run a report server that adds the reports sent by add and sends the queued error emails');
+    sp_serve.set_defaults(which='serve');
+
     sp_delete_schedule = sp.add_parser('delete-report', parents=[p_delete_schedule], help='Delete Report');
     sp_delete_schedule.set_defaults(which='delete-report');
 
@@ -169,77 +649,136 @@ class NekBackupMonitor(object):
     sp_delete_schedule = sp.add_parser('delete-schedule', parents=[p_delete_schedule], help='Delete Schedule');
     sp_delete_schedule.set_defaults(which='delete-schedule');
 
+    sp_export_schedules = sp.add_parser('export-schedules', parents=[p_export_schedules, p_schedule_file], help='Write all schedules to a JSON or CSV file');
+    sp_export_schedules.set_defaults(which='export-schedules');
+
+    sp_import_schedules = sp.add_parser('import-schedules', parents=[p_import_schedules, p_schedule_file], help='Make the schedules match a JSON or CSV file, in one transaction');
+    sp_import_schedules.set_defaults(which='import-schedules');
+
     if(len(sys.argv)) == 1:
       parser.print_usage();
       exit(0);
 
     args = parser.parse_args();
+
+    # --profile prints the summary to stderr, --profile-json writes it as
+    # JSON. NEKBACKUPMONITOR_PROFILE does the same: 1 for stderr, otherwise the
+    # JSON file.
+    profileFile = args.profile_json;
+    if(profileFile == None and args.profile == False):
+      profileFile = os.environ.get('NEKBACKUPMONITOR_PROFILE') or None;
+      if(profileFile == '1'):
+        profileFile = None;
+        args.profile = True;
+    if(args.profile == True or profileFile != None):
+      self.startProfiling(Profiler());
+
+    try:
+      self.runCommand(args);
+    finally:
+      if(self.profiler != None):
+        self.profiler.report(args.which, profileFile);
+
+  def runCommand(self, args):
     if(args.which == 'list-schedules'):
       self.listSchedules(args);
     elif(args.which == 'list-reports'):
       self.listReports(args);
+    elif(args.which == 'search-reports'):
+      self.searchReports(args);
     elif(args.which == 'add'):
-      self.addReport(args);
+      if(self.forwardReport(args) == False):
+        self.addReport(args);
+    elif(args.which == 'add-batch'):
+      self.addReportsBatch(args);
+    elif(args.which == 'prune'):
+      self.pruneReports(args);
+    elif(args.which == 'stats'):
+      self.showStats(args);
+    elif(args.which == 'export-metrics'):
+      self.exportMetrics(args);
+    elif(args.which == 'rebuild-status'):
+      self.rebuildStatus(args);
+    elif(args.which == 'flush-notifications'):
+      self.flushNotificationsCommand(args);
+    elif(args.which == 'serve'):
+      self.serve(args);
     elif(args.which == 'delete-report'):
       self.deleteReport(args);
     elif(args.which == 'add-schedule'):
       self.addSchedule(args);
     elif(args.which == 'delete-schedule'):
       self.deleteSchedule(args);
+    elif(args.which == 'export-schedules'):
+      self.exportSchedules(args);
+    elif(args.which == 'import-schedules'):
+      self.importSchedules(args);
     elif(args.which == 'check'):
       self.checkReports(args);
+    elif(args.which == 'watch'):
+      self.watch(args);
 
   def listSchedules(self, args):
+    if(args.format != 'text'):
+      writer = RowWriter(args.format, self.scheduleFields);
+      for schedule in self.getAllSchedules():
+        writer.write({'id': schedule.id, 'title': schedule.title, 'interval': schedule.interval,
+                      'source_host': schedule.sourceHost, 'destination_host': schedule.destinationHost,
+                      'source_dir': schedule.sourceDir, 'destination_dir': schedule.destinationDir, 'type': schedule.type});
+      writer.close();
+      return;
+
     print("Listing Schedules");
     
     all_rows = self.getAllSchedules();
     
     if(args.full):
-      templateColumns = "{index:4.4} {id:4.4} {title:15.15} {interval:>12.12} {sourcehost:10.10} {destinationhost:20.20} {sourcedir:30.30} {destinationdir:30.30} {type:2.2}";
-      reportHeader = templateColumns.format(index="#", id="ID", title="Title", 
-                        interval="Interval", sourcehost="SourceHost", 
-                        destinationhost="DestinationHost", 
-                        sourcedir="SourceDir", destinationdir="DestinationDir", 
-                        type="Type");
-      print(reportHeader);
-      index = 0;
-      for row in all_rows:
-        index = index + 1;
-        reportRow = templateColumns.format(index=str(index), id=str(row['id']), 
-                        title=str(row['title']), interval=str(row['interval']), 
-                        sourcehost=str(row['sourcehost']), 
-                        destinationhost=str(row['destinationhost']),
-                        sourcedir=str(row['sourcedir']),
-                        destinationdir=str(row['destinationdir']),
-                        type=str(row['type']));
-        print(self.formatForTextDisplay(reportRow));
+      columns = [('index', 4, '<', False), ('id', 4, '<', False), ('title', 15, '<', False), ('interval', 12, '>', False),
+                 ('sourcehost', 10, '<', False), ('destinationhost', 20, '<', False),
+                 ('sourcedir', 30, '<', False), ('destinationdir', 30, '<', False), ('type', 2, '<', False)];
+      header = {'index': "#", 'id': "ID", 'title': "Title", 'interval': "Interval", 'sourcehost': "SourceHost",
+                'destinationhost': "DestinationHost", 'sourcedir': "SourceDir", 'destinationdir': "DestinationDir",
+                'type': "Type"};
     else:
-      templateColumns = "{index:4.4} {id:4.4} {title:15.15} {interval:>12.12} {sourcehost:15.15} {destinationhost:15.15}";
-      reportHeader = templateColumns.format(index="#", id="ID", title="Title", 
-                        interval="Interval", sourcehost="SourceHost", 
-                        destinationhost="DestHost");
-      print(reportHeader);
-      index = 0;
-      for row in all_rows:
-        index = index + 1;
-        reportRow = templateColumns.format(index=str(index), id=str(row['id']), 
-                        title=str(row['title']), interval=str(row['interval']), 
-                        sourcehost=str(row['sourcehost']), 
-                        destinationhost=str(row['destinationhost']));
-        print(self.formatForTextDisplay(reportRow));
+      columns = [('index', 4, '<', False), ('id', 4, '<', False), ('title', 15, '<', False), ('interval', 12, '>', False),
+                 ('sourcehost', 15, '<', False), ('destinationhost', 15, '<', False)];
+      header = {'index': "#", 'id': "ID", 'title': "Title", 'interval': "Interval", 'sourcehost': "SourceHost",
+                'destinationhost': "DestHost"};
+
+    print(self.renderRow(columns, header));
+    index = 0;
+    for schedule in all_rows:
+      index = index + 1;
+      print(self.renderRow(columns, {'index': index, 'id': schedule.id, 'title': schedule.title, 'interval': schedule.interval,
+                      'sourcehost': schedule.sourceHost, 'destinationhost': schedule.destinationHost,
+                      'sourcedir': schedule.sourceDir, 'destinationdir': schedule.destinationDir, 'type': schedule.type}));
 
   def listReports(self, args):
     c = self.conn.cursor();
 
     if(args.report):
-      self.displayReport(args.report);
+      self.displayReport(args.report, args.head, args.tail, args.format);
       return;
 
+    # the text output has a title line, the --format output only the rows
+    if(args.format == 'text'):
+      printTitle = print;
+    else:
+      printTitle = lambda title: None;
+
+    if(args.limit != None and args.limit < 1):
+      print("ERROR: The limit must be a positive integer e.g. 50 or 1000", file=sys.stderr);
+      exit(1);
+
+    conditions = [];
+    params = {};
+
     if(args.schedule):
       selectedSchedule = self.getSchedule(args.schedule);
       if(selectedSchedule):
-        print("Listing Reports for schedule " + selectedSchedule['title'] + " (ID: " + str(selectedSchedule['id']) + ")");
-        c.execute('SELECT id, Schedule, date, Result, duration, message FROM {tn} WHERE schedule = :si'.format(tn=self.tableReports), {'si':args.schedule});
+        printTitle("Listing Reports for schedule " + selectedSchedule.title + " (ID: " + str(selectedSchedule.id) + ")");
+        conditions.append('r.Schedule = :si');
+        params['si'] = args.schedule;
       else:
         print("ERROR: No schedule found with id: " + str(args.schedule), file=sys.stderr);
         exit(1);
@@ -283,75 +822,565 @@ class NekBackupMonitor(object):
         print("ERROR: To Date must be after the From Date.", file=sys.stderr);
         exit(1);
 
-      d1 = listReportsFromDate;
-      d2 = listReportsToDate;
-      d1Timestamp = self.totimestamp(d1);
-      d2Timestamp = self.totimestamp(d2);
-      print("Listing Reports from date {d1} to {d2}".format(d1=listReportsFromDate.strftime("%Y-%m-%d %H:%M:%S"), d2=listReportsToDate.strftime("%Y-%m-%d %H:%M:%S")));
-      queryString = 'SELECT * FROM {tn} WHERE date BETWEEN :d1 AND :d2 '.format(tn=self.tableReports);
-      #print(queryString);
-      c.execute(queryString, {'d1': d1Timestamp, 'd2': d2Timestamp});
+      printTitle("Listing Reports from date {d1} to {d2}".format(d1=listReportsFromDate.strftime("%Y-%m-%d %H:%M:%S"), d2=listReportsToDate.strftime("%Y-%m-%d %H:%M:%S")));
+      conditions.append('r.date BETWEEN :d1 AND :d2');
+      params['d1'] = self.totimestamp(listReportsFromDate);
+      params['d2'] = self.totimestamp(listReportsToDate);
+
+    # pruned reports are read from the archives of the months in the range
+    archivedReports = self.iterArchivedReports(params.get('d1'), params.get('d2'), params.get('si'));
+
+    # keyset pagination: continue right after the given report in (date, id) order
+    afterKey = None;
+    if(args.after_id != None):
+      c.execute('SELECT date FROM {tn} WHERE id = :ri'.format(tn=self.tableReports), {'ri': args.after_id});
+      afterRow = c.fetchone();
+      if(afterRow != None):
+        afterKey = (afterRow['date'], args.after_id);
+      else:
+        for archivedReport in self.iterArchivedReports(params.get('d1'), params.get('d2'), params.get('si')):
+          if(archivedReport['id'] == args.after_id):
+            afterKey = (archivedReport['date'], args.after_id);
+            break;
+      if(afterKey == None):
+        print("ERROR: No report found with id: " + str(args.after_id), file=sys.stderr);
+        exit(1);
+      conditions.append('(r.date, r.id) > (:ad, :ai)');
+      params['ad'] = afterKey[0];
+      params['ai'] = afterKey[1];
+      archivedReports = (archivedReport for archivedReport in archivedReports if (archivedReport['date'], archivedReport['id']) > afterKey);
+
+    # the message is never loaded here, it can be arbitrarily large. The titles
+    # come from the schedule cache.
+    queryString = """
+      SELECT r.id, r.Schedule, r.date, r.Result, r.duration
+      FROM {tn} r
+      WHERE {where}
+      ORDER BY r.date, r.id
+      """.format(tn=self.tableReports, where=' AND '.join(conditions));
+    if(args.limit != None):
+      # fetch one more row to know whether there is a next page
+      queryString += 'LIMIT :limit';
+      params['limit'] = args.limit + 1;
+    c.execute(queryString, params);
+
+    if(args.format != 'text'):
+      self.writeReports(args.format, itertools.chain(archivedReports, c), args.limit);
+      return;
 
-    all_rows = c.fetchall();
-    index = 0;
-    templateColumns = "{index:4.4s} {id:4.4s} {schedule:25.25s} {date:20.20s} {result:20.20s} {dur:9.9s}";
-    reportHeader = templateColumns.format(index="#", id="ID", schedule="Schedule (id)", 
-                      date="Date", result="Result", dur="Duration");
+    schedules = self.repository.schedules();
 
-    print(reportHeader);
-    for row in all_rows:
+    index = 0;
+    lastReportId = None;
+    columns = [('index', 4, '<', False), ('id', 4, '<', False), ('schedule', 25, '<', False),
+               ('date', 20, '<', False), ('result', 20, '<', True), ('dur', 9, '<', False)];
+    print(self.renderRow(columns, {'index': "#", 'id': "ID", 'schedule': "Schedule (id)",
+                      'date': "Date", 'result': "Result", 'dur': "Duration"}));
+    # the archived reports are older than the ones still in the database
+    for row in itertools.chain(archivedReports, c):
+      if(args.limit != None and index == args.limit):
+        print("More reports are available. Continue with --after-id {ri}".format(ri=lastReportId));
+        break;
       index = index + 1;
-      scheduleTitle = 'N/A';
+      lastReportId = row['id'];
+      scheduleTitle = self.reportScheduleTitle(schedules, row) or 'N/A';
+
+      print(self.renderRow(columns, {'index': index, 'id': row['id'],
+                      'schedule': scheduleTitle + ' (' + str(row['Schedule']) + ')',
+                      'date': self.unixToDate(int(row['date'])),
+                      'result': self.formatReportResult(row['Result']),
+                      'dur': self.secondsToTime(row['duration'])}));
+
+  # Writes the reports, read lazily from the rows, in a --format output. The
+  # note about the next page goes to stderr, to keep the output parseable.
+  def writeReports(self, outputFormat, rows, limit):
+    schedules = self.repository.schedules();
+    writer = RowWriter(outputFormat, self.reportFields);
+    numberOfReports = 0;
+    lastReportId = None;
+    for row in rows:
+      if(limit != None and numberOfReports == limit):
+        print("More reports are available. Continue with --after-id {ri}".format(ri=lastReportId), file=sys.stderr);
+        break;
+      writer.write({'id': row['id'], 'schedule_id': row['Schedule'], 'schedule_title': self.reportScheduleTitle(schedules, row),
+                    'starting_timestamp': row['date'], 'result': self.resultNames.get(row['Result'], row['Result']),
+                    'duration_in_seconds': row['duration']});
+      numberOfReports = numberOfReports + 1;
+      lastReportId = row['id'];
+    writer.close();
+
+  # Full-text search over the messages of the reports still in the database.
+  # The index has one row per message chunk; a report is ranked by the bm25
+  # score of its best chunk, and the snippet comes from that chunk.
+  def searchReports(self, args):
+    import re;
+    import zlib;
+
+    if(args.limit < 1):
+      print("ERROR: The limit must be a positive integer e.g. 20 or 100", file=sys.stderr);
+      exit(1);
 
-      schedule = self.getSchedule(row['schedule']);
-      if(schedule):
-        scheduleTitle = schedule['title'];
+    if(not self.hasSearchIndex(self.conn)):
+      if(not self.hasFts5(self.conn)):
+        print("ERROR: search-reports is not available, the SQLite of this Python is built without FTS5", file=sys.stderr);
+        exit(1);
+      # the database was upgraded by a NekBackupMonitor whose SQLite lacks FTS5
+      print("Building the search index of the report messages...", file=sys.stderr);
+      c = self.conn.cursor();
+      try:
+        self.beginWrite(c);
+        self.createSearchIndex(self.conn);
+        self.rebuildSearchIndex(self.conn);
+        self.conn.commit();
+      except sqlite3.Error as e:
+        self.conn.rollback();
+        print("ERROR: Failed to build the search index: {e}".format(e=e.args[0]), file=sys.stderr);
+        exit(1);
 
-      reportRow = templateColumns.format(index=str(index), id=str(row['id']), 
-                      schedule=scheduleTitle + ' (' + str(row['schedule']) + ')', 
-                      dur=str(self.secondsToTime(row['duration'])),
-                      result=str(self.formatReportResult(row['result'])),
-                      date=str(self.unixToDate(int(row['date']))),
-                      );
-      print(self.formatForTextDisplay(reportRow));
+    # the words of the query, to highlight them in the snippets
+    if(args.match):
+      words = [word for word in re.findall(r'[^\W_]+\*?', args.QUERY) if not word in ('AND', 'OR', 'NOT', 'NEAR')];
+      query = args.QUERY;
+    else:
+      words = re.findall(r'[^\W_]+', args.QUERY);
+      # every word is a quoted string, so that no character of it has a meaning in the FTS5 syntax
+      query = ' '.join('"' + word.replace('"', '""') + '"' for word in args.QUERY.split());
+    if(len(words) == 0):
+      print("ERROR: The query has no words to search for", file=sys.stderr);
+      exit(1);
+
+    conditions = ['1'];
+    params = {'query': query, 'cf': self.searchChunkFactor, 'limit': args.limit};
+
+    if(args.schedule != None):
+      if(not self.scheduleExists(args.schedule)):
+        print("ERROR: No schedule found with id: " + str(args.schedule), file=sys.stderr);
+        exit(1);
+      conditions.append('r.Schedule = :si');
+      params['si'] = args.schedule;
+
+    if(args.result):
+      resultCodes = {name: code for code, name in self.resultNames.items()};
+      conditions.append('r.Result IN (SELECT value FROM json_each(:results))');
+      params['results'] = json.dumps([resultCodes[result] for result in args.result]);
+
+    fromDate = None;
+    toDate = None;
+    if(args.date):
+      fromDate = self.parseDate(args.date);
+      toDate = fromDate;
+    else:
+      if(args.fromdate):
+        fromDate = self.parseDate(args.fromdate);
+      if(args.todate):
+        toDate = self.parseDate(args.todate);
+      if(args.days != None):
+        if(args.days < 1):
+          print("ERROR: Number of Days must be an positve integer e.g. 5 or 120", file=sys.stderr);
+          exit(1);
+        fromDate = datetime.datetime.now().replace(hour=0, minute=0, second=0, microsecond=0) - datetime.timedelta(days=args.days);
+    if(fromDate != None):
+      conditions.append('r.date >= :d1');
+      params['d1'] = self.totimestamp(fromDate);
+    if(toDate != None):
+      conditions.append('r.date < :d2');
+      params['d2'] = self.totimestamp(toDate + datetime.timedelta(days=1));
+    if(fromDate != None and toDate != None and toDate < fromDate):
+      print("ERROR: To Date must be after the From Date.", file=sys.stderr);
+      exit(1);
+
+    # min() makes SQLite take the chunk from the row with the best score
+    c = self.conn.cursor();
+    try:
+      c.execute("""
+        SELECT r.id, r.Schedule, r.date, r.Result, r.duration, min(h.rank) AS score, h.rowid % :cf AS chunk
+        FROM (SELECT rowid, rank FROM {ts} WHERE {ts} MATCH :query) h
+        JOIN {tn} r ON r.id = h.rowid / :cf
+        WHERE {where}
+        GROUP BY r.id
+        ORDER BY score, r.date DESC
+        LIMIT :limit
+        """.format(ts=self.tableSearch, tn=self.tableReports, where=' AND '.join(conditions)), params);
+      rows = c.fetchall();
+    except sqlite3.OperationalError as e:
+      print("ERROR: Invalid search query: {e}".format(e=e.args[0]), file=sys.stderr);
+      exit(1);
+
+    # a word matches as a whole token, a word* as the start of one, like in the index
+    patterns = [];
+    for word in words:
+      if(word.endswith('*')):
+        patterns.append(re.escape(word[:-1]) + r'[^\W_]*');
+      else:
+        patterns.append(re.escape(word) + r'(?![^\W_])');
+    wordPatterns = [re.compile(r'(?<![^\W_])' + pattern, re.IGNORECASE) for pattern in patterns];
+    wordsPattern = re.compile(r'(?<![^\W_])(?:' + '|'.join(patterns) + ')', re.IGNORECASE);
+
+    results = [];
+    for row in rows:
+      # the row of the chunk may start with the last line of the previous chunk
+      data = b''.join(zlib.decompress(chunkRow[0]) for chunkRow in self.conn.execute(
+               'SELECT data FROM {tm} WHERE Report = :ri AND chunk BETWEEN :ci - 1 AND :ci ORDER BY chunk'.format(tm=self.tableMessages),
+               {'ri': row['id'], 'ci': row['chunk']}));
+      snippet, spans = self.searchSnippet(data.decode('utf-8', errors='replace'), wordPatterns, wordsPattern);
+      results.append((row, snippet, spans));
+
+    schedules = self.repository.schedules();
+
+    if(args.format != 'text'):
+      writer = RowWriter(args.format, self.searchFields);
+      for row, snippet, spans in results:
+        writer.write({'id': row['id'], 'schedule_id': row['Schedule'], 'schedule_title': self.reportScheduleTitle(schedules, row),
+                      'starting_timestamp': row['date'], 'result': self.resultNames.get(row['Result'], row['Result']),
+                      'duration_in_seconds': row['duration'], 'score': round(-row['score'], 3), 'snippet': snippet});
+      writer.close();
+      return;
+
+    print("Searching the report messages for: " + args.QUERY);
+    columns = [('index', 4, '<', False), ('id', 6, '<', False), ('schedule', 25, '<', False),
+               ('date', 20, '<', False), ('result', 20, '<', True), ('dur', 9, '<', False)];
+    print(self.renderRow(columns, {'index': "#", 'id': "ID", 'schedule': "Schedule (id)",
+                      'date': "Date", 'result': "Result", 'dur': "Duration"}));
+    for index, (row, snippet, spans) in enumerate(results, 1):
+      scheduleTitle = self.reportScheduleTitle(schedules, row) or 'N/A';
+      print(self.renderRow(columns, {'index': index, 'id': row['id'],
+                      'schedule': scheduleTitle + ' (' + str(row['Schedule']) + ')',
+                      'date': self.unixToDate(int(row['date'])),
+                      'result': self.formatReportResult(row['Result']),
+                      'dur': self.secondsToTime(row['duration'])}));
+      highlighted = '';
+      position = 0;
+      for start, end in spans:
+        highlighted += snippet[position:start] + bcolors.BOLD + bcolors.WARNING + snippet[start:end] + bcolors.ENDC;
+        position = end;
+      print('     ' + highlighted + snippet[position:]);
+
+    if(len(results) == 0):
+      print("No report message matches");
+    elif(len(results) == args.limit):
+      print("Only the best {n} matches are shown, see --limit".format(n=args.limit));
+
+  # The snippet of a search result: the line of the first match of the rarest
+  # word of the query in a message chunk, cut to searchSnippetChars around the
+  # match. Returns the snippet and the (start, end) spans of the matches in it.
+  def searchSnippet(self, text, wordPatterns, wordsPattern):
+    match = None;
+    matchCount = None;
+    for wordPattern in wordPatterns:
+      wordMatches = list(itertools.islice(wordPattern.finditer(text), 0, matchCount));
+      if(len(wordMatches) > 0 and (matchCount == None or len(wordMatches) < matchCount)):
+        match = wordMatches[0];
+        matchCount = len(wordMatches);
+    if(match == None):
+      # the match is in a phrase that crosses a line, or in a character the
+      # pattern does not fold like the index; show the start of the chunk
+      matchStart = 0;
+      matchEnd = 0;
+    else:
+      matchStart = match.start();
+      matchEnd = match.end();
+
+    lineStart = text.rfind('\n', 0, matchStart) + 1;
+    lineEnd = text.find('\n', matchEnd);
+    if(lineEnd == -1):
+      lineEnd = len(text);
+
+    start = max(lineStart, matchStart - (self.searchSnippetChars - (matchEnd - matchStart)) // 2);
+    end = min(lineEnd, start + self.searchSnippetChars);
+    start = max(lineStart, min(start, end - self.searchSnippetChars));
+    prefix = '...' if start > lineStart else '';
+    suffix = '...' if end < lineEnd else '';
+    snippet = prefix + text[start:end].replace('\t', ' ').replace('\r', '') + suffix;
+
+    spans = [(m.start(), m.end()) for m in wordsPattern.finditer(snippet, len(prefix), len(snippet) - len(suffix))];
+    return snippet, spans;
+
+  # The title of the schedule of a report row. An archived report keeps the
+  # title its schedule had when it was archived, for deleted schedules.
+  def reportScheduleTitle(self, schedules, row):
+    schedule = schedules.get(row['Schedule']);
+    if(schedule != None):
+      return schedule.title;
+    if(isinstance(row, dict)):
+      return row.get('Title');
+    return None;
+
+  def getArchiveDir(self):
+    archiveDir = self.readConfig().get('Retention', 'ArchiveDir', fallback=self.defaultArchiveDir);
+    return os.path.join(self.currentPath, archiveDir);
+
+  # The ids of the last batch of reports that prune archived, or an empty set.
+  # If prune stopped before it deleted them, they are still in the database.
+  def readArchivedBatch(self):
+    try:
+      with open(os.path.join(self.getArchiveDir(), 'last-batch.json'), 'r') as batchFile:
+        return set(json.load(batchFile));
+    except (OSError, ValueError):
+      return set();
+
+  def writeArchivedBatch(self, reportIds):
+    batchPath = os.path.join(self.getArchiveDir(), 'last-batch.json');
+    with open(batchPath + '.tmp', 'w') as batchFile:
+      json.dump(reportIds, batchFile);
+      batchFile.flush();
+      os.fsync(batchFile.fileno());
+    os.replace(batchPath + '.tmp', batchPath);
+
+  # Yields the archived reports of the months that overlap the range
+  # [d1Timestamp, d2Timestamp], or of all months without a range, optionally
+  # only the ones of one schedule. The archives are read lazily, month by
+  # month, in the order in which the reports were archived. A report that was
+  # archived twice, by a prune that stopped before it deleted it, is yielded
+  # once.
+  def iterArchivedReports(self, d1Timestamp, d2Timestamp, scheduleId):
+    import gzip;
+
+    try:
+      archiveNames = sorted(os.listdir(self.getArchiveDir()));
+    except OSError:
+      return;
+
+    firstMonth = None;
+    lastMonth = None;
+    reportIds = set();
+    if(d1Timestamp != None):
+      firstMonth = datetime.datetime.fromtimestamp(d1Timestamp).strftime('%Y-%m');
+      lastMonth = datetime.datetime.fromtimestamp(d2Timestamp).strftime('%Y-%m');
+
+    for archiveName in archiveNames:
+      # reports-YYYY-MM.ndjson.gz
+      if(not archiveName.startswith('reports-') or not archiveName.endswith('.ndjson.gz')):
+        continue;
+      month = archiveName[len('reports-'):-len('.ndjson.gz')];
+      if(firstMonth != None and (month < firstMonth or month > lastMonth)):
+        continue;
+
+      with gzip.open(os.path.join(self.getArchiveDir(), archiveName), 'rt', encoding='utf-8') as archiveFile:
+        for line in archiveFile:
+          report = json.loads(line);
+          if(scheduleId != None and report['Schedule'] != scheduleId):
+            continue;
+          if(d1Timestamp != None and (report['date'] < d1Timestamp or report['date'] > d2Timestamp)):
+            continue;
+          if(report['id'] in reportIds):
+            continue;
+          reportIds.add(report['id']);
+          yield report;
+
+  # Moves the reports older than the retention period into monthly compressed
+  # NDJSON archives. The reports are deleted in small batches, each in its own
+  # short write transaction, after they have been written to the archive. Each
+  # batch is a complete gzip member, so an interrupted prune leaves readable
+  # archives, and the ids of the last batch are kept so that the next prune
+  # does not archive them again.
+  def pruneReports(self, args):
+    import gzip;
+
+    keepDays = args.days;
+    if(keepDays == None):
+      keepDays = self.getIntSetting('Retention', 'KeepDays', 0);
+    if(keepDays < 1):
+      print("ERROR: No retention period. Set KeepDays under the [Retention] section or use --days.", file=sys.stderr);
+      exit(1);
+    batchSize = args.batch_size or self.getIntSetting('Retention', 'PruneBatchSize', self.defaultPruneBatchSize);
+
+    cutoffDate = datetime.datetime.now().replace(hour=0, minute=0, second=0, microsecond=0) - datetime.timedelta(days=keepDays);
+    print("Archiving the reports before {d} to {a}".format(d=cutoffDate.strftime("%Y-%m-%d"), a=self.getArchiveDir()));
+    os.makedirs(self.getArchiveDir(), exist_ok=True);
 
-  def displayReport(self, reportId):
     c = self.conn.cursor();
+    numberOfPruned = 0;
+    # archived, but maybe not deleted
+    archivedIds = self.readArchivedBatch();
+    # month -> archive file
+    archiveFiles = {};
+    # month -> gzip member of the current batch
+    batchArchives = {};
+    try:
+      while True:
+        c.execute("""
+          SELECT r.id, r.Schedule, s.Title, r.date, r.Result, r.duration
+          FROM {tn} r LEFT JOIN {st} s ON s.id = r.Schedule
+          WHERE r.date < :cutoff
+          ORDER BY r.date, r.id LIMIT :batch
+          """.format(tn=self.tableReports, st=self.tableSchedules), {'cutoff': self.totimestamp(cutoffDate), 'batch': batchSize});
+        reports = c.fetchall();
+        if(len(reports) == 0):
+          break;
+
+        for report in reports:
+          if(report['id'] in archivedIds):
+            continue;
+          archivedReport = dict(zip(report.keys(), report));
+          archivedReport['message'] = self.readMessage(report['id']);
+          month = datetime.datetime.fromtimestamp(report['date']).strftime('%Y-%m');
+          if(not month in archiveFiles):
+            archiveFiles[month] = open(os.path.join(self.getArchiveDir(), 'reports-' + month + '.ndjson.gz'), 'ab');
+          if(not month in batchArchives):
+            batchArchives[month] = gzip.GzipFile(fileobj=archiveFiles[month], mode='ab');
+          batchArchives[month].write((json.dumps(archivedReport) + '\n').encode('utf-8'));
+
+        # the archive must be on disk before the reports are deleted
+        for month, archiveGzipFile in batchArchives.items():
+          archiveGzipFile.close();
+          archiveFiles[month].flush();
+          os.fsync(archiveFiles[month].fileno());
+        batchArchives = {};
+        self.writeArchivedBatch([report['id'] for report in reports]);
+
+        reportIds = [(report['id'],) for report in reports];
+        self.beginWrite(c);
+        self.unindexMessages(c, [report['id'] for report in reports]);
+        c.executemany('DELETE FROM {tm} WHERE Report = ?'.format(tm=self.tableMessages), reportIds);
+        c.executemany('DELETE FROM {tn} WHERE id = ?'.format(tn=self.tableReports), reportIds);
+        self.conn.commit();
+        numberOfPruned = numberOfPruned + len(reports);
+    except sqlite3.Error as e:
+      self.conn.rollback();
+      print("ERROR: Failed to prune reports, {n} reports had been pruned before: {e}".format(n=numberOfPruned, e=e.args[0]), file=sys.stderr);
+      exit(1);
+    finally:
+      for archiveGzipFile in batchArchives.values():
+        archiveGzipFile.close();
+      for archiveFile in archiveFiles.values():
+        archiveFile.close();
+
+    print("Pruned {n} reports".format(n=numberOfPruned));
+
+    if(args.vacuum == True or args.no_vacuum == False):
+      self.vacuum(c, args.vacuum);
+
+    self.conn.close();
+
+  # Gives the free pages of the database back to the file system, a few at a
+  # time, each step in its own short write transaction. The database has to be
+  # switched to incremental vacuum once, with a full VACUUM that locks it
+  # completely; that is only done with convert.
+  def vacuum(self, c, convert):
+    try:
+      if(self.conn.execute('PRAGMA auto_vacuum').fetchone()[0] != 2):
+        if(convert == False):
+          print("The free space stays in the database file. Run prune --vacuum once, while no backups report, to give it back to the file system from then on.");
+          return;
+        print("Enabling incremental vacuum. This needs a one-time full VACUUM of the database...");
+        self.conn.execute('PRAGMA auto_vacuum = INCREMENTAL');
+        self.conn.execute('VACUUM');
+        return;
+
+      while(self.conn.execute('PRAGMA freelist_count').fetchone()[0] > 0):
+        self.beginWrite(c);
+        c.execute('PRAGMA incremental_vacuum({n:d})'.format(n=self.vacuumPagesPerStep)).fetchall();
+        self.conn.commit();
+    except sqlite3.Error as e:
+      self.conn.rollback();
+      print("ERROR: Failed to vacuum the database: {e}".format(e=e.args[0]), file=sys.stderr);
+      exit(1);
+
+  def displayReport(self, reportId, head=None, tail=None, outputFormat='text'):
+    if(head != None and tail != None):
+      print("ERROR: --head and --tail cannot be used together.", file=sys.stderr);
+      exit(1);
+    if((head != None and head < 1) or (tail != None and tail < 1)):
+      print("ERROR: The number of lines must be a positive integer e.g. 20 or 100", file=sys.stderr);
+      exit(1);
     
+    report = self.repository.getReport(reportId);
+
+    if(report and outputFormat != 'text'):
+      writer = RowWriter(outputFormat, ['id', 'schedule_id', 'starting_timestamp', 'result', 'duration_in_seconds', 'message']);
+      writer.write({'id': report.id, 'schedule_id': report.schedule, 'starting_timestamp': report.date,
+                    'result': self.resultNames.get(report.result, report.result), 'duration_in_seconds': report.duration,
+                    'message': self.readMessage(reportId, head, tail)});
+      writer.close();
+      return;
+
     print("Listing details for a report");
     
-    c.execute('SELECT id, Schedule, date, Result, duration, message FROM {tn} WHERE id = {ri}'.format(tn=self.tableReports, ri=reportId));
-    row = c.fetchone();
-    
-    if(row):
-      reportRow = 'ID: ' + str(row['id']) + "\n";
-      reportRow += 'Schedule: ' + str(row['Schedule']) + "\n";
-      reportRow += 'Date: ' + self.unixToDate(int(row['date'])) + "\n";
-      reportRow += 'Result: ' + self.formatReportResult(row['Result']) + "\n";
-      reportRow += 'Duration: ' + self.secondsToTime((row['duration'])) + "\n";
-      if row['message'] != None:
-        reportRow += 'Message:\n"' + row['message'].replace('\\n', "\n") + '"\n';
+    if(report):
+      reportRow = 'ID: ' + str(report.id) + "\n";
+      reportRow += 'Schedule: ' + str(report.schedule) + "\n";
+      reportRow += 'Date: ' + self.unixToDate(int(report.date)) + "\n";
+      reportRow += 'Result: ' + self.renderStatus(self.formatReportResult(report.result)) + "\n";
+      reportRow += 'Duration: ' + self.secondsToTime((report.duration)) + "\n";
+      reportMessage = self.readMessage(reportId, head, tail);
+      if reportMessage != None:
+        if(head != None):
+          reportRow += 'Message (first {n} lines):\n"'.format(n=head);
+        elif(tail != None):
+          reportRow += 'Message (last {n} lines):\n"'.format(n=tail);
+        else:
+          reportRow += 'Message:\n"';
+        reportRow += reportMessage.replace('\\n', "\n") + '"\n';
       else:
         reportRow += 'No Message\n';
-      print(self.formatForTextDisplay(reportRow));
+      print(reportRow);
     else:
       print("ERROR: No report found with id: " + str(reportId), file=sys.stderr);
       exit(1);
     
     
   def getAllSchedules(self):
-    c = self.conn.cursor();
-
-    c.execute('SELECT * FROM {tn}'.format(tn=self.tableSchedules))
-    all_rows = c.fetchall();
-    return all_rows;
+    return self.repository.schedules().values();
 
   def addReport(self, args):
+    reportMessage = self.readReportMessage(args);
+
+    try:
+      scheduleId, datetimeReport, reportResult, reportsDuration = self.parseReport(args.schedule_id, 
+                      args.starting_timestamp, args.result, args.duration_in_seconds);
+    except ValueError as e:
+      print("ERROR: " + str(e), file=sys.stderr);
+      exit(1);
+
+    if(self.scheduleExists(scheduleId) == True):
+      msg = None;
+      if(isinstance(reportMessage, io.IOBase)):
+        msg = "<read from stdin>";
+      elif(reportMessage != None):
+        if len(reportMessage) > 100:
+          msg = "<too big to list> (" + str(len(reportMessage)) + " chars total)";
+        else:
+          msg = "\"" + reportMessage + "\"";
+      print("""Adding report with the following details: 
+Schedule = {s}
+Datetime = {d}
+Result = {r}
+Duration = {dr} seconds
+Message = {msg}
+""".format(s=scheduleId, d=datetimeReport, r=self.formatReportResult(reportResult), dr=reportsDuration, msg=msg));
+
+      try:
+        self.storeReport(scheduleId, datetimeReport, reportResult, reportsDuration, reportMessage);
+      except sqlite3.Error as e:
+        # fail loudly, so that the backup job knows that the report is lost
+        print("ERROR: Failed to execute SQL statement for inserting a new report: " + e.args[0], file=sys.stderr);
+        self.conn.close();
+        exit(1);
+
+      # the queued email is sent by the report server or by flush-notifications
+      # from cron. With SendOnAdd, add sends the pending emails itself, but
+      # only the ones that waited DigestWindow seconds, so that a burst of
+      # failures still ends up in one digest.
+      # storeReport has loaded the email settings for an error report
+      if(reportResult in (ReportResult.ERROR, ReportResult.DONE_BUT_VERIFICATION_ERROR) and self.sendEmailImmediatelyOnErrorReport == True
+         and self.readConfig().getboolean('Notifications', 'SendOnAdd', fallback=False) == True):
+        try:
+          self.flushNotifications();
+        except sqlite3.Error as e:
+          self.conn.rollback();
+          print("WARNING: The error email stays queued, failed to read the notifications: " + e.args[0], file=sys.stderr);
+        except DeliveryError as e:
+          print("WARNING: The error email stays queued, it could not be sent: " + str(e), file=sys.stderr);
+        self.closeMailer();
 
-    if(args.schedule_id == None):
-      print("ERROR: no schedule ID has been specified.", file=sys.stderr);
+      self.conn.close()
+    else:
+      print('ERROR: Schedule with ID {s} does not exist'.format(s=scheduleId), file=sys.stderr);
+      self.conn.close();
       exit(1);
 
+  # Reads the report message of the add command, either from -m or from stdin.
+  def readReportMessage(self, args):
     reportMessage = None;
     if(args.stdin_message == True):
       # make sure there is no -m specified
@@ -363,123 +1392,617 @@ class NekBackupMonitor(object):
 
       # are we piped to another program or connected to an interactive shell (terminal)?
       if not sys.stdin.isatty():
-        #print("reading message from stdin");
-        reportMessage = sys.stdin.read();
+        # the message is read incrementally while it is stored
+        reportMessage = sys.stdin.buffer;
       else:
         print("ERROR: stdin is a terminal instead of piped to another program.", file=sys.stderr);
         exit(1);
     elif(args.message):
         reportMessage = args.message;
 
-    if(args.result == None):
-      print("ERROR: no result has been specified.", file=sys.stderr);
-      exit(1);
+    return reportMessage;
+
+  # Validates the fields of a report, as given on the command line or to the
+  # report server. Returns the schedule id, the timestamp, the ReportResult and
+  # the duration, or raises ValueError.
+  def parseReport(self, scheduleId, startingTimestamp, result, duration):
+    if(scheduleId == None):
+      raise ValueError("no schedule ID has been specified.");
+    try:
+      scheduleId = int(scheduleId);
+    except (TypeError, ValueError):
+      raise ValueError("Could not parse schedule ID '{s}'.".format(s=scheduleId));
+
+    if(result == None):
+      raise ValueError("no result has been specified.");
 
     # ['done', 'done-and-verified', 'done-but-verify-error', 'failed']
-    reportResult = None;
-    if args.result == 'done':
+    if result == 'done':
       reportResult = ReportResult.DONE;
-    elif args.result == 'done-and-verified':
+    elif result == 'done-and-verified':
       reportResult = ReportResult.DONE_AND_VERIFIED;
-    elif args.result == 'done-but-verify-error':
+    elif result == 'done-but-verify-error':
       reportResult = ReportResult.DONE_BUT_VERIFICATION_ERROR;
-    elif args.result == 'failed':
+    elif result == 'failed':
       reportResult = ReportResult.ERROR;
     else:
-      print("ERROR: unknown result value has been specified: " + args.result, file=sys.stderr);
-      exit(1);
+      raise ValueError("unknown result value has been specified: " + str(result));
+
+    if(startingTimestamp == None):
+      raise ValueError("no starting UNIX timestamp has been specified.");
 
-    if(args.starting_timestamp == None):
-      print("ERROR: no starting UNIX timestamp has been specified.", file=sys.stderr);
-      exit(1);
-    
     try:
-      datetimeReport = int(args.starting_timestamp);
-    except:
-      print("ERROR: Could not parse timestamp '{s}'. The format is a UNIX timestamp, the number of seconds since the Unix epoch.".format(d=args.DATETIME), file=sys.stderr);
-      exit(1);
-    
-    if(args.duration_in_seconds == None):
+      datetimeReport = int(startingTimestamp);
+    except (TypeError, ValueError):
+      raise ValueError("Could not parse timestamp '{s}'. The format is a UNIX timestamp, the number of seconds since the Unix epoch.".format(s=startingTimestamp));
+
+    if(duration == None):
       reportsDuration = 0;
     else:
       try:
-        reportsDuration = float(args.duration_in_seconds)
-        if(reportsDuration < 0):
-          print("ERROR: Duration must be zero or a positive float e.g. 0.0, 5 or 120", file=sys.stderr)
-          exit(1);
-      except ValueError:
-        print("ERROR: Duration must be zero or a positive float e.g. 0.0, 5 or 120", file=sys.stderr)
-        exit(1);
+        reportsDuration = float(duration);
+      except (TypeError, ValueError):
+        reportsDuration = -1;
+      if(reportsDuration < 0):
+        raise ValueError("Duration must be zero or a positive float e.g. 0.0, 5 or 120");
+
+    return scheduleId, datetimeReport, reportResult, reportsDuration;
+
+  # Inserts a validated report and sends the immediate error email if that is
+  # enabled. The message can be a string or a binary file that is read
+  # incrementally. Returns the id of the new report. Raises sqlite3.Error, and
+  # rolls back on any error.
+  def storeReport(self, scheduleId, datetimeReport, reportResult, reportsDuration, reportMessage):
+    c = self.conn.cursor();
 
-    if(self.scheduleExists(args.schedule_id) == True):
-      msg = None;
+    try:
+      self.beginWrite(c);
+      c.execute("""
+        INSERT INTO {tableName} (id, Schedule, date, Result, duration) 
+        VALUES (NULL, :scheduleid, :date, :result, :duration)
+        """.format(tableName=self.tableReports),
+        {
+          'scheduleid': scheduleId,
+          'date': datetimeReport,
+          'result': reportResult.value ,
+          'duration': reportsDuration
+        });
+      reportId = c.lastrowid;
       if(reportMessage != None):
-        if len(reportMessage) > 100:
-          msg = "<too big to list> (" + str(len(reportMessage)) + " chars total)";
-        else:
-          msg = "\"" + reportMessage + "\"";
-      print("""Adding report with the following details: 
-Schedule = {s}
-Datetime = {d}
-Result = {r}
-Duration = {dr} seconds
-Message = {msg}
-""".format(s=args.schedule_id, d=datetimeReport, r=self.formatReportResult(reportResult), dr=reportsDuration, msg=msg));
+        self.storeMessage(c, reportId, reportMessage, self.getMaxMessageSize());
+      self.updateDayStatus(c, scheduleId, datetimeReport);
+
+      # the email is only queued here, flushNotifications sends it
+      if(reportResult == ReportResult.ERROR or reportResult == ReportResult.DONE_BUT_VERIFICATION_ERROR):
+        self.loadSettings();
+        if(self.sendEmailImmediatelyOnErrorReport == True):
+          self.queueNotification(c, reportId, scheduleId);
+
+      self.conn.commit();
+    except BaseException:
+      # whatever failed, the connection must not stay in the write
+      # transaction; the report server keeps using it
+      self.conn.rollback();
+      raise;
+
+    return reportId;
+
+  # Appends the notification of an error report to the outbox, within the
+  # caller's write transaction.
+  def queueNotification(self, c, reportId, scheduleId):
+    c.execute("""
+      INSERT INTO {to} (Report, Schedule, DestinationHost, created)
+      SELECT :ri, :si, s.DestinationHost, :now FROM (SELECT 1) LEFT JOIN {st} s ON s.id = :si
+      """.format(to=self.tableOutbox, st=self.tableSchedules), {'ri': reportId, 'si': scheduleId, 'now': int(time.time())});
+
+  # Sends the pending notifications of the outbox, one email per destination
+  # host. The notifications of a host wait until the oldest of them is
+  # DigestWindow seconds old, so that the errors of many jobs that fail
+  # together end up in one digest. With sendAll everything pending is sent.
+  # The notifications to send are claimed in a write transaction first, so
+  # that concurrent flushes never send the same one. Returns the number of
+  # emails sent. A DeliveryError stops the flush and releases the unsent
+  # notifications, they stay in the outbox.
+  def flushNotifications(self, sendAll=False):
+    digestWindow = self.getIntSetting('Notifications', 'DigestWindow', self.defaultDigestWindow);
 
-      c = self.conn.cursor();
+    c = self.conn.cursor();
+    # the report server flushes often, mostly with nothing to send
+    if(c.execute('SELECT 1 FROM {to} LIMIT 1'.format(to=self.tableOutbox)).fetchone() == None):
+      return 0;
 
+    self.beginWrite(c);
+    try:
+      c.execute("""
+        SELECT o.id, o.Report, o.Schedule, o.DestinationHost, o.created, r.date, r.Result, s.Title
+        FROM {to} o LEFT JOIN {tn} r ON r.id = o.Report LEFT JOIN {st} s ON s.id = o.Schedule
+        WHERE o.claimed IS NULL OR o.claimed < :expired
+        ORDER BY o.DestinationHost, o.id
+        """.format(to=self.tableOutbox, tn=self.tableReports, st=self.tableSchedules), {'expired': int(time.time()) - self.notificationClaimTimeout});
+
+      # destination host -> pending notifications that are due
+      pending = {};
+      for row in c.fetchall():
+        pending.setdefault(row['DestinationHost'], []).append(row);
+      for destinationHost in list(pending.keys()):
+        if(sendAll == False and min(n['created'] for n in pending[destinationHost]) > time.time() - digestWindow):
+          del pending[destinationHost];
+
+      c.executemany('UPDATE {to} SET claimed = ? WHERE id = ?'.format(to=self.tableOutbox),
+                    [(int(time.time()), n['id']) for notifications in pending.values() for n in notifications]);
+      self.conn.commit();
+    except BaseException:
+      self.conn.rollback();
+      raise;
+
+    numberOfEmails = 0;
+    for destinationHost, notifications in list(pending.items()):
       try:
-        
-        c.execute("""
-          INSERT INTO {tableName} (id, Schedule, date, Result, duration, message) 
-          VALUES (NULL, :scheduleid, :date, :result, :duration, :message)
-          """.format(tableName=self.tableReports),
-          {
-            'scheduleid': args.schedule_id,
-            'date': datetimeReport,
-            'result': reportResult.value ,
-            'duration': reportsDuration,
-            'message': reportMessage
-          });
-
+        if(self.sendNotifications(destinationHost, notifications) == True):
+          numberOfEmails = numberOfEmails + 1;
+      except DeliveryError:
+        self.beginWrite(c);
+        c.executemany('UPDATE {to} SET claimed = NULL WHERE id = ?'.format(to=self.tableOutbox),
+                      [(n['id'],) for unsent in pending.values() for n in unsent]);
         self.conn.commit();
-        #print("report added");
-        if(reportResult == ReportResult.ERROR or reportResult == ReportResult.DONE_BUT_VERIFICATION_ERROR):
-          if(self.sendEmailImmediatelyOnErrorReport == True):
-            print("Sending email...");
-            rowSchedule = self.getSchedule(args.schedule_id);
-            scheduleTitle = "";
-            if(rowSchedule != None):
-              scheduleTitle = rowSchedule['title'];
-            if(reportResult == ReportResult.DONE_BUT_VERIFICATION_ERROR):
-              subject = "Backup verification error for {title}".format(title=scheduleTitle);
-            if(reportResult == ReportResult.ERROR):
-              subject = "Backup error for {title}".format(title=scheduleTitle);
-            message = reportMessage;
-            self.sendEmail(message, subject, []);
+        raise;
+
+      # the notifications of deleted reports are dropped as well
+      notificationIds = [(n['id'],) for n in notifications];
+      self.beginWrite(c);
+      c.executemany('DELETE FROM {to} WHERE id = ?'.format(to=self.tableOutbox), notificationIds);
+      self.conn.commit();
+      del pending[destinationHost];
+
+    return numberOfEmails;
+
+  # Sends the claimed notifications of a destination host as one email.
+  # Returns False if their reports have been deleted in the meantime and there
+  # is nothing to send.
+  def sendNotifications(self, destinationHost, notifications):
+    reports = [n for n in notifications if n['date'] != None];
+    if(len(reports) == 1):
+      report = reports[0];
+      if(report['Result'] == ReportResult.DONE_BUT_VERIFICATION_ERROR.value):
+        subject = "Backup verification error for {title}".format(title=report['Title'] or '');
+      else:
+        subject = "Backup error for {title}".format(title=report['Title'] or '');
+      self.sendEmail(self.readMessage(report['Report'], tail=self.emailMessageLines) or '', subject, []);
+    elif(len(reports) > 1):
+      subject = "Backup errors for {n} reports on {host}".format(n=len(reports), host=destinationHost or 'N/A');
+      self.sendEmail(self.formatDigest(reports), subject, []);
+    return len(reports) > 0;
+
+  def formatDigest(self, reports):
+    templateColumns = "{id:<6} {schedule:<25} {date:<20} {result:<30}";
+    lines = [templateColumns.format(id='ID', schedule='Schedule (id)', date='Date', result='Result')];
+    for report in reports:
+      lines.append(templateColumns.format(id=str(report['Report']), schedule=(report['Title'] or 'N/A') + ' (' + str(report['Schedule']) + ')',
+                      date=self.unixToDate(report['date']), result=ReportResult(report['Result']).name));
+
+    for report in reports:
+      lines.append('');
+      lines.append("--- Report {id}, last {n} lines of the message ---".format(id=report['Report'], n=self.digestMessageLines));
+      lines.append(self.readMessage(report['Report'], tail=self.digestMessageLines) or '');
+
+    return "\n".join(lines);
+
+  def flushNotificationsCommand(self, args):
+    try:
+      numberOfEmails = self.flushNotifications(args.all);
+    except sqlite3.Error as e:
+      self.conn.rollback();
+      print("ERROR: Failed to flush the notifications: " + e.args[0], file=sys.stderr);
+      exit(1);
+    except DeliveryError as e:
+      print("ERROR: " + str(e), file=sys.stderr);
+      exit(2);
+
+    print("Sent {n} emails".format(n=numberOfEmails));
+    self.closeMailer();
+    self.conn.close();
+
+  # Called by the report server between requests. Sends the pending
+  # notifications every FlushInterval seconds.
+  def serviceNotifications(self):
+    if(time.time() < self.nextNotificationFlush):
+      return;
+    self.nextNotificationFlush = time.time() + self.getIntSetting('Notifications', 'FlushInterval', self.defaultFlushInterval);
+    try:
+      self.flushNotifications();
+    except sqlite3.Error as e:
+      self.conn.rollback();
+      print("ERROR: Failed to flush the notifications: " + e.args[0], file=sys.stderr);
+    except DeliveryError as e:
+      # the notifications stay in the outbox and are tried again next time
+      print("ERROR: " + str(e), file=sys.stderr);
+
+  def getMaxMessageSize(self):
+    return self.getIntSetting('Messages', 'MaxMessageSize', self.defaultMaxMessageSize);
+
+  # Splits a report message, a string or a binary file that is read
+  # incrementally, into chunks of at most ChunkSize bytes. Stops after maxSize
+  # bytes, if given, and then adds a note about how much was left out.
+  def iterMessageChunks(self, reportMessage, maxSize):
+    chunkSize = self.getIntSetting('Messages', 'ChunkSize', self.defaultMessageChunkSize);
+    if(chunkSize < 1):
+      print("ERROR: The ChunkSize setting under the [Messages] section must be a positive integer", file=sys.stderr);
+      exit(3);
+
+    if(isinstance(reportMessage, str)):
+      reportMessage = reportMessage.encode('utf-8');
+    if(isinstance(reportMessage, bytes)):
+      reportMessage = io.BytesIO(reportMessage);
+
+    size = 0;
+    droppedSize = 0;
+    while True:
+      data = reportMessage.read(chunkSize);
+      if(not data):
+        break;
+      if(maxSize != None and size + len(data) > maxSize):
+        # keep reading, so that the writer does not fail on a closed pipe
+        droppedSize = droppedSize + size + len(data) - maxSize;
+        data = data[:maxSize - size];
+      if(data):
+        size = size + len(data);
+        yield data;
+
+    if(droppedSize > 0):
+      yield "\n[message truncated, {n} more bytes were left out]\n".format(n=droppedSize).encode('utf-8');
+
+  # Stores a report message compressed, in chunks, and adds the chunks to the
+  # search index. Returns its size in bytes.
+  def storeMessage(self, c, reportId, reportMessage, maxSize, index=True):
+    import zlib;
+
+    messageSize = 0;
+    def storeChunks():
+      nonlocal messageSize;
+      for chunkIndex, data in enumerate(self.iterMessageChunks(reportMessage, maxSize)):
+        c.execute('INSERT INTO {tm} (Report, chunk, size, data) VALUES (:ri, :ci, :size, :data)'.format(tm=self.tableMessages),
+                  {'ri': reportId, 'ci': chunkIndex, 'size': len(data), 'data': zlib.compress(data)});
+        messageSize = messageSize + len(data);
+        yield chunkIndex, data;
+
+    if(index == True and self.hasSearchIndex(c.connection)):
+      for chunkIndex, text in self.iterSearchRows(storeChunks()):
+        if(chunkIndex < self.searchChunkFactor):
+          c.execute('INSERT INTO {ts} (rowid, message) VALUES (:rowid, :message)'.format(ts=self.tableSearch),
+                    {'rowid': reportId * self.searchChunkFactor + chunkIndex, 'message': text});
+    else:
+      for chunk in storeChunks():
+        pass;
+
+    return messageSize;
+
+  # Yields (chunk index, text) of the search index rows of a message, from its
+  # chunks [(chunk index, bytes)] in order. The text of a chunk is decoded
+  # together with the bytes of a character split off the previous chunk, and
+  # its unfinished last line goes with the next chunk (see searchCarryChars).
+  # Storing and deleting a message give the same rows, as the FTS5 'delete'
+  # command needs.
+  def iterSearchRows(self, chunks):
+    import codecs;
+
+    decoder = codecs.getincrementaldecoder('utf-8')(errors='replace');
+    carry = '';
+    previous = None;
+    for chunkIndex, data in chunks:
+      if(previous != None):
+        yield previous;
+      text = carry + decoder.decode(data);
+      cut = text.rfind('\n') + 1;
+      if(len(text) - cut > self.searchCarryChars):
+        # a long line: only the unfinished last word goes with the next chunk
+        cut = len(text);
+        while(cut > 0 and text[cut - 1].isalnum()):
+          cut = cut - 1;
+        if(cut == 0):
+          cut = len(text);
+      previous = (chunkIndex, text[:cut]);
+      carry = text[cut:];
+    if(previous != None):
+      yield (previous[0], previous[1] + carry + decoder.decode(b'', True));
+
+  # Removes the messages of reports from the search index, before they are
+  # deleted. The index keeps no copy of the text, so the FTS5 'delete' command
+  # needs the indexed text of every row again.
+  def unindexMessages(self, c, reportIds):
+    import zlib;
+
+    if(not self.hasSearchIndex(c.connection)):
+      return;
 
-      except sqlite3.Error as e:
-        self.conn.rollback()
-        print("Failed to execute SQL statement for inserting a new report: " + e.args[0]);
+    def deletions():
+      for reportId in reportIds:
+        rows = c.connection.execute('SELECT chunk, data FROM {tm} WHERE Report = :ri ORDER BY chunk'.format(tm=self.tableMessages), {'ri': reportId});
+        for chunkIndex, text in self.iterSearchRows((chunkIndex, zlib.decompress(data)) for chunkIndex, data in rows):
+          if(chunkIndex < self.searchChunkFactor):
+            yield (reportId * self.searchChunkFactor + chunkIndex, text);
 
-      self.conn.close()
+    c.executemany("INSERT INTO {ts} ({ts}, rowid, message) VALUES ('delete', ?, ?)".format(ts=self.tableSearch), deletions());
+
+  # Reads a report message. With head or tail only the chunks needed for that
+  # many first or last lines are decompressed. Returns None if the report has
+  # no message.
+  def readMessage(self, reportId, head=None, tail=None):
+    import zlib;
+    c = self.conn.cursor();
+
+    order = 'DESC' if tail != None else 'ASC';
+    c.execute('SELECT data FROM {tm} WHERE Report = :ri ORDER BY chunk {o}'.format(tm=self.tableMessages, o=order), {'ri': reportId});
+
+    parts = [];
+    numberOfNewlines = 0;
+    for row in c:
+      data = zlib.decompress(row['data']);
+      parts.append(data);
+      numberOfNewlines = numberOfNewlines + data.count(b'\n');
+      if(head != None and numberOfNewlines >= head):
+        break;
+      if(tail != None and numberOfNewlines > tail):
+        break;
+
+    if(len(parts) == 0):
+      return None;
+
+    if(tail != None):
+      parts.reverse();
+    message = b''.join(parts);
+    if(head != None):
+      message = b''.join(message.splitlines(True)[:head]);
+    elif(tail != None):
+      message = b''.join(message.splitlines(True)[-tail:]);
+
+    return message.decode('utf-8', errors='replace');
+
+  # Adds reports from newline-delimited JSON, one report object per line with
+  # the same fields as the report server accepts. Valid reports are inserted
+  # in chunks, one transaction per chunk; invalid lines are reported and skipped.
+  def addReportsBatch(self, args):
+    if(args.chunk_size < 1):
+      print("ERROR: The chunk size must be a positive integer e.g. 1000", file=sys.stderr);
+      exit(1);
+
+    scheduleIds = self.repository.schedules().keys();
+
+    if(args.FILE == '-'):
+      batchFile = sys.stdin;
     else:
-      print('ERROR: Schedule with ID {s} does not exist'.format(s=args.schedule_id));
+      try:
+        batchFile = open(args.FILE, encoding='utf-8');
+      except OSError as e:
+        print("ERROR: Could not open '{f}': {e}".format(f=args.FILE, e=e.strerror), file=sys.stderr);
+        exit(1);
+
+    numberOfAdded = 0;
+    numberOfRejected = 0;
+    chunk = [];
+    with batchFile:
+      for lineNumber, line in enumerate(batchFile, 1):
+        if(line.strip() == ''):
+          continue;
+        try:
+          request = json.loads(line);
+          if(not isinstance(request, dict)):
+            raise ValueError("the report must be a JSON object");
+          scheduleId, datetimeReport, reportResult, reportsDuration = self.parseReport(request.get('schedule_id'), 
+                          request.get('starting_timestamp'), request.get('result'), request.get('duration_in_seconds'));
+          if(not scheduleId in scheduleIds):
+            raise ValueError('Schedule with ID {s} does not exist'.format(s=scheduleId));
+        except ValueError as e:
+          print("REJECTED line {n}: {e}".format(n=lineNumber, e=e), file=sys.stderr);
+          numberOfRejected = numberOfRejected + 1;
+          continue;
+
+        chunk.append({
+          'scheduleid': scheduleId,
+          'date': datetimeReport,
+          'result': reportResult.value,
+          'duration': reportsDuration,
+          'message': request.get('message')
+        });
+        if(len(chunk) >= args.chunk_size):
+          self.insertReports(chunk, numberOfAdded);
+          numberOfAdded = numberOfAdded + len(chunk);
+          chunk = [];
+
+    if(len(chunk) > 0):
+      self.insertReports(chunk, numberOfAdded);
+      numberOfAdded = numberOfAdded + len(chunk);
+
+    self.conn.close();
+    print("Added {a} reports, rejected {r} lines".format(a=numberOfAdded, r=numberOfRejected));
+    if(numberOfRejected > 0):
+      exit(1);
+
+  # Inserts a chunk of validated reports of add-batch in one transaction.
+  def insertReports(self, chunk, numberOfAdded):
+    c = self.conn.cursor();
+    maxSize = self.getMaxMessageSize();
+
+    try:
+      # the report ids are assigned here, so that the messages can refer to
+      # them while the reports are still inserted with one executemany
+      self.beginWrite(c);
+      c.execute("""
+        SELECT max(coalesce((SELECT seq FROM sqlite_sequence WHERE name = :tn), 0),
+                   coalesce((SELECT max(id) FROM {tableName}), 0))
+        """.format(tableName=self.tableReports), {'tn': self.tableReports});
+      nextReportId = c.fetchone()[0] + 1;
+      for report in chunk:
+        report['id'] = nextReportId;
+        nextReportId = nextReportId + 1;
+
+      c.executemany("""
+        INSERT INTO {tableName} (id, Schedule, date, Result, duration) 
+        VALUES (:id, :scheduleid, :date, :result, :duration)
+        """.format(tableName=self.tableReports), chunk);
+      for report in chunk:
+        if(report['message'] != None):
+          self.storeMessage(c, report['id'], str(report['message']), maxSize);
+      for scheduleId, dayStart in set((report['scheduleid'], self.dayBounds(report['date'])[0]) for report in chunk):
+        self.updateDayStatus(c, scheduleId, dayStart);
+      self.conn.commit();
+    except sqlite3.Error as e:
+      self.conn.rollback();
+      print("ERROR: Failed to insert a chunk of reports, {a} reports had been added before it: {e}".format(a=numberOfAdded, e=e.args[0]), file=sys.stderr);
+      exit(1);
+
+  # Sends the report of the add command to a running report server (see
+  # serve). Returns False if no server is listening, so that the caller can
+  # add the report directly instead. Exits if the server got the report but
+  # did not answer.
+  def forwardReport(self, args):
+    socketPath = args.socket or self.socket_file;
+    if(not os.path.exists(socketPath)):
+      return False;
+
+    import socket;
+
+    reportMessage = self.readReportMessage(args);
+    if(isinstance(reportMessage, io.IOBase)):
+      reportMessage = b''.join(self.iterMessageChunks(reportMessage, self.getMaxMessageSize())).decode('utf-8', errors='replace');
+    request = {
+      'schedule_id': args.schedule_id,
+      'starting_timestamp': args.starting_timestamp,
+      'result': args.result,
+      'duration_in_seconds': args.duration_in_seconds,
+      'message': reportMessage
+    };
+
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+      s.settimeout(self.forwardTimeout);
+      try:
+        s.connect(socketPath);
+      except OSError as e:
+        print("WARNING: Could not connect to the report server at {p}: {e}. Adding the report directly.".format(p=socketPath, e=e), file=sys.stderr);
+        # stdin has already been consumed, keep the message for addReport
+        args.stdin_message = False;
+        args.message = reportMessage;
+        return False;
+
+      # once the request is on its way the server may still add the report,
+      # e.g. after waiting for the write lock. Adding it directly as well
+      # could store it twice.
+      try:
+        s.sendall(json.dumps(request).encode('utf-8') + b'\n');
+        replyLine = s.makefile('rb').readline();
+        if(not replyLine):
+          raise OSError("the server closed the connection");
+        reply = json.loads(replyLine.decode('utf-8'));
+      except (OSError, ValueError) as e:
+        print("ERROR: The report was sent to the report server at {p}, but it did not confirm it: {e}. ".format(p=socketPath, e=e) +
+              "The server may still add it, check list-reports before adding it again.", file=sys.stderr);
+        exit(1);
+
+    if(reply.get('ok') != True):
+      print("ERROR: " + str(reply.get('error')), file=sys.stderr);
+      exit(1);
+
+    print("Report added with ID {id}".format(id=reply['id']));
+    return True;
+
+  # Runs the report server: accepts reports as JSON lines on a Unix socket and
+  # adds them through one long-lived database connection.
+  def serve(self, args):
+    import socket;
+    import socketserver;
+    import signal;
+
+    class ReportServer(socketserver.UnixStreamServer):
+      # many backup jobs may finish at the same time
+      request_queue_size = 128
+
+      # the queued error emails are sent by the server between requests
+      def service_actions(self):
+        self.monitor.serviceNotifications();
+
+    class ReportRequestHandler(socketserver.StreamRequestHandler):
+      timeout = self.requestTimeout
+
+      # one JSON report per line, answered with one JSON reply per line
+      def handle(self):
+        try:
+          for line in self.rfile:
+            try:
+              request = json.loads(line.decode('utf-8'));
+            except ValueError:
+              request = None;
+            if(isinstance(request, dict)):
+              reply = self.server.monitor.handleReportRequest(request);
+            else:
+              reply = {'ok': False, 'error': 'The request must be a JSON object'};
+            self.wfile.write(json.dumps(reply).encode('utf-8') + b'\n');
+        except TimeoutError:
+          print("WARNING: Closed a connection that sent no complete request for {t} seconds".format(t=self.timeout), file=sys.stderr);
+
+    # everything a report needs is loaded once, before the first report
+    self.loadSettings();
+    self.conn;
+
+    socketPath = args.socket or self.socket_file;
+    if(os.path.exists(socketPath)):
+      # refuse to take over the socket of a running server, remove a stale one
+      try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+          s.connect(socketPath);
+        print("ERROR: A report server is already listening on " + socketPath, file=sys.stderr);
+        exit(1);
+      except OSError:
+        os.unlink(socketPath);
+
+    server = ReportServer(socketPath, ReportRequestHandler);
+    server.monitor = self;
+    # remove the socket also when stopped by the service manager
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0));
+    print("Listening for reports on " + socketPath);
+    try:
+      server.serve_forever();
+    except KeyboardInterrupt:
+      pass;
+    finally:
+      server.server_close();
+      os.unlink(socketPath);
+      self.conn.close();
+
+  # Handles one report request of the report server. Returns the reply.
+  def handleReportRequest(self, request):
+    try:
+      scheduleId, datetimeReport, reportResult, reportsDuration = self.parseReport(request.get('schedule_id'), 
+                      request.get('starting_timestamp'), request.get('result'), request.get('duration_in_seconds'));
+      reportMessage = request.get('message');
+      if(reportMessage != None and not isinstance(reportMessage, str)):
+        raise ValueError("the message must be a string");
+      if(self.scheduleExists(scheduleId) == False):
+        raise ValueError('Schedule with ID {s} does not exist'.format(s=scheduleId));
+      reportId = self.storeReport(scheduleId, datetimeReport, reportResult, reportsDuration, reportMessage);
+    except ValueError as e:
+      return {'ok': False, 'error': str(e)};
+    except sqlite3.Error as e:
+      return {'ok': False, 'error': "Failed to execute SQL statement for inserting a new report: " + e.args[0]};
+
+    return {'ok': True, 'id': reportId};
 
   def deleteReport(self, args):
     c = self.conn.cursor();
 
-    c.execute('SELECT r.id, s.id, s.title FROM {tn} r inner join {st} s on s.id = r.schedule WHERE r.id = {ri}'.format(tn=self.tableReports, st=self.tableSchedules, ri=args.ID));
-    reportRow = c.fetchone();
+    report = self.repository.getReport(args.ID);
+    schedule = None;
+    if(report):
+      schedule = self.getSchedule(report.schedule);
 
-    if(reportRow):
+    if(schedule):
       print("Deleting Report with the following details ID = {id}, Schedule = {title}"
-                        .format(id=args.ID, title=reportRow['title']));
+                        .format(id=args.ID, title=schedule.title));
       
       answer = input("WARNING: The report will be deleted! Are you sure? [y/N]");
       if(answer == "y"):
         try:
-          c.execute("DELETE FROM {tn} WHERE id = {rid}".format(tn=self.tableReports, rid=args.ID));
+          self.beginWrite(c);
+          self.repository.deleteReport(c, args.ID);
+          self.updateDayStatus(c, report.schedule, report.date);
           self.conn.commit()
         except sqlite3.Error as e: 
           self.conn.rollback()
@@ -497,8 +2020,8 @@ Message = {msg}
     self.conn.close()
   
   def addSchedule(self, args):
-    print("Adding Schedule with the following details Title = {title}, Interval = {title}, Source Host = {sourceHost}, " +
-                        "Destination Host = {destinationHost}, Source Dir. = {sourceDir}, Destination Dir. = {destinationDir}, Type = {type}"
+    print(("Adding Schedule with the following details Title = {title}, Interval = {interval}, Source Host = {sourceHost}, " +
+                        "Destination Host = {destinationHost}, Source Dir. = {sourceDir}, Destination Dir. = {destinationDir}, Type = {type}")
                         .format(title=args.TITLE, interval=args.INTERVAL, sourceHost=args.SOURCE_HOST, 
                                 destinationHost=args.DESTINATION_HOST, sourceDir=args.SOURCE_DIR, 
                                 destinationDir=args.DESTINATION_DIR, type=args.TYPE));
@@ -507,8 +2030,9 @@ Message = {msg}
     c = self.conn.cursor();
 
     try:
-      c.execute("INSERT INTO {tn} (id, Title, Interval, SourceHost, DestinationHost, SourceDir, DestinationDir, Type) VALUES (NULL, \"{title}\", \"{interval}\", \"{sourceHost}\", \"{destinationHost}\", \"{sourceDir}\", \"{destinationDir}\", {type})".\
-      format(tn=self.tableSchedules, title=args.TITLE, interval=args.INTERVAL, sourceHost=args.SOURCE_HOST, destinationHost=args.DESTINATION_HOST, sourceDir=args.SOURCE_DIR, destinationDir=args.DESTINATION_DIR, type=args.TYPE));
+      self.beginWrite(c);
+      self.repository.addSchedule(c, Schedule(None, args.TITLE, args.INTERVAL, args.SOURCE_HOST, args.DESTINATION_HOST,
+                                              args.SOURCE_DIR, args.DESTINATION_DIR, args.TYPE));
       self.conn.commit()
     except sqlite3.Error as e: 
       self.conn.rollback()
@@ -519,19 +2043,13 @@ Message = {msg}
   def deleteSchedule(self, args):
     c = self.conn.cursor();
 
-    c.execute('SELECT * FROM {tn} WHERE id = {si}'.format(tn=self.tableSchedules, si=args.ID));
-    scheduleRow = c.fetchone();
-
-    if(scheduleRow):
-      reportRow = 'ID: ' + str(scheduleRow['id']) + "\n";
-      reportRow += 'Schedule: ' + str(scheduleRow['Title']) + "\n";
+    schedule = self.getSchedule(args.ID);
 
+    if(schedule):
       print("Deleting Schedule with the following details ID = {id}, Title = {title}"
-                        .format(id=args.ID, title=scheduleRow['title']));
+                        .format(id=args.ID, title=schedule.title));
 
-      c.execute('SELECT count(*) FROM {tn} WHERE Schedule = {si}'.format(tn=self.tableReports, si=args.ID));
-      row = c.fetchone();
-      numberOfReports = int(row[0]);
+      numberOfReports = self.repository.countReports(args.ID);
       deleteReports = False;
 
       if(numberOfReports > 0):
@@ -544,11 +2062,8 @@ Message = {msg}
             exit(1);
 
       try:
-        
-        if(deleteReports == True):
-          c.execute("DELETE FROM {tn} WHERE Schedule = {scheduleid}".format(tn=self.tableReports, scheduleid=args.ID));
-        
-        c.execute("DELETE FROM {tn} WHERE id = {id}".format(tn=self.tableSchedules, id=args.ID));
+        self.beginWrite(c);
+        self.repository.deleteSchedule(c, args.ID, deleteReports);
         self.conn.commit()
       except sqlite3.Error as e: 
         self.conn.rollback()
@@ -561,6 +2076,200 @@ Message = {msg}
 
     self.conn.close()
 
+  # The format of a schedule file: --format, or else its extension.
+  def scheduleFileFormat(self, args):
+    if(args.format != None):
+      return args.format;
+    extension = os.path.splitext(args.FILE)[1].lower();
+    if(extension in ['.csv', '.ndjson']):
+      return extension[1:];
+    return 'json';
+
+  def exportSchedules(self, args):
+    fileFormat = self.scheduleFileFormat(args);
+    out = sys.stdout;
+    if(args.FILE != '-'):
+      # written next to it first, so that a failed export keeps the old file
+      try:
+        out = open(args.FILE + '.tmp', 'w', encoding='utf-8', newline='');
+      except OSError as e:
+        print("ERROR: Could not open '{f}': {e}".format(f=args.FILE, e=e.strerror), file=sys.stderr);
+        exit(1);
+
+    writer = RowWriter(fileFormat, self.scheduleFields, out);
+    for schedule in self.getAllSchedules():
+      writer.write({'id': schedule.id, 'title': schedule.title, 'interval': schedule.interval,
+                    'source_host': schedule.sourceHost, 'destination_host': schedule.destinationHost,
+                    'source_dir': schedule.sourceDir, 'destination_dir': schedule.destinationDir, 'type': schedule.type});
+    writer.close();
+
+    if(out != sys.stdout):
+      out.close();
+      os.replace(args.FILE + '.tmp', args.FILE);
+      print("Exported {n} schedules to {f}".format(n=writer.numberOfRows, f=args.FILE));
+    self.conn.close();
+
+  # Reads the schedules of a file of export-schedules. Returns [Schedule]
+  # whose id is None where the file has none. Raises ValueError with all
+  # invalid rows.
+  def readScheduleFile(self, fileName, fileFormat):
+    import csv;
+
+    if(fileName == '-'):
+      scheduleFile = sys.stdin;
+    else:
+      try:
+        scheduleFile = open(fileName, encoding='utf-8', newline='');
+      except OSError as e:
+        raise ValueError("Could not open '{f}': {e}".format(f=fileName, e=e.strerror));
+
+    with scheduleFile:
+      try:
+        if(fileFormat == 'csv'):
+          rows = list(csv.DictReader(scheduleFile));
+        elif(fileFormat == 'ndjson'):
+          rows = [json.loads(line) for line in scheduleFile if line.strip() != ''];
+        else:
+          rows = json.load(scheduleFile);
+          if(not isinstance(rows, list)):
+            raise ValueError("the file must contain a JSON array of schedules");
+      except (ValueError, csv.Error) as e:
+        raise ValueError("Could not read '{f}': {e}".format(f=fileName, e=e));
+
+    schedules = [];
+    errors = [];
+    for number, row in enumerate(rows, 1):
+      try:
+        schedules.append(self.parseScheduleRow(row));
+      except ValueError as e:
+        errors.append("schedule {n}: {e}".format(n=number, e=e));
+    if(len(errors) > 0):
+      raise ValueError("\n".join(errors));
+    return schedules;
+
+  def parseScheduleRow(self, row):
+    from croniter import croniter;
+
+    if(not isinstance(row, dict)):
+      raise ValueError("the schedule must be an object");
+
+    values = [];
+    for field in ['title', 'interval', 'source_host', 'destination_host', 'source_dir', 'destination_dir']:
+      value = row.get(field);
+      if(value == None or str(value).strip() == ''):
+        raise ValueError("{f} is missing".format(f=field));
+      values.append(str(value));
+    if(not croniter.is_valid(values[1])):
+      raise ValueError("'{i}' is not a valid cron interval".format(i=values[1]));
+
+    try:
+      scheduleType = int(row.get('type'));
+    except (TypeError, ValueError):
+      raise ValueError("type must be an integer");
+
+    scheduleId = row.get('id');
+    if(scheduleId == ''):
+      scheduleId = None;
+    if(scheduleId != None):
+      try:
+        scheduleId = int(scheduleId);
+      except (TypeError, ValueError):
+        raise ValueError("id must be an integer");
+
+    return Schedule(scheduleId, *values, scheduleType);
+
+  # Compares the schedules of a file with the current ones. A schedule of the
+  # file is the current one with its id, or with its title if it has no id.
+  # Returns the schedules to insert, the ones to update, the ids of the
+  # current schedules missing from the file and the number of unchanged ones.
+  def diffSchedules(self, schedules):
+    current = self.repository.schedules();
+    idsByTitle = {};
+    for schedule in current.values():
+      idsByTitle.setdefault(schedule.title, []).append(schedule.id);
+
+    inserts = [];
+    updates = [];
+    numberOfUnchanged = 0;
+    matchedIds = set();
+    fileTitles = set();
+    for schedule in schedules:
+      if(schedule.id != None):
+        if(schedule.id in matchedIds):
+          raise ValueError("Schedule {s} is in the file more than once".format(s=schedule.id));
+        existing = current.get(schedule.id);
+      else:
+        if(schedule.title in fileTitles):
+          raise ValueError("The title '{t}' is in the file more than once without an id".format(t=schedule.title));
+        fileTitles.add(schedule.title);
+        titleIds = idsByTitle.get(schedule.title, []);
+        if(len(titleIds) > 1):
+          raise ValueError("The title '{t}' matches the schedules {s}. Give the id of the schedule.".format(t=schedule.title, s=", ".join(str(i) for i in titleIds)));
+        existing = None;
+        if(len(titleIds) == 1 and not titleIds[0] in matchedIds):
+          existing = current[titleIds[0]];
+          schedule.id = existing.id;
+
+      if(existing == None):
+        inserts.append(schedule);
+        continue;
+      matchedIds.add(existing.id);
+      if(all(getattr(schedule, field) == getattr(existing, field) for field in Schedule.__slots__)):
+        numberOfUnchanged = numberOfUnchanged + 1;
+      else:
+        updates.append(schedule);
+
+    missingIds = [scheduleId for scheduleId in current if not scheduleId in matchedIds];
+    return inserts, updates, missingIds, numberOfUnchanged;
+
+  # Makes the schedules match a file of export-schedules: the diff is computed
+  # and applied in one write transaction, with one statement per kind of
+  # change. Schedules missing from the file are only deleted with --delete.
+  def importSchedules(self, args):
+    try:
+      schedules = self.readScheduleFile(args.FILE, self.scheduleFileFormat(args));
+    except ValueError as e:
+      print("ERROR: " + str(e), file=sys.stderr);
+      exit(1);
+
+    c = self.conn.cursor();
+    try:
+      if(args.dry_run == False):
+        self.beginWrite(c);
+      inserts, updates, missingIds, numberOfUnchanged = self.diffSchedules(schedules);
+      current = self.repository.schedules();
+      deleteIds = [];
+      if(args.delete == True):
+        deleteIds = missingIds;
+
+      if(args.dry_run == True):
+        for schedule in inserts:
+          print("add: {t}".format(t=schedule.title));
+        for schedule in updates:
+          print("update: {t} (ID: {s})".format(t=schedule.title, s=schedule.id));
+        for scheduleId in deleteIds:
+          print("delete: {t} (ID: {s}) and its reports".format(t=current[scheduleId].title, s=scheduleId));
+      else:
+        self.repository.applyScheduleChanges(c, inserts, updates, deleteIds);
+        self.conn.commit();
+    except ValueError as e:
+      self.conn.rollback();
+      print("ERROR: " + str(e), file=sys.stderr);
+      exit(1);
+    except sqlite3.Error as e:
+      self.conn.rollback();
+      print("ERROR: Failed to import the schedules: " + e.args[0], file=sys.stderr);
+      exit(1);
+
+    if(args.dry_run == True):
+      summary = "Would add {a}, update {u} and delete {d} schedules, {k} unchanged";
+    else:
+      summary = "Added {a}, updated {u} and deleted {d} schedules, {k} unchanged";
+    print(summary.format(a=len(inserts), u=len(updates), d=len(deleteIds), k=numberOfUnchanged));
+    if(len(missingIds) > 0 and args.delete == False):
+      print("{n} schedules are not in the file and were kept. Use --delete to delete them.".format(n=len(missingIds)));
+    self.conn.close();
+
   def formatReportResult(self, reportResult):
     formmatedResult = '';
     if(ReportResult(reportResult) == ReportResult.DONE):
@@ -598,34 +2307,21 @@ Message = {msg}
     return timestamp; 
 
   def scheduleExists(self, scheduleId):
-    c = self.conn.cursor();
+    return self.repository.getSchedule(scheduleId) != None;
 
-    queryString = 'SELECT id FROM {tn} WHERE id = {si}'.format(tn=self.tableSchedules, si=scheduleId);
-    c.execute(queryString);
-    if c.fetchone() != None:
-      return True;
-    else:
-      return False;
-      
+  # Returns the Schedule, or None if there is no schedule with that id.
   def getSchedule(self, scheduleId):
-    c = self.conn.cursor();
-
-    queryString = 'SELECT * FROM {tn} WHERE id = {si}'.format(tn=self.tableSchedules, si=scheduleId);
-    c.execute(queryString);
-    #print("queryString={qs}, scheduleid={si}, rowcount={rc}".format(qs=queryString, si=scheduleId, rc=c.rowcount));
-    resultRow = c.fetchone();
-    if resultRow != None:
-      #print("true");
-      return resultRow;
-    else:
-      #print("false");
-      return False;
+    return self.repository.getSchedule(scheduleId);
   
   def checkReports(self, args):
     doEmailReport = False;
     
     if(args.email):
       doEmailReport = True;
+
+    if(args.date_from or args.date_to):
+      self.checkReportsRange(args, doEmailReport);
+      return;
       
     if(args.date):
       try:
@@ -633,7 +2329,7 @@ Message = {msg}
       except:
         print("ERROR: Could not parse date '{d}'. The format is YYYY-mm-dd (e.g. 2015-03-16)".format(d=args.date), file=sys.stderr);
         exit(1);
-      self.checkReportsByDate(dateForChecking, doEmailReport);
+      self.checkReportsByDate(dateForChecking, doEmailReport, args.format, args.sites);
     else:
       if(args.days):
         try:
@@ -655,20 +2351,66 @@ Message = {msg}
         
       # get current date and substract 1
       dateForChecking = dateForChecking - datetime.timedelta(days=1);
-      self.checkReportsByDate(dateForChecking, doEmailReport);
+      self.checkReportsByDate(dateForChecking, doEmailReport, args.format, args.sites);
   
-  def notify(self, message, notifyType, dateForChecking):
+  def notify(self, message, notifyType, dateForChecking, lastDate=None):
     headers = [];
+    dateText = dateForChecking.strftime("%Y-%m-%d");
+    if(lastDate != None):
+      dateText += " to " + lastDate.strftime("%Y-%m-%d");
     if(notifyType == self.NOTIFY_OK):
-      subject = 'NekBackupMonitor Report ' + dateForChecking.strftime("%Y-%m-%d");
+      subject = 'NekBackupMonitor Report ' + dateText;
     elif(notifyType == self.NOTIFY_ERROR):
-      subject = 'ERROR!!! NekBackupMonitor Report ' + dateForChecking.strftime("%Y-%m-%d");
+      subject = 'ERROR!!! NekBackupMonitor Report ' + dateText;
     
     print("Sending email...");
-    self.sendEmail(message, subject, headers);
+    try:
+      self.sendEmail(message, subject, headers);
+    except DeliveryError as e:
+      print("ERROR: " + str(e), file=sys.stderr);
+      exit(2);
+    self.closeMailer();
     
+  # Returns the email delivery backend of the [Email] Delivery setting. It is
+  # kept for the following emails, so that SMTP reuses its connection.
+  def getMailer(self):
+    if(self.mailer != None):
+      return self.mailer;
+
+    config = self.readConfig();
+    delivery = config.get('Email', 'Delivery', fallback=self.defaultDelivery);
+    if(delivery == 'sendmail'):
+      self.mailer = SendmailDelivery();
+    elif(delivery == 'smtp'):
+      security = config.get('Email', 'SmtpSecurity', fallback=self.defaultSmtpSecurity);
+      if(not security in ['none', 'starttls', 'ssl']):
+        print("ERROR: The SmtpSecurity setting under the [Email] section must be one of none, starttls or ssl", file=sys.stderr);
+        exit(3);
+      self.mailer = SmtpDelivery(config.get('Email', 'SmtpHost', fallback=self.defaultSmtpHost),
+                      self.getIntSetting('Email', 'SmtpPort', 0), security,
+                      config.get('Email', 'SmtpUser', fallback=''), config.get('Email', 'SmtpPassword', fallback=''),
+                      self.getIntSetting('Email', 'SmtpTimeout', self.defaultSmtpTimeout),
+                      self.getIntSetting('Email', 'SmtpRetries', self.defaultSmtpRetries));
+    else:
+      print("ERROR: The Delivery setting under the [Email] section must be sendmail or smtp", file=sys.stderr);
+      exit(3);
+
+    return self.mailer;
+
+  def closeMailer(self):
+    if(self.mailer != None):
+      self.mailer.close();
+      self.mailer = None;
+
+  # Sends an email with the configured delivery backend. Raises DeliveryError
+  # if it could not be sent.
   def sendEmail(self, message, subject, headers):
-    
+    from email.mime.text import MIMEText;
+    from email.mime.multipart import MIMEMultipart;
+
+    self.loadSettings();
+    mailer = self.getMailer();
+
     msg = MIMEMultipart('alternative')
     msg['Subject'] = subject;
     msg['From'] = self.fromEmail;
@@ -702,163 +2444,1586 @@ Message = {msg}
     msg.attach(part1)
     msg.attach(part2)
 
-
-    # Send the message via our own SMTP server, but don't include the
-    # envelope header.
-    p = Popen(["sendmail", "-t", "-oi"], stdin=PIPE, universal_newlines=True)
-    p.communicate(msg.as_string())
+    mailer.send(msg);
   
-  def checkReportsByDate(self, dateForChecking, doEmailReport):
-    reportText = '';
-    reportTableText = '';
-    
-    schedulesDone = []
+  # Returns the start and end timestamps of the local day of a timestamp.
+  def dayBounds(self, timestamp):
+    d1 = datetime.datetime.fromtimestamp(timestamp).replace(hour=0, minute=0, second=0, microsecond=0);
+    return int(self.totimestamp(d1)), int(self.totimestamp(d1 + datetime.timedelta(days=1)));
+
+  # Recomputes the schedule_day_status row of a schedule and day from its
+  # reports, within the caller's write transaction. Reads only that day of
+  # the schedule from the covering reports index.
+  def updateDayStatus(self, c, scheduleId, timestamp):
+    dayStart, dayEnd = self.dayBounds(timestamp);
+    c.execute('DELETE FROM {td} WHERE Schedule = :si AND day = :day'.format(td=self.tableDayStatus), {'si': scheduleId, 'day': dayStart});
+    c.execute("""
+      INSERT INTO {td} (Schedule, day, attempts, successes, errors, verification, totalDuration, lastDuration)
+      SELECT :si, :day, count(*), sum(Result IN (1, 2, 3)), sum(Result = 0),
+        coalesce((SELECT Result FROM {tn} WHERE Schedule = :si AND date >= :day AND date < :dayEnd AND Result IN (2, 3) ORDER BY date DESC LIMIT 1), 0),
+        total(duration),
+        (SELECT duration FROM {tn} WHERE Schedule = :si AND date >= :day AND date < :dayEnd ORDER BY date DESC LIMIT 1)
+      FROM {tn} WHERE Schedule = :si AND date >= :day AND date < :dayEnd
+      HAVING count(*) > 0
+      """.format(td=self.tableDayStatus, tn=self.tableReports), {'si': scheduleId, 'day': dayStart, 'dayEnd': dayEnd});
+
+  # Recomputes the whole schedule_day_status table from the reports in one
+  # ordered pass. Used by migration 5 and by rebuild-status.
+  def rebuildDayStatus(self, conn):
+    c = conn.cursor();
+    # the days before the oldest report left may have been pruned, their status
+    # can't be rebuilt and is kept
+    c.execute("SELECT CAST(strftime('%s', date(min(date), 'unixepoch', 'localtime'), 'utc') AS INTEGER) FROM {tn}".format(tn=self.tableReports));
+    firstDay = c.fetchone()[0];
+    if(firstDay == None):
+      return 0;
+    conn.execute('DELETE FROM {td} WHERE day >= :day'.format(td=self.tableDayStatus), {'day': firstDay});
+
+    # 'utc' turns the local midnight of the report's day back into a timestamp
+    c.execute("""
+      SELECT Schedule, CAST(strftime('%s', date(date, 'unixepoch', 'localtime'), 'utc') AS INTEGER) AS day, Result, duration
+      FROM {tn} ORDER BY Schedule, date
+      """.format(tn=self.tableReports));
+
+    numberOfRows = 0;
+    dayStatuses = [];
+    dayStatus = None;
+    for scheduleId, day, result, duration in c:
+      if(dayStatus == None or dayStatus['si'] != scheduleId or dayStatus['day'] != day):
+        dayStatus = {'si': scheduleId, 'day': day, 'attempts': 0, 'successes': 0, 'errors': 0, 'verification': 0, 'totalDuration': 0, 'lastDuration': None};
+        dayStatuses.append(dayStatus);
+      self.addToDayStatus(dayStatus, result, duration);
+      if(len(dayStatuses) >= 10000):
+        numberOfRows = numberOfRows + self.insertDayStatuses(conn, dayStatuses[:-1]);
+        dayStatuses = dayStatuses[-1:];
+    numberOfRows = numberOfRows + self.insertDayStatuses(conn, dayStatuses);
+
+    return numberOfRows;
+
+  def insertDayStatuses(self, conn, dayStatuses):
+    conn.executemany("""
+      INSERT INTO {td} (Schedule, day, attempts, successes, errors, verification, totalDuration, lastDuration)
+      VALUES (:si, :day, :attempts, :successes, :errors, :verification, :totalDuration, :lastDuration)
+      """.format(td=self.tableDayStatus), dayStatuses);
+    return len(dayStatuses);
+
+  # Adds one report, in date order, to a day status.
+  def addToDayStatus(self, dayStatus, result, duration):
+    dayStatus['attempts'] = dayStatus['attempts'] + 1;
+    if(result == ReportResult.ERROR.value):
+      dayStatus['errors'] = dayStatus['errors'] + 1;
+    elif(result in [ReportResult.DONE.value, ReportResult.DONE_AND_VERIFIED.value, ReportResult.DONE_BUT_VERIFICATION_ERROR.value]):
+      dayStatus['successes'] = dayStatus['successes'] + 1;
+    # the last verification result of the day counts
+    if(result in [ReportResult.DONE_AND_VERIFIED.value, ReportResult.DONE_BUT_VERIFICATION_ERROR.value]):
+      dayStatus['verification'] = result;
+    dayStatus['totalDuration'] = dayStatus['totalDuration'] + (duration or 0);
+    dayStatus['lastDuration'] = duration;
+
+  def rebuildStatus(self, args):
+    print("Rebuilding the daily status of all schedules from their reports. The status of pruned days is kept.");
+    c = self.conn.cursor();
+    try:
+      self.beginWrite(c);
+      numberOfRows = self.rebuildDayStatus(self.conn);
+      self.conn.commit();
+    except sqlite3.Error as e:
+      self.conn.rollback();
+      print("ERROR: Failed to rebuild the daily status: " + e.args[0], file=sys.stderr);
+      exit(1);
+
+    print("Rebuilt {n} schedule days".format(n=numberOfRows));
+    self.conn.close();
+
+  # Loads the status of the schedules that have reports on the day from the
+  # schedule_day_status rollup. Returns schedule id -> status.
+  def loadDayStatus(self, d1Timestamp):
+    c = self.conn.cursor();
+
+    c.execute("""
+      SELECT Schedule, attempts, successes, errors, verification, lastDuration
+      FROM {td} WHERE day = :day
+      """.format(td=self.tableDayStatus), {'day': int(d1Timestamp)});
+
+    return dict((row['Schedule'], row) for row in c);
+
+  # Loads the reports of the day window [d1Timestamp, d2Timestamp) of the
+  # schedules in needReports, bucketed by schedule id and ordered by date.
+  def loadDayReports(self, d1Timestamp, d2Timestamp, needReports):
+    reportsBySchedule = dict((scheduleId, []) for scheduleId in needReports);
+    if(len(needReports) == 0):
+      return reportsBySchedule;
+
+    # the schedules are looked up in the (Schedule, date, ...) index, so that
+    # the reports of the other schedules aren't read at all
+    c = self.conn.cursor();
+    c.execute("""
+      SELECT Schedule, date, Result, duration FROM {tn}
+      WHERE Schedule IN (SELECT value FROM json_each(:si)) AND date >= :d1 AND date < :d2
+      ORDER BY Schedule, date
+      """.format(tn=self.tableReports), {'si': json.dumps(list(needReports)), 'd1': d1Timestamp, 'd2': d2Timestamp});
+    for row in c:
+      reportsBySchedule[row['Schedule']].append(row);
+
+    return reportsBySchedule;
+
+  # Summarizes reports, in date order, the same way as schedule_day_status.
+  def summarizeReports(self, scheduleReports):
+    dayStatus = {'attempts': 0, 'successes': 0, 'errors': 0, 'verification': 0, 'totalDuration': 0, 'lastDuration': None};
+    for report in scheduleReports:
+      self.addToDayStatus(dayStatus, report['Result'], report['duration']);
+    return dayStatus;
+
+  # Classifies a day status of a schedule, from the rollup or from
+  # summarizeReports. Returns the result text, the verified text, the duration
+  # of the last report and whether the schedule counts as successful.
+  def classifyDayStatus(self, dayStatus):
+    if(not dayStatus['attempts']):
+      return "MISSING", "NO", 0, False;
+
+    isDone = dayStatus['successes'] > 0;
+    hadError = dayStatus['errors'] > 0;
+
+    isOK = True;
+    if(isDone == True and hadError == True):
+      resultText = "OK (with retries)";
+    elif(isDone == True):
+      resultText = "OK";
+    elif(hadError == True):
+      isOK = False;
+      resultText = "ERROR";
+    else:
+      isOK = False;
+      resultText = "Tried with ERROR";
+
+    if(dayStatus['verification'] == ReportResult.DONE_AND_VERIFIED.value):
+      verifiedText = "VERIFIED";
+    elif(dayStatus['verification'] == ReportResult.DONE_BUT_VERIFICATION_ERROR.value):
+      verifiedText = "VERIFICATION ERROR";
+    else:
+      verifiedText = "NO";
+
+    return resultText, verifiedText, dayStatus['lastDuration'] or 0, isOK;
+
+  # Returns the timestamps of all runs of a cron interval in the day
+  # [d1, d2Timestamp). The expansion is cached per (interval, day), as many
+  # schedules share an interval.
+  def expectedRuns(self, interval, d1, d2Timestamp):
+    d1Timestamp = self.totimestamp(d1);
+    runs = self.expectedRunsCache.get((interval, d1Timestamp));
+    if(runs == None):
+      from croniter import croniter;
+
+      # start just before midnight, so that a run at 00:00 belongs to the day
+      itr = croniter(interval, d1 - datetime.timedelta(seconds=1));
+      runs = [];
+      nextRun = itr.get_next();
+      while(nextRun < d2Timestamp):
+        runs.append(nextRun);
+        nextRun = itr.get_next();
+      runs = tuple(runs);
+      self.expectedRunsCache[(interval, d1Timestamp)] = runs;
+
+    return runs;
+
+  # Expands a cron interval once for the consecutive days from dayStarts[0]
+  # to dayEnds[-1], instead of once per day, and returns the runs of each day.
+  # They are added to the cache of expectedRuns.
+  def expectedRunsOfDays(self, interval, dayStarts, dayEnds):
+    import bisect;
+
+    runsByDay = [self.expectedRunsCache.get((interval, dayStart)) for dayStart in dayStarts];
+    if(not None in runsByDay):
+      return runsByDay;
+
+    from croniter import croniter;
+
+    itr = croniter(interval, datetime.datetime.fromtimestamp(dayStarts[0] - 1));
+    runs = [];
+    nextRun = itr.get_next();
+    while(nextRun < dayEnds[-1]):
+      runs.append(nextRun);
+      nextRun = itr.get_next();
+
+    runsByDay = [];
+    for dayStart, dayEnd in zip(dayStarts, dayEnds):
+      dayRuns = tuple(runs[bisect.bisect_left(runs, dayStart):bisect.bisect_left(runs, dayEnd)]);
+      self.expectedRunsCache[(interval, dayStart)] = dayRuns;
+      runsByDay.append(dayRuns);
+    return runsByDay;
+
+  # Assigns the reports of a schedule, sorted by date, to its expected runs of
+  # the day with a sorted merge. The window of a run starts earlyTolerance
+  # seconds before it and ends earlyTolerance seconds before the next run. The
+  # window of the first run starts at the beginning of the day, the window of
+  # the last run ends at the end of it.
+  def matchReportsToRuns(self, runs, scheduleReports, earlyTolerance):
+    reportsByRun = [[] for run in runs];
+    runIndex = 0;
+    for report in scheduleReports:
+      while(runIndex + 1 < len(runs) and report['date'] >= runs[runIndex + 1] - earlyTolerance):
+        runIndex = runIndex + 1;
+      reportsByRun[runIndex].append(report);
+
+    return reportsByRun;
+
+  # Evaluates one schedule for the day from its status of loadDayStatus. Every
+  # expected run gets its own verdict; the schedule is OK if all of them are.
+  # Schedules with more than one run need their reports of the day. Returns a
+  # dict with the texts of the check table and the times of the failed runs.
+  def evaluateSchedule(self, dayStatus, runs, scheduleReports, earlyTolerance):
+    status = {
+      'runs': runs,
+      'failedRuns': [],
+      'isOK': True
+    };
+
+    if(len(runs) == 0):
+      status['scheduledFor'] = None;
+      status['result'] = "Not scheduled";
+      status['verified'] = "N/A";
+      status['duration'] = 0;
+      return status;
+
+    status['scheduledFor'] = runs[0];
+    status['result'], status['verified'], status['duration'], status['isOK'] = self.classifyDayStatus(dayStatus);
+    if(len(runs) == 1):
+      if(status['isOK'] == False):
+        status['failedRuns'].append((runs[0], status['result']));
+      return status;
+
+    numberOfMissing = 0;
+    # without reports of the day all runs are missing
+    if(not dayStatus['attempts']):
+      scheduleReports = [];
+    elif(len(scheduleReports) == 0):
+      # prune archived the reports of the day, only the rollup is left. Its
+      # verdict holds for the day, the runs cannot be told apart any more
+      return status;
+    for run, runReports in zip(runs, self.matchReportsToRuns(runs, scheduleReports, earlyTolerance)):
+      if(len(runReports) == 0):
+        runResult, runIsOK = "MISSING", False;
+      else:
+        runResult, runVerified, runDuration, runIsOK = self.classifyDayStatus(self.summarizeReports(runReports));
+      if(runIsOK == False):
+        status['failedRuns'].append((run, runResult));
+        if(len(runReports) == 0):
+          numberOfMissing = numberOfMissing + 1;
+
+    if(len(status['failedRuns']) > 0):
+      status['isOK'] = False;
+      if(numberOfMissing > 0):
+        status['result'] = "MISSING {m}/{n} runs".format(m=numberOfMissing, n=len(runs));
+      else:
+        status['result'] = "ERROR {e}/{n} runs".format(e=len(status['failedRuns']), n=len(runs));
+
+    return status;
+
+  # Evaluates all schedules for the day of d1 and yields (schedule, status)
+  # for each of them.
+  def evaluateDay(self, d1):
+    d2Timestamp = self.totimestamp(d1 + datetime.timedelta(days=1));
+    d1Timestamp = self.totimestamp(d1);
+    earlyTolerance = self.getIntSetting('Check', 'EarlyTolerance', self.defaultEarlyTolerance);
+
     allSchedules = self.getAllSchedules();
-    
-    reportTableText += "Backup report for date {d}\n\n".format(d=dateForChecking.strftime("%Y-%m-%d"));
-    d1 = dateForChecking.replace(hour=0, minute=0, second=0, microsecond=0);
-    d2 = d1 + datetime.timedelta(days=1);
+    dayStatus = self.loadDayStatus(d1Timestamp);
+    runsBySchedule = dict((schedule.id, self.expectedRuns(schedule.interval, d1, d2Timestamp)) for schedule in allSchedules);
+    reportsBySchedule = self.loadDayReports(d1Timestamp, d2Timestamp, 
+                          [scheduleId for scheduleId, runs in runsBySchedule.items() if len(runs) > 1]);
+
+    noStatus = {'attempts': 0};
+    for schedule in allSchedules:
+      status = self.evaluateSchedule(dayStatus.get(schedule.id, noStatus), runsBySchedule[schedule.id], reportsBySchedule.get(schedule.id), earlyTolerance);
+      if(status['scheduledFor'] == None):
+        # show when the schedule runs next
+        from croniter import croniter;
+        status['scheduledFor'] = croniter(schedule.interval, d1).get_next();
+      yield schedule, status;
+
+  # The unusual durations of the day of d1, compared to the days before it.
+  def dayAnomalies(self, d1):
     d1Timestamp = self.totimestamp(d1);
-    d2Timestamp = self.totimestamp(d2);
-    #print("d1 = {d1}, d2 = {d2}".format(d1=d1, d2=d2));
-    #exit(0);
+    return self.findDurationAnomalies(self.getBaselineStart(d1Timestamp), d1Timestamp, d1Timestamp, self.totimestamp(d1 + datetime.timedelta(days=1)));
+
+  # Returns the start of the baseline of the anomalies of the window that
+  # starts at d1Timestamp: the BaselineDays days before the window, so that
+  # the runs that are compared are not part of their own baseline.
+  def getBaselineStart(self, d1Timestamp):
+    baselineDays = self.getIntSetting('Stats', 'BaselineDays', self.defaultAnomalyBaselineDays);
+    if(baselineDays < 1):
+      print("ERROR: The BaselineDays setting under the [Stats] section must be a positive integer", file=sys.stderr);
+      exit(3);
+    return d1Timestamp - baselineDays * 86400;
+
+  # Returns [(site name, database file)] of the [Sites] section.
+  def readSites(self):
+    config = self.readConfig();
+    if(not 'Sites' in config or len(config['Sites']) == 0):
+      print("ERROR: The settings file does not list any site under the [Sites] section", file=sys.stderr);
+      exit(3);
+    return [(siteName, os.path.join(self.currentPath, sqliteFile)) for siteName, sqliteFile in config['Sites'].items()];
+
+  # Evaluates the day of d1 on the database of another site, with its own
+  # NekBackupMonitor and read-only connection. Runs in a worker process of
+  # evaluateSites.
+  # Returns (site name, [(schedule, status)], anomalies, error).
+  def evaluateSite(self, siteName, sqliteFile, d1, needAnomalies):
+    site = NekBackupMonitor();
+    site.sqlite_file = sqliteFile;
+    site.config = self.readConfig();
+    if(self.profiler != None):
+      site.startProfiling(self.profiler);
+    try:
+      if(not os.path.exists(sqliteFile)):
+        raise ValueError("{f} does not exist".format(f=sqliteFile));
+      site._conn = site.connectReadOnly();
+      evaluations = list(site.evaluateDay(d1));
+      anomalies = [];
+      if(needAnomalies == True):
+        # rows can't be sent back from the worker process
+        anomalies = [dict(anomaly) for anomaly in site.dayAnomalies(d1)];
+      return siteName, evaluations, anomalies, None;
+    except (sqlite3.Error, ValueError) as e:
+      return siteName, [], [], str(e);
+    except SystemExit:
+      # the reason was printed by the failed call
+      return siteName, [], [], "the database could not be opened";
+    finally:
+      if(site._conn != None):
+        site._conn.close();
+
+  # Evaluates the day of d1 on all sites in parallel, in a pool of processes
+  # like the range check, as the evaluation is mostly Python. The check takes
+  # about as long as the slowest site when there are enough CPUs. Returns the
+  # results of evaluateSite, in the order of the [Sites] section.
+  def evaluateSites(self, d1, needAnomalies):
+    from concurrent.futures import ProcessPoolExecutor;
+
+    sites = self.readSites();
+    results = [];
+    with ProcessPoolExecutor(max_workers=min(len(sites), os.cpu_count() or 1)) as executor:
+      futures = [executor.submit(evaluateSiteInWorker, self.settings_file, siteName, sqliteFile, d1, needAnomalies, self.profiler != None)
+                 for siteName, sqliteFile in sites];
+      for future in futures:
+        result, profile = future.result();
+        if(profile != None):
+          self.profiler.merge(*profile);
+        results.append(result);
+    return results;
+
+  def checkReportsByDate(self, dateForChecking, doEmailReport, outputFormat='text', federated=False):
+    d1 = dateForChecking.replace(hour=0, minute=0, second=0, microsecond=0);
+    needAnomalies = outputFormat == 'text' or doEmailReport == True;
 
-    c = self.conn.cursor();
+    # (site name, [(schedule, status)], anomalies, error) of each site. The
+    # schedules of the local database are evaluated lazily, as they are written.
+    if(federated == True):
+      siteResults = self.evaluateSites(d1, needAnomalies);
+    else:
+      siteResults = [(None, self.evaluateDay(d1), None, None)];
 
-    # 1) Contents of all columns for row that match a certain value in 1 column
-    queryString = 'SELECT * FROM {tn} WHERE date BETWEEN {d1} AND {d2}'.format(tn=self.tableReports, d1=d1Timestamp, d2=d2Timestamp);
-    #print(queryString);
-    c.execute(queryString);
-    all_rows = c.fetchall();
-    for row in all_rows:
-      rowSchedule = self.getSchedule(row['Schedule']);
-      #print(rowSchedule);
-      if(rowSchedule != None):
-        schedulesDone.append(row);
     allOK = True;
+    # the table and the failed runs are built once and then rendered as text
+    # and, for the email, as HTML. The --format output is written per schedule.
+    rows = [];
+    failedRuns = [];
+    anomalies = [];
+    failedSites = [];
+    writer = None;
+    if(outputFormat != 'text'):
+      if(federated == True):
+        writer = RowWriter(outputFormat, ['site'] + self.checkFields);
+      else:
+        writer = RowWriter(outputFormat, self.checkFields);
 
-    templateColumns = "{id:4.4} {sourcehost:14.14} {desthost:14.14} {title:18.18} {scheduledfor:14.14} {result:18.18} {verified:20.20} {duration:9.9}\n";
-    reportTableText += templateColumns.format(id="SID", sourcehost="Source", 
-    									desthost="Dest.", title="Title",
-                      scheduledfor="Sched.Time", 
-                      result="Result", verified="Verified",
-                      duration="Duration");
-    #reportTableText += "ID    Title              Result                Verified" + "\n";
-    for schedule in allSchedules:
-      isTried = False;
-      isDone = False;
-      isVerified = False;
-      hadError = False;
-      hasVerificationErrors = False;
-      scheduleDuration = 0;
-
-      base = d1;
-      itr = croniter(schedule['interval'], base);
-      scheduleNextIeration = itr.get_next();
-      reportTableText += "{id:4.4} {sourcehost:14.14} {desthost:14.14} {title:18.18} {scheduledfor:14.14} ".format(id=str(schedule['id']), 
-                         sourcehost=schedule['sourcehost'], desthost=schedule['destinationhost'],
-                         title=str(schedule['title']), 
-                         scheduledfor=datetime.datetime.fromtimestamp(scheduleNextIeration).strftime('%H:%M:%S'));
-
-      resultText = '';
-      verifiedText = '';
-      # check if it is scheduled for the date of checking
-      if(scheduleNextIeration >= d1Timestamp and scheduleNextIeration <= d2Timestamp):
-        #print("Scheduled date is between the checking date");
-        for scheduleDone in schedulesDone:
-          if(schedule['id'] == scheduleDone['Schedule']):
-            isTried = True;
-            scheduleDuration = scheduleDone['duration'];
-            #print("result = {s}".format(s=scheduleDone['result']));
-            if(scheduleDone['result'] == 1):
-              isDone = True;
-            if(scheduleDone['result'] == 2):
-              isDone = True;
-              isVerified = True;
-            if(scheduleDone['result'] == 3):
-              isDone = True;
-              isVerified = False;
-              hasVerificationErrors = True;
-            elif(scheduleDone['result'] == 0):
-              hadError = True;
-        
-        #print("isTried = {t}, isDone = {d}, hadError = {e}".format(t=isTried,d=isDone,e=hadError));
-        
-        if(isTried == True):
-          if(isDone == True and hadError == True):
-            resultText += "OK (with retries)";
-            reportText += "Schedule {n} with id {i} is done But had error tries".format(n=schedule['title'], i=schedule['id']) + "\n";
-          elif(isDone == True and hadError == False):
-            resultText += "OK";
-            reportText += "Schedule {n} with id {i} is done".format(n=schedule['title'], i=schedule['id']) + "\n";
-          elif(hadError == True):
-            allOK = False;
-            resultText += "ERROR";
-            reportText += "Schedule {n} with id {i} had Error(s)".format(n=schedule['title'], i=schedule['id']) + "\n";
-          else:
-            allOK = False;
-            resultText += "Tried with ERROR";
-            reportText += "Schedule {n} with id {i} had been Tried but not done and no Error(s)".format(n=schedule['title'], i=schedule['id']) + "\n";
-          
-          if(isVerified == True):
-            verifiedText += "VERIFIED";
-            reportText += "Schedule {n} with id {i} is verified".format(n=schedule['title'], i=schedule['id']) + "\n";
-          else:
-            if(hasVerificationErrors == True):
-              verifiedText += "VERIFICATION ERROR";
-              reportText += "Schedule {n} with id {i} has verification errors.".format(n=schedule['title'], i=schedule['id']) + "\n";
-            else:
-              verifiedText += "NO";
-              reportText += "Schedule {n} with id {i} is not verified".format(n=schedule['title'], i=schedule['id']) + "\n";
-        else:
+    for siteName, evaluations, siteAnomalies, error in siteResults:
+      if(error != None):
+        allOK = False;
+        failedSites.append((siteName, error));
+        continue;
+
+      for schedule, status in evaluations:
+        if(status['isOK'] == False):
           allOK = False;
-          resultText += "MISSING";
-          verifiedText += "NO";
-          reportText += "Schedule {n} with id {i} wasn't tried at all".format(n=schedule['title'], i=schedule['id']) + "\n";
-      else:
-        resultText += "Not scheduled";
-        verifiedText += "N/A";
-        #reportText += "Schedule {n} with id {i} wasn't tried at all".format(n=schedule['title'], i=schedule['id']) + "\n";
-        reportText += "Schedule {n} was not scheduled for the date".format(n=schedule['title']);
-      
-      reportTableText += "{result:18.18} {verified:20.20} {duration:9.9}\n".format(result=resultText, verified=verifiedText, duration=self.secondsToTime(scheduleDuration));
+
+        scheduledFor = datetime.datetime.fromtimestamp(status['scheduledFor']).strftime('%H:%M:%S');
+        if(len(status['runs']) > 1):
+          scheduledFor += " (x{n})".format(n=len(status['runs']));
+
+        if(writer != None):
+          checkRow = {'schedule_id': schedule.id, 'title': schedule.title, 'source_host': schedule.sourceHost,
+                      'destination_host': schedule.destinationHost, 'interval': schedule.interval,
+                      'scheduled_for': int(status['scheduledFor']), 'runs': len(status['runs']),
+                      'result': status['result'], 'verified': status['verified'], 'duration_in_seconds': status['duration'],
+                      'ok': status['isOK'],
+                      'failed_runs': [datetime.datetime.fromtimestamp(run).strftime('%H:%M') + " " + runResult for run, runResult in status['failedRuns']]};
+          if(federated == True):
+            checkRow['site'] = siteName;
+          writer.write(checkRow);
+          if(doEmailReport == False):
+            continue;
+
+        rows.append({'site': siteName, 'id': schedule.id, 'sourcehost': schedule.sourceHost, 'desthost': schedule.destinationHost,
+                     'title': schedule.title, 'scheduledfor': scheduledFor,
+                     'result': status['result'], 'verified': status['verified'],
+                     'duration': self.secondsToTime(status['duration'])});
+
+        if(len(status['runs']) > 1 and len(status['failedRuns']) > 0):
+          failedRuns.append((siteName, schedule, status['failedRuns']));
+
+      if(needAnomalies == True):
+        if(siteAnomalies == None):
+          siteAnomalies = self.dayAnomalies(d1);
+        anomalies.extend((siteName, anomaly) for anomaly in siteAnomalies);
+
     if(allOK == True):
       notifyType = self.NOTIFY_OK;
-    elif(allOK == False):
+    else:
       notifyType = self.NOTIFY_ERROR;
-    reportTableText += "\n\nReport created on {s}".format(s=datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"));
-    
-    print(self.formatForTextDisplay(reportTableText));
-    
-    
-    #print(reportText);
+    createdOn = datetime.datetime.now();
+
+    if(writer != None):
+      writer.close();
+      for siteName, error in failedSites:
+        print("ERROR: Could not check site {s}: {e}".format(s=siteName, e=error), file=sys.stderr);
+    else:
+      print(self.renderCheckReport(dateForChecking, rows, failedRuns, anomalies, failedSites, createdOn, federated));
+
     if(doEmailReport == True):
-      self.notify(self.formatForHTMLDisplay(reportTableText), notifyType, dateForChecking);
-    
-  def formatForTextDisplay(self, stringText):
-    stringTextFormatted = stringText.replace('OK', bcolors.OKGREEN + "OK" + bcolors.ENDC);
-    stringTextFormatted = stringTextFormatted.replace('OK AND VERIFIED', bcolors.OKGREEN + "OK AND VERIFIED" + bcolors.ENDC);
-    stringTextFormatted = stringTextFormatted.replace('(with retries)', bcolors.WARNING + "(with retries)" + bcolors.ENDC);
-    stringTextFormatted = stringTextFormatted.replace('(unverified)', bcolors.WARNING + "(unverified)" + bcolors.ENDC);
-    stringTextFormatted = stringTextFormatted.replace('NO', bcolors.WARNING + "NO" + bcolors.ENDC);
-    stringTextFormatted = stringTextFormatted.replace('VERIFICATION ERROR', bcolors.FAIL + "VERIFICATION ERROR" + bcolors.ENDC);
-    stringTextFormatted = stringTextFormatted.replace('ERROR', bcolors.FAIL + "ERROR" + bcolors.ENDC);
-    stringTextFormatted = stringTextFormatted.replace('Missing', bcolors.FAIL + "Missing" + bcolors.ENDC);
-    stringTextFormatted = stringTextFormatted.replace('VERIFIED', bcolors.OKGREEN + "VERIFIED" + bcolors.ENDC);
-    return stringTextFormatted;
-  
-  def formatForHTMLDisplay(self, stringText):
-    stringHTMLFormatted = stringText.replace('OK', "<span style='color: green;'>" + "OK" + "</span>");
-    stringHTMLFormatted = stringHTMLFormatted.replace('OK AND VERIFIED', "<span style='color: green;'>" + "OK AND VERIFIED" + "</span>");
-    stringHTMLFormatted = stringHTMLFormatted.replace('(with retries)', "<span style='color: darkorange;'>" + "(with retries)" + "</span>");
-    stringHTMLFormatted = stringHTMLFormatted.replace('(unverified)', "<span style='color: darkorange;'>" + "(unverified)" + "</span>");
-    stringHTMLFormatted = stringHTMLFormatted.replace('NO', "<span style='color: darkorange;'>" + "NO" + "</span>");
-    stringHTMLFormatted = stringHTMLFormatted.replace('VERIFICATION ERROR', "<span style='color: red;'>" + "VERIFICATION ERROR" + "</span>");
-    stringHTMLFormatted = stringHTMLFormatted.replace('ERROR', "<span style='color: red;'>" + "ERROR" + "</span>");
-    stringHTMLFormatted = stringHTMLFormatted.replace('Missing', "<span style='color: red;'>" + "Missing" + "</span>");
-    stringHTMLFormatted = stringHTMLFormatted.replace('VERIFIED', "<span style='color: green;'>" + "VERIFIED" + "</span>");
-    
-    return stringHTMLFormatted;
+      self.notify(self.renderCheckReport(dateForChecking, rows, failedRuns, anomalies, failedSites, createdOn, federated, html=True), notifyType, dateForChecking);
+
+  # Watches the schedules until stopped and emails an alert as soon as a run
+  # has no report by its deadline, its scheduled time plus the grace period.
+  # The deadlines are kept in a heap and the watcher sleeps until the earliest
+  # one, or until it looks for new, changed and deleted schedules every
+  # PollInterval seconds.
+  def watch(self, args):
+    import heapq;
+    import signal;
+
+    grace = args.grace;
+    if(grace == None):
+      grace = self.getIntSetting('Watch', 'Grace', self.defaultWatchGrace);
+    pollInterval = self.getIntSetting('Watch', 'PollInterval', self.defaultWatchPollInterval);
+    earlyTolerance = self.getIntSetting('Check', 'EarlyTolerance', self.defaultEarlyTolerance);
+    if(grace < 0 or pollInterval < 1):
+      print("ERROR: The grace period can not be negative and the PollInterval setting must be at least 1", file=sys.stderr);
+      exit(1);
+    # fail now rather than at the first alert
+    self.loadSettings();
+
+    # (deadline, schedule id, generation, run) of the next run of every
+    # schedule, and schedule id -> [interval, croniter, generation]. A heap
+    # entry of an older generation is left over from before the schedule
+    # changed, and is dropped when it comes up.
+    heap = [];
+    watchRuns = {};
+    schedules = self.watchSchedules(heap, watchRuns, None, grace);
+    nextPoll = time.time() + pollInterval;
+
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0));
+    print("Watching {n} schedules".format(n=len(watchRuns)));
+    try:
+      while(True):
+        now = time.time();
+        # cheap unless the schedules changed, see Repository.schedules
+        schedules = self.watchSchedules(heap, watchRuns, schedules, grace);
+        if(now >= nextPoll):
+          nextPoll = now + pollInterval;
+
+        overdue = [];
+        while(len(heap) > 0 and heap[0][0] <= now):
+          deadline, scheduleId, generation, run = heapq.heappop(heap);
+          if(not scheduleId in watchRuns or watchRuns[scheduleId][2] != generation):
+            continue;
+          schedule = self.getSchedule(scheduleId);
+          if(schedule == None):
+            # the schedule was deleted
+            del watchRuns[scheduleId];
+            continue;
+          if(self.hasReport(scheduleId, run - earlyTolerance, now) == False):
+            overdue.append((schedule, run));
+          self.pushNextRun(heap, watchRuns, scheduleId, grace);
+
+        if(len(overdue) > 0):
+          self.alertOverdue(overdue, now);
+
+        wakeUp = nextPoll;
+        if(len(heap) > 0):
+          wakeUp = min(wakeUp, heap[0][0]);
+        time.sleep(max(wakeUp - time.time(), 0));
+    except KeyboardInterrupt:
+      pass;
+    finally:
+      self.closeMailer();
+      self.conn.close();
+
+  # Brings the watch up to date with the schedules, when the schedule cache
+  # has reloaded them since lastSchedules because another process changed
+  # them. A new schedule, or one whose interval changed, starts over with the
+  # first of its runs whose deadline hasn't passed; a deleted one is dropped.
+  # Returns the schedules.
+  def watchSchedules(self, heap, watchRuns, lastSchedules, grace):
+    from croniter import croniter;
+
+    schedules = self.repository.schedules();
+    if(schedules is lastSchedules):
+      return schedules;
+
+    for scheduleId in list(watchRuns.keys()):
+      if(not scheduleId in schedules):
+        del watchRuns[scheduleId];
+
+    start = datetime.datetime.now() - datetime.timedelta(seconds=grace);
+    for schedule in schedules.values():
+      watched = watchRuns.get(schedule.id);
+      if(watched != None and watched[0] == schedule.interval):
+        continue;
+      generation = watched[2] + 1 if watched != None else 0;
+      try:
+        watchRuns[schedule.id] = [schedule.interval, croniter(schedule.interval, start), generation];
+      except ValueError:
+        # kept without a croniter, so that the error is printed once
+        print("ERROR: Schedule {s} has the invalid interval '{i}'. It is not watched.".format(s=schedule.id, i=schedule.interval), file=sys.stderr);
+        watchRuns[schedule.id] = [schedule.interval, None, generation];
+        continue;
+      self.pushNextRun(heap, watchRuns, schedule.id, grace);
+    return schedules;
+
+  # Pushes the next run of a schedule onto the watch heap. The cron times are
+  # local times.
+  def pushNextRun(self, heap, watchRuns, scheduleId, grace):
+    import heapq;
+
+    interval, cron, generation = watchRuns[scheduleId];
+    run = self.totimestamp(cron.get_next(datetime.datetime));
+    heapq.heappush(heap, (run + grace, scheduleId, generation, run));
+
+  # Whether the schedule has a report, of any result, dated in [d1, d2).
+  def hasReport(self, scheduleId, d1Timestamp, d2Timestamp):
+    c = self.conn.cursor();
+    c.execute("SELECT 1 FROM {tn} WHERE Schedule = :si AND date >= :d1 AND date < :d2 LIMIT 1".format(tn=self.tableReports),
+              {'si': scheduleId, 'd1': d1Timestamp, 'd2': d2Timestamp});
+    return c.fetchone() != None;
+
+  # Emails one alert for the overdue runs, [(schedule, run)], found together.
+  # A failed email is reported and the watch goes on.
+  def alertOverdue(self, overdue, now):
+    columns = [('id', 4, '<', False), ('sourcehost', 14, '<', False), ('desthost', 14, '<', False), ('title', 18, '<', False),
+               ('scheduledfor', 19, '<', False), ('result', 18, '<', True)];
+
+    lines = ["Overdue backups on {d}".format(d=datetime.datetime.fromtimestamp(now).strftime("%Y-%m-%d %H:%M:%S")), ""];
+    lines.append(self.renderRow(columns, {'id': "SID", 'sourcehost': "Source", 'desthost': "Dest.", 'title': "Title",
+                                          'scheduledfor': "Sched.Time", 'result': "Result"}, True));
+    for schedule, run in overdue:
+      scheduledFor = datetime.datetime.fromtimestamp(run).strftime("%Y-%m-%d %H:%M:%S");
+      print("{d} Schedule {s} ({t}) is overdue: no report for its run at {r}".format(
+              d=datetime.datetime.fromtimestamp(now).strftime("%Y-%m-%d %H:%M:%S"), s=schedule.id, t=schedule.title, r=scheduledFor));
+      lines.append(self.renderRow(columns, {'id': schedule.id, 'sourcehost': schedule.sourceHost, 'desthost': schedule.destinationHost,
+                                            'title': schedule.title, 'scheduledfor': scheduledFor, 'result': "MISSING"}, True));
+
+    if(len(overdue) == 1):
+      subject = "OVERDUE!!! NekBackupMonitor {t} (SID {s})".format(t=overdue[0][0].title, s=overdue[0][0].id);
+    else:
+      subject = "OVERDUE!!! NekBackupMonitor {n} backups".format(n=len(overdue));
+    try:
+      self.sendEmail("\n".join(lines), subject, []);
+    except DeliveryError as e:
+      print("ERROR: " + str(e), file=sys.stderr);
+    self.closeMailer();
+
+  def checkReportsRange(self, args, doEmailReport):
+    if(args.date or args.days or args.sites):
+      print("ERROR: --from and --to can not be combined with -d, -b or --sites", file=sys.stderr);
+      exit(1);
+    if(not args.date_from):
+      print("ERROR: --to needs --from", file=sys.stderr);
+      exit(1);
+
+    dates = [];
+    for date in [args.date_from, args.date_to]:
+      if(date == None):
+        # dafault: up to yesterday
+        dates.append(datetime.datetime.now().replace(hour=0, minute=0, second=0, microsecond=0) - datetime.timedelta(days=1));
+        continue;
+      try:
+        dates.append(datetime.datetime.strptime(date, "%Y-%m-%d"));
+      except ValueError:
+        print("ERROR: Could not parse date '{d}'. The format is YYYY-mm-dd (e.g. 2015-03-16)".format(d=date), file=sys.stderr);
+        exit(1);
+
+    firstDate, lastDate = dates;
+    if(firstDate > lastDate or (lastDate - firstDate).days >= 40000):
+      print("ERROR: --from must be a date before --to, at most 40000 days earlier", file=sys.stderr);
+      exit(1);
+
+    jobs = args.jobs or os.cpu_count() or 1;
+    if(jobs < 1):
+      print("ERROR: Number of jobs must be a positive integer e.g. 4", file=sys.stderr);
+      exit(1);
+
+    self.checkReportsByRange(firstDate, lastDate, doEmailReport, args.format, jobs);
+
+  # Evaluates all schedules on each of the given days, with the status of the
+  # days from the rollup. schedules is [(id, interval)], dayStatus is day
+  # timestamp -> schedule id -> status. The reports of the schedules that run
+  # more than once a day are loaded for all days together. Returns, per day,
+  # [(result, verified, isOK)] in the order of schedules.
+  def evaluateDays(self, schedules, days, dayStatus, earlyTolerance):
+    import bisect;
+
+    dayStarts = [self.totimestamp(day) for day in days];
+    dayEnds = [self.totimestamp(day + datetime.timedelta(days=1)) for day in days];
+    # interval -> runs of each day. Many schedules share an interval.
+    runsByInterval = dict((interval, self.expectedRunsOfDays(interval, dayStarts, dayEnds)) for interval in set(interval for scheduleId, interval in schedules));
+    needReports = set(scheduleId for scheduleId, interval in schedules if any(len(runs) > 1 for runs in runsByInterval[interval]));
+    reportsBySchedule = self.loadDayReports(dayStarts[0], dayEnds[-1], needReports);
+    reportDates = dict((scheduleId, [report['date'] for report in scheduleReports]) for scheduleId, scheduleReports in reportsBySchedule.items());
+
+    noStatus = {'attempts': 0};
+    results = [];
+    for dayIndex, (d1Timestamp, dayEnd) in enumerate(zip(dayStarts, dayEnds)):
+      statusBySchedule = dayStatus.get(int(d1Timestamp), {});
+      dayResults = [];
+      for scheduleId, interval in schedules:
+        runs = runsByInterval[interval][dayIndex];
+        scheduleReports = None;
+        if(len(runs) > 1):
+          dates = reportDates[scheduleId];
+          scheduleReports = reportsBySchedule[scheduleId][bisect.bisect_left(dates, d1Timestamp):bisect.bisect_left(dates, dayEnd)];
+        status = self.evaluateSchedule(statusBySchedule.get(scheduleId, noStatus), runs, scheduleReports, earlyTolerance);
+        dayResults.append((status['result'], status['verified'], status['isOK']));
+      results.append(dayResults);
+
+    return results;
+
+  # Checks every day from firstDate to lastDate. The daily status of the whole
+  # range is loaded in one query, then the days are evaluated in blocks of
+  # consecutive days by a pool of jobs processes, each with its own connection
+  # for the reports of the schedules that run more than once a day. The result
+  # is a schedule x day matrix.
+  def checkReportsByRange(self, firstDate, lastDate, doEmailReport, outputFormat='text', jobs=1):
+    firstDate = firstDate.replace(hour=0, minute=0, second=0, microsecond=0);
+    lastDate = lastDate.replace(hour=0, minute=0, second=0, microsecond=0);
+    days = [firstDate + datetime.timedelta(days=i) for i in range((lastDate - firstDate).days + 1)];
+    earlyTolerance = self.getIntSetting('Check', 'EarlyTolerance', self.defaultEarlyTolerance);
+
+    allSchedules = list(self.getAllSchedules());
+    schedules = [(schedule.id, schedule.interval) for schedule in allSchedules];
+
+    dayStatus = {};
+    c = self.conn.cursor();
+    c.execute("""
+      SELECT Schedule, day, attempts, successes, errors, verification, lastDuration FROM {td}
+      WHERE day >= :d1 AND day < :d2
+      """.format(td=self.tableDayStatus), {'d1': int(self.totimestamp(firstDate)), 'd2': int(self.totimestamp(lastDate + datetime.timedelta(days=1)))});
+    for row in c:
+      dayStatus.setdefault(row['day'], {})[row['Schedule']] = dict(row);
+
+    numberOfBlocks = min(jobs, -(-len(days) // self.minDaysPerJob));
+    if(len(schedules) == 0):
+      results = [[] for day in days];
+    elif(numberOfBlocks <= 1):
+      results = self.evaluateDays(schedules, days, dayStatus, earlyTolerance);
+    else:
+      from concurrent.futures import ProcessPoolExecutor;
+
+      blockSize = -(-len(days) // numberOfBlocks);
+      blocks = [days[i:i + blockSize] for i in range(0, len(days), blockSize)];
+      results = [];
+      with ProcessPoolExecutor(max_workers=len(blocks)) as executor:
+        futures = [executor.submit(evaluateDaysInWorker, self.sqlite_file, schedules, block,
+                     dict((day, dayStatus[day]) for day in (int(self.totimestamp(d)) for d in block) if day in dayStatus), earlyTolerance)
+                   for block in blocks];
+        for future in futures:
+          results.extend(future.result());
+
+    # the cell of a day: its result, and the verification error of an OK day
+    matrix = [];
+    allOK = True;
+    for scheduleIndex, schedule in enumerate(allSchedules):
+      cells = [];
+      for dayResults in results:
+        result, verified, isOK = dayResults[scheduleIndex];
+        if(isOK == False):
+          allOK = False;
+        if(verified == "VERIFICATION ERROR" and isOK == True):
+          result = verified;
+        cells.append((result, isOK));
+      matrix.append((schedule, cells));
+
+    if(outputFormat != 'text'):
+      dayFields = [day.strftime("%Y-%m-%d") for day in days];
+      writer = RowWriter(outputFormat, ['schedule_id', 'title'] + dayFields);
+      for schedule, cells in matrix:
+        matrixRow = {'schedule_id': schedule.id, 'title': schedule.title};
+        matrixRow.update(zip(dayFields, (result for result, isOK in cells)));
+        writer.write(matrixRow);
+      writer.close();
+    else:
+      print(self.renderRangeReport(days, matrix, datetime.datetime.now()));
+
+    if(doEmailReport == True):
+      if(allOK == True):
+        notifyType = self.NOTIFY_OK;
+      else:
+        notifyType = self.NOTIFY_ERROR;
+      self.notify(self.renderRangeReport(days, matrix, datetime.datetime.now(), html=True), notifyType, firstDate, lastDate);
+
+  # Renders the schedule x day matrix of a range check, one character per day
+  # in the style of its result, with the days grouped by month.
+  def renderRangeReport(self, days, matrix, createdOn, html=False):
+    columns = [('id', 4, '<', False), ('title', 18, '<', False)];
+
+    # a space before the first day of every month but the first
+    monthStarts = set(i for i, day in enumerate(days) if i > 0 and day.day == 1);
+    monthHeader = "";
+    dayHeader = "";
+    for i, day in enumerate(days):
+      if(i in monthStarts):
+        monthHeader += " ";
+        dayHeader += " ";
+      if(i == 0 or i in monthStarts):
+        monthLength = next((j for j in range(i + 1, len(days)) if j in monthStarts), len(days)) - i;
+        monthLabel = day.strftime("%Y-%m");
+        if(len(monthLabel) > monthLength):
+          monthLabel = day.strftime("%m")[:monthLength];
+        monthHeader += monthLabel.ljust(monthLength);
+      dayHeader += str(day.day % 10);
+
+    lines = ["Backup report from {d1} to {d2}".format(d1=days[0].strftime("%Y-%m-%d"), d2=days[-1].strftime("%Y-%m-%d")), ""];
+    lines.append(self.renderRow(columns, {'id': "", 'title': ""}, html) + " " + monthHeader);
+    lines.append(self.renderRow(columns, {'id': "SID", 'title': "Title"}, html) + " " + dayHeader + "  OK/Days");
+    for schedule, cells in matrix:
+      # (result, cell) of each day and of the month separators
+      symbols = [];
+      numberOfOK = 0;
+      numberOfScheduled = 0;
+      for i, (result, isOK) in enumerate(cells):
+        if(i in monthStarts):
+          symbols.append((None, " "));
+        symbols.append((result, self.matrixSymbols.get(result) or self.matrixSymbols.get(result.split(' ', 1)[0], '?')));
+        if(result != "Not scheduled"):
+          numberOfScheduled = numberOfScheduled + 1;
+          if(isOK == True):
+            numberOfOK = numberOfOK + 1;
+      # days in a row with the same result are styled together
+      line = "";
+      for result, group in itertools.groupby(symbols, key=lambda symbol: symbol[0]):
+        cell = "".join(symbol for result, symbol in group);
+        if(result == None):
+          line += cell;
+        else:
+          line += self.renderStatus(result, cell, html);
+      lines.append(self.renderRow(columns, {'id': schedule.id, 'title': schedule.title}, html) + " " + line +
+                   "  {ok}/{n}".format(ok=numberOfOK, n=numberOfScheduled));
+
+    lines.append("");
+    lines.append(self.renderText(", ".join("{s} {r}".format(s=symbol, r=result) for result, symbol in self.matrixSymbols.items()), html));
+    lines.append("");
+    lines.append("Report created on {s}".format(s=createdOn.strftime("%Y-%m-%d %H:%M:%S")));
+    return "\n".join(lines);
+
+  def renderCheckReport(self, dateForChecking, rows, failedRuns, anomalies, failedSites, createdOn, federated=False, html=False):
+    columns = [('id', 4, '<', False), ('sourcehost', 14, '<', False), ('desthost', 14, '<', False), ('title', 18, '<', False),
+               ('scheduledfor', 14, '<', False), ('result', 18, '<', True), ('verified', 20, '<', True), ('duration', 9, '<', False)];
+
+    # the sites have their own schedules, prefixed by the site name
+    sitePrefix = lambda siteName: '';
+    if(federated == True):
+      columns.insert(0, ('site', 12, '<', False));
+      sitePrefix = lambda siteName: "[" + siteName + "] ";
+
+    lines = ["Backup report for date {d}".format(d=dateForChecking.strftime("%Y-%m-%d")), ""];
+    lines.append(self.renderRow(columns, {'site': "Site", 'id': "SID", 'sourcehost': "Source", 'desthost': "Dest.", 'title': "Title",
+                      'scheduledfor': "Sched.Time", 'result': "Result", 'verified': "Verified", 'duration': "Duration"}, html));
+    for row in rows:
+      lines.append(self.renderRow(columns, row, html));
+
+    if(len(failedRuns) > 0):
+      lines.append("");
+      lines.append("Failed runs of schedules that run more than once a day:");
+      for siteName, schedule, scheduleFailedRuns in failedRuns:
+        lines.append("{site}{title} (SID {id}): {runs}".format(site=self.renderText(sitePrefix(siteName), html), title=self.renderText(schedule.title, html), id=schedule.id,
+                      runs=", ".join(datetime.datetime.fromtimestamp(run).strftime('%H:%M') + " " + self.renderStatus(runResult, html=html) for run, runResult in scheduleFailedRuns)));
+
+    if(len(anomalies) > 0):
+      lines.append("");
+      lines.append("Unusual durations:");
+      for siteName, anomaly in anomalies:
+        lines.append(self.renderText(sitePrefix(siteName) + self.formatAnomaly(anomaly), html));
+
+    if(len(failedSites) > 0):
+      lines.append("");
+      lines.append("Sites that could not be checked:");
+      for siteName, error in failedSites:
+        lines.append(self.renderText(siteName, html) + ": " + self.renderStatus("ERROR", html=html) + " " + self.renderText(error, html));
+
+    lines.append("");
+    lines.append("");
+    lines.append("Report created on {s}".format(s=createdOn.strftime("%Y-%m-%d %H:%M:%S")));
+    return "\n".join(lines);
+
+  # Renders one row of a fixed-width table in one pass over its cells.
+  # columns is a list of (key, width, alignment, isStatus); the cells of the
+  # status columns are colored by their statusStyles, as ANSI text or HTML.
+  def renderRow(self, columns, row, html=False):
+    cells = [];
+    for key, width, alignment, isStatus in columns:
+      text = str(row[key]);
+      cell = text[:width];
+      padding = ' ' * (width - len(cell));
+      if(isStatus == True):
+        cell = self.renderStatus(text, cell, html);
+      else:
+        cell = self.renderText(cell, html);
+      if(alignment == '>'):
+        cells.append(padding + cell);
+      else:
+        cells.append(cell + padding);
+    return ' '.join(cells);
+
+  # Renders a status, or the table cell of a status, in the style of the status.
+  def renderStatus(self, status, cell=None, html=False):
+    if(cell == None):
+      cell = status;
+    style = self.statusStyles.get(status) or self.statusStyles.get(status.split(' ', 1)[0]);
+    if(style == None):
+      return self.renderText(cell, html);
+    if(html == True):
+      return "<span style='color: {c};'>{t}</span>".format(c=self.htmlColors[style], t=self.renderText(cell, html));
+    return {'ok': bcolors.OKGREEN, 'warning': bcolors.WARNING, 'fail': bcolors.FAIL}[style] + cell + bcolors.ENDC;
+
+  def renderText(self, text, html=False):
+    if(html == True):
+      return str(text).replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;');
+    return str(text);
+
+  # Computes the duration statistics of each schedule over the window
+  # [d1Timestamp, d2Timestamp) in one query: the percentiles with window
+  # functions, nearest rank over the durations ranked per schedule, and the
+  # least squares trend from aggregate sums. Only successful runs count for
+  # the durations, the failure rate comes from the daily status rollup.
+  # Returns schedule id -> statistics.
+  def computeStats(self, d1Timestamp, d2Timestamp, scheduleId=None):
+    scheduleCondition = '';
+    reportCondition = '';
+    if(scheduleId != None):
+      scheduleCondition = 'WHERE s.id = :si';
+      reportCondition = 'AND Schedule = :si';
+    params = {'d1': d1Timestamp, 'd2': d2Timestamp, 'si': scheduleId};
+
+    c = self.conn.cursor();
+    statsBySchedule = {};
+    c.execute("""
+      SELECT s.id, s.Title, total(d.attempts) AS attempts, total(d.errors) AS errors
+      FROM {st} s LEFT JOIN {td} d ON d.Schedule = s.id AND d.day >= :d1 AND d.day < :d2
+      {condition}
+      GROUP BY s.id ORDER BY s.id
+      """.format(st=self.tableSchedules, td=self.tableDayStatus, condition=scheduleCondition), params);
+    for row in c:
+      statsBySchedule[row['id']] = {'title': row['Title'], 'reports': int(row['attempts']),
+                                    'failureRate': row['errors'] / row['attempts'] if row['attempts'] else None,
+                                    'runs': 0, 'p50': None, 'p95': None, 'p99': None, 'mean': None, 'trend': None};
+
+    # x is the day of the run within the window, for the trend in seconds per day
+    c.execute("""
+      WITH runs AS (
+        SELECT Schedule, duration, (date - :d1) / 86400.0 AS x,
+          row_number() OVER (PARTITION BY Schedule ORDER BY duration) AS rn,
+          count(*) OVER (PARTITION BY Schedule) AS n
+        FROM {tn}
+        WHERE date >= :d1 AND date < :d2 AND Result IN (1, 2, 3) AND duration IS NOT NULL {condition}
+      )
+      SELECT Schedule, n,
+        min(CASE WHEN rn >= 0.50 * n THEN duration END) AS p50,
+        min(CASE WHEN rn >= 0.95 * n THEN duration END) AS p95,
+        min(CASE WHEN rn >= 0.99 * n THEN duration END) AS p99,
+        avg(duration) AS mean,
+        total(x) AS sx, total(x * x) AS sxx, total(x * duration) AS sxy, total(duration) AS sy
+      FROM runs GROUP BY Schedule
+      """.format(tn=self.tableReports, condition=reportCondition), params);
+    for row in c:
+      stats = statsBySchedule.get(row['Schedule']);
+      if(stats == None):
+        continue;
+      n = row['n'];
+      stats.update({'runs': n, 'p50': row['p50'], 'p95': row['p95'], 'p99': row['p99'], 'mean': row['mean']});
+      denominator = n * row['sxx'] - row['sx'] * row['sx'];
+      if(n >= 2 and denominator > 0):
+        stats['trend'] = (n * row['sxy'] - row['sx'] * row['sy']) / denominator;
+
+    return statsBySchedule;
+
+  # Returns the successful runs in [d1Timestamp, d2Timestamp) whose duration
+  # deviates from the baseline of their schedule, the mean and variance of the
+  # durations in [b1Timestamp, b2Timestamp), by AnomalyThreshold standard
+  # deviations and at least AnomalyMinSeconds. Schedules with fewer than
+  # AnomalyMinRuns runs in the baseline have no baseline.
+  def findDurationAnomalies(self, b1Timestamp, b2Timestamp, d1Timestamp, d2Timestamp, scheduleId=None):
+    threshold = self.getIntSetting('Stats', 'AnomalyThreshold', self.defaultAnomalyThreshold);
+    minRuns = self.getIntSetting('Stats', 'AnomalyMinRuns', self.defaultAnomalyMinRuns);
+    minSeconds = self.getIntSetting('Stats', 'AnomalyMinSeconds', self.defaultAnomalyMinSeconds);
+
+    scheduleCondition = '';
+    if(scheduleId != None):
+      scheduleCondition = 'AND r.Schedule = :si';
+
+    c = self.conn.cursor();
+    # compares squares, SQLite may be built without sqrt
+    c.execute("""
+      WITH baseline AS (
+        SELECT Schedule, avg(duration) AS mean, avg(duration * duration) - avg(duration) * avg(duration) AS variance
+        FROM {tn}
+        WHERE date >= :b1 AND date < :b2 AND Result IN (1, 2, 3) AND duration IS NOT NULL
+        GROUP BY Schedule HAVING count(*) >= :minRuns
+      )
+      SELECT r.id, r.Schedule, s.Title, r.date, r.duration, b.mean, b.variance
+      FROM {tn} r JOIN baseline b ON b.Schedule = r.Schedule LEFT JOIN {st} s ON s.id = r.Schedule
+      WHERE r.date >= :d1 AND r.date < :d2 AND r.Result IN (1, 2, 3) AND r.duration IS NOT NULL {condition}
+        AND (r.duration - b.mean) * (r.duration - b.mean) >= max(:minSeconds * :minSeconds, :threshold * :threshold * b.variance)
+      ORDER BY r.Schedule, r.date
+      """.format(tn=self.tableReports, st=self.tableSchedules, condition=scheduleCondition),
+      {'b1': b1Timestamp, 'b2': b2Timestamp, 'd1': d1Timestamp, 'd2': d2Timestamp, 'si': scheduleId,
+       'minRuns': minRuns, 'minSeconds': minSeconds, 'threshold': threshold});
+
+    return c.fetchall();
+
+  def formatAnomaly(self, anomaly):
+    import math;
+
+    deviation = math.sqrt(max(anomaly['variance'], 0));
+    if(deviation > 0):
+      score = " ({z:+.1f} sd)".format(z=(anomaly['duration'] - anomaly['mean']) / deviation);
+    else:
+      score = "";
+    return "{title} (SID {si}): report {ri} on {d} took {dur}, usually {mean} +/- {sd}{score}".format(
+              title=anomaly['Title'], si=anomaly['Schedule'], ri=anomaly['id'], d=self.unixToDate(anomaly['date']),
+              dur=self.secondsToTime(anomaly['duration']), mean=self.secondsToTime(anomaly['mean']),
+              sd=self.secondsToTime(deviation), score=score);
+
+  def showStats(self, args):
+    windowDays = args.days or self.getIntSetting('Stats', 'WindowDays', self.defaultStatsWindowDays);
+    if(windowDays < 1):
+      print("ERROR: Number of Days must be a positive integer e.g. 5 or 120", file=sys.stderr);
+      exit(1);
+    if(args.schedule != None and self.scheduleExists(args.schedule) == False):
+      print("ERROR: No schedule found with id: " + str(args.schedule), file=sys.stderr);
+      exit(1);
+
+    # the last windowDays days, today included
+    d1Timestamp, d2Timestamp = self.dayBounds(time.time() - (windowDays - 1) * 86400);
+    d2Timestamp = self.dayBounds(time.time())[1];
+
+    statsBySchedule = self.computeStats(d1Timestamp, d2Timestamp, args.schedule);
+    anomalies = self.findDurationAnomalies(self.getBaselineStart(d1Timestamp), d1Timestamp, d1Timestamp, d2Timestamp, args.schedule);
+    anomaliesBySchedule = {};
+    for anomaly in anomalies:
+      anomaliesBySchedule.setdefault(anomaly['Schedule'], []).append(anomaly['id']);
+
+    if(args.format != 'text'):
+      writer = RowWriter(args.format, self.statsFields);
+      for scheduleId, stats in statsBySchedule.items():
+        writer.write({'schedule_id': scheduleId, 'title': stats['title'], 'reports': stats['reports'],
+                      'failure_rate': stats['failureRate'], 'runs': stats['runs'],
+                      'p50': stats['p50'], 'p95': stats['p95'], 'p99': stats['p99'], 'mean': stats['mean'],
+                      'trend_seconds_per_day': stats['trend'], 'anomalies': anomaliesBySchedule.get(scheduleId, [])});
+      writer.close();
+      return;
+
+    print("Duration statistics of the last {n} days".format(n=windowDays));
+    columns = [('id', 4, '<', False), ('title', 18, '<', False), ('reports', 7, '>', False), ('failed', 7, '>', False),
+               ('p50', 9, '>', False), ('p95', 9, '>', False), ('p99', 9, '>', False), ('trend', 12, '>', False),
+               ('anomalies', 9, '>', False)];
+    print(self.renderRow(columns, {'id': "SID", 'title': "Title", 'reports': "Reports", 'failed': "Failed",
+                      'p50': "p50", 'p95': "p95", 'p99': "p99", 'trend': "Trend/day", 'anomalies': "Unusual"}));
+    for scheduleId, stats in statsBySchedule.items():
+      trend = '';
+      if(stats['trend'] != None):
+        trend = ('+' if stats['trend'] >= 0 else '-') + self.secondsToTime(abs(stats['trend']));
+      print(self.renderRow(columns, {'id': scheduleId, 'title': stats['title'], 'reports': stats['reports'],
+                      'failed': '' if stats['failureRate'] == None else "{r:.1%}".format(r=stats['failureRate']),
+                      'p50': '' if stats['p50'] == None else self.secondsToTime(stats['p50']),
+                      'p95': '' if stats['p95'] == None else self.secondsToTime(stats['p95']),
+                      'p99': '' if stats['p99'] == None else self.secondsToTime(stats['p99']),
+                      'trend': trend, 'anomalies': len(anomaliesBySchedule.get(scheduleId, []))}));
+
+    if(len(anomalies) > 0):
+      print("");
+      print("Unusual durations:");
+      for anomaly in anomalies:
+        print(self.formatAnomaly(anomaly));
+
+  # Returns the per schedule health gauges in the Prometheus text format. One
+  # query reads everything: the last report and the last success of each
+  # schedule are single backward steps on the (Schedule, date, Result,
+  # duration) index and the error counts come from the daily status rollup,
+  # so the cost depends on the number of schedules, not of reports.
+  def collectMetrics(self):
+    startTime = time.time();
+    errorWindowDays = self.getIntSetting('Metrics', 'ErrorWindowDays', self.defaultErrorWindowDays);
+    windowStart, windowEnd = self.dayBounds(startTime - (errorWindowDays - 1) * 86400);
+
+    c = self.conn.cursor();
+    c.execute("""
+      SELECT s.id, s.Title, s.Interval, s.SourceHost, s.DestinationHost,
+        l.date AS lastDate, l.Result AS lastResult, l.duration AS lastDuration,
+        (SELECT r.date FROM {tn} r WHERE r.Schedule = s.id AND r.Result IN (1, 2, 3)
+          ORDER BY r.date DESC LIMIT 1) AS lastSuccess,
+        (SELECT total(d.errors) FROM {td} d WHERE d.Schedule = s.id AND d.day >= :windowStart) AS errors,
+        (SELECT total(d.attempts) FROM {td} d WHERE d.Schedule = s.id AND d.day >= :windowStart) AS attempts
+      FROM {st} s
+      LEFT JOIN {tn} l ON l.id = (SELECT r.id FROM {tn} r WHERE r.Schedule = s.id ORDER BY r.date DESC, r.id DESC LIMIT 1)
+      ORDER BY s.id
+      """.format(tn=self.tableReports, td=self.tableDayStatus, st=self.tableSchedules), {'windowStart': windowStart});
+
+    window = "{n}d".format(n=errorWindowDays);
+    # (name, help, samples as (labels, value))
+    metrics = [
+      ('nekbackupmonitor_last_report_timestamp_seconds', 'Start time of the last report of the schedule.', []),
+      ('nekbackupmonitor_last_success_timestamp_seconds', 'Start time of the last successful report of the schedule.', []),
+      ('nekbackupmonitor_last_result', 'Result of the last report: 0 error, 1 done, 2 done and verified, 3 done but verification error.', []),
+      ('nekbackupmonitor_last_duration_seconds', 'Duration of the last report of the schedule.', []),
+      ('nekbackupmonitor_window_errors', 'Failed reports of the schedule in the last ErrorWindowDays days, today included.', []),
+      ('nekbackupmonitor_window_reports', 'Reports of the schedule in the last ErrorWindowDays days, today included.', []),
+      ('nekbackupmonitor_next_run_timestamp_seconds', 'Next expected run of the schedule, from its cron interval.', []),
+    ];
+    samples = dict((name, metricSamples) for name, metricHelp, metricSamples in metrics);
+
+    # interval -> next run; many schedules share an interval
+    nextRuns = {};
+    for row in c:
+      labels = 'schedule_id="{id}",title="{title}",source_host="{source}",destination_host="{dest}"'.format(
+                  id=row['id'], title=self.escapeLabel(row['Title']),
+                  source=self.escapeLabel(row['SourceHost']), dest=self.escapeLabel(row['DestinationHost']));
+      if(row['lastDate'] != None):
+        samples['nekbackupmonitor_last_report_timestamp_seconds'].append((labels, row['lastDate']));
+        samples['nekbackupmonitor_last_result'].append((labels, row['lastResult']));
+        samples['nekbackupmonitor_last_duration_seconds'].append((labels, row['lastDuration'] or 0));
+      if(row['lastSuccess'] != None):
+        samples['nekbackupmonitor_last_success_timestamp_seconds'].append((labels, row['lastSuccess']));
+      windowLabels = labels + ',window="{w}"'.format(w=window);
+      samples['nekbackupmonitor_window_errors'].append((windowLabels, int(row['errors'])));
+      samples['nekbackupmonitor_window_reports'].append((windowLabels, int(row['attempts'])));
+
+      if(not row['Interval'] in nextRuns):
+        from croniter import croniter;
+        try:
+          nextRuns[row['Interval']] = croniter(row['Interval'], startTime).get_next();
+        except (ValueError, KeyError):
+          # not a valid cron expression
+          nextRuns[row['Interval']] = None;
+      if(nextRuns[row['Interval']] != None):
+        samples['nekbackupmonitor_next_run_timestamp_seconds'].append((labels, int(nextRuns[row['Interval']])));
+
+    lines = [];
+    for name, metricHelp, metricSamples in metrics:
+      lines.append('# HELP {n} {h}'.format(n=name, h=metricHelp));
+      lines.append('# TYPE {n} gauge'.format(n=name));
+      for labels, value in metricSamples:
+        lines.append('{n}{{{l}}} {v}'.format(n=name, l=labels, v=value));
+    lines.append('# HELP nekbackupmonitor_scrape_duration_seconds Time it took to collect these metrics.');
+    lines.append('# TYPE nekbackupmonitor_scrape_duration_seconds gauge');
+    lines.append('nekbackupmonitor_scrape_duration_seconds {v:.6f}'.format(v=time.time() - startTime));
+    return "\n".join(lines) + "\n";
+
+  def escapeLabel(self, value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n');
+
+  def exportMetrics(self, args):
+    if(args.listen == None):
+      metricsText = self.collectMetrics();
+      if(args.output == None):
+        sys.stdout.write(metricsText);
+      else:
+        # e.g. for the textfile collector of node_exporter, which must never
+        # see a half written file
+        with open(args.output + '.tmp', 'w') as f:
+          f.write(metricsText);
+        os.replace(args.output + '.tmp', args.output);
+      self.conn.close();
+      return;
+
+    self.serveMetrics(args.listen);
+
+  # Serves the metrics over HTTP on [HOST:]PORT, collected anew on every scrape.
+  def serveMetrics(self, listen):
+    from http.server import HTTPServer, BaseHTTPRequestHandler;
+
+    host, separator, port = listen.rpartition(':');
+    try:
+      port = int(port);
+    except ValueError:
+      print("ERROR: --listen must be [HOST:]PORT, e.g. 9480 or 127.0.0.1:9480", file=sys.stderr);
+      exit(1);
+
+    class MetricsRequestHandler(BaseHTTPRequestHandler):
+
+      def do_GET(self):
+        if(self.path.split('?', 1)[0] != '/metrics'):
+          self.send_error(404);
+          return;
+        try:
+          body = self.server.monitor.collectMetrics().encode('utf-8');
+        except sqlite3.Error as e:
+          self.send_error(500, e.args[0]);
+          return;
+        self.send_response(200);
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8');
+        self.send_header('Content-Length', str(len(body)));
+        self.end_headers();
+        self.wfile.write(body);
+
+      # no access log for every scrape
+      def log_message(self, format, *args):
+        pass;
+
+    server = HTTPServer((host, port), MetricsRequestHandler);
+    server.monitor = self;
+    print("Serving metrics on http://{h}:{p}/metrics".format(h=host or '0.0.0.0', p=port));
+    try:
+      server.serve_forever();
+    except KeyboardInterrupt:
+      pass;
+    finally:
+      server.server_close();
+      self.conn.close();
+
+# A row of the schedules table.
+class Schedule:
+  __slots__ = ('id', 'title', 'interval', 'sourceHost', 'destinationHost', 'sourceDir', 'destinationDir', 'type');
+
+  def __init__(self, id, title, interval, sourceHost, destinationHost, sourceDir, destinationDir, type):
+    self.id = id;
+    self.title = title;
+    self.interval = interval;
+    self.sourceHost = sourceHost;
+    self.destinationHost = destinationHost;
+    self.sourceDir = sourceDir;
+    self.destinationDir = destinationDir;
+    self.type = type;
+
+# A row of the reports table, without its message.
+class Report:
+  __slots__ = ('id', 'schedule', 'date', 'result', 'duration');
+
+  def __init__(self, id, schedule, date, result, duration):
+    self.id = id;
+    self.schedule = schedule;
+    self.date = date;
+    self.result = result;
+    self.duration = duration;
+
+# The reads and writes of single schedules and reports. The values are always
+# bound parameters, so that every statement is parsed once and then reused
+# from the statement cache of the connection. The schedules are read once
+# into a map of Schedule objects. The map is dropped on the schedule writes of
+# this connection. The writes of other processes are noticed by PRAGMA
+# data_version, which costs no I/O, and then by the schedule_version counter.
+# The writes run in the transaction of the caller.
+class Repository:
+
+  def __init__(self, monitor):
+    self.monitor = monitor;
+    self.scheduleMap = None;
+    self.dataVersion = None;
+    self.scheduleVersion = None;
+
+  # Returns schedule id -> Schedule, in id order.
+  def schedules(self):
+    conn = self.monitor.conn;
+    dataVersion = conn.execute('PRAGMA data_version').fetchone()[0];
+    if(self.scheduleMap != None and dataVersion == self.dataVersion):
+      return self.scheduleMap;
+
+    # another connection committed, maybe only reports
+    self.dataVersion = dataVersion;
+    scheduleVersion = conn.execute("SELECT version FROM {sv}".format(sv=self.monitor.tableScheduleVersion)).fetchone()[0];
+    if(self.scheduleMap == None or scheduleVersion != self.scheduleVersion):
+      c = conn.execute("""
+        SELECT id, Title, Interval, SourceHost, DestinationHost, SourceDir, DestinationDir, Type
+        FROM {st} ORDER BY id
+        """.format(st=self.monitor.tableSchedules));
+      self.scheduleMap = dict((row[0], Schedule(*row)) for row in c);
+      self.scheduleVersion = scheduleVersion;
+    return self.scheduleMap;
+
+  # Returns the Schedule, or None if there is no schedule with that id. Unless
+  # the map is loaded already, only this schedule is read, as for add.
+  def getSchedule(self, scheduleId):
+    if(self.scheduleMap != None):
+      return self.schedules().get(scheduleId);
+
+    row = self.monitor.conn.execute("""
+      SELECT id, Title, Interval, SourceHost, DestinationHost, SourceDir, DestinationDir, Type
+      FROM {st} WHERE id = ?
+      """.format(st=self.monitor.tableSchedules), (scheduleId,)).fetchone();
+    if(row == None):
+      return None;
+    return Schedule(*row);
+
+  # Returns the id of the new schedule.
+  def addSchedule(self, c, schedule):
+    c.execute("""
+      INSERT INTO {st} (Title, Interval, SourceHost, DestinationHost, SourceDir, DestinationDir, Type)
+      VALUES (?, ?, ?, ?, ?, ?, ?)
+      """.format(st=self.monitor.tableSchedules),
+      (schedule.title, schedule.interval, schedule.sourceHost, schedule.destinationHost, schedule.sourceDir, schedule.destinationDir, schedule.type));
+    self.scheduleMap = None;
+    return c.lastrowid;
+
+  # Deletes a schedule, and with deleteReports also its reports with their
+  # messages, daily status and queued notifications.
+  def deleteSchedule(self, c, scheduleId, deleteReports):
+    self.deleteSchedules(c, [scheduleId], deleteReports);
+
+  def deleteSchedules(self, c, scheduleIds, deleteReports):
+    monitor = self.monitor;
+    params = [(scheduleId,) for scheduleId in scheduleIds];
+    if(deleteReports == True):
+      reportIds = [];
+      for scheduleId in scheduleIds:
+        reportIds.extend(row[0] for row in c.connection.execute("SELECT id FROM {tn} WHERE Schedule = ?".format(tn=monitor.tableReports), (scheduleId,)));
+      monitor.unindexMessages(c, reportIds);
+      c.executemany("DELETE FROM {tm} WHERE Report IN (SELECT id FROM {tn} WHERE Schedule = ?)".format(tm=monitor.tableMessages, tn=monitor.tableReports), params);
+      c.executemany("DELETE FROM {tn} WHERE Schedule = ?".format(tn=monitor.tableReports), params);
+      c.executemany("DELETE FROM {td} WHERE Schedule = ?".format(td=monitor.tableDayStatus), params);
+      c.executemany("DELETE FROM {to} WHERE Schedule = ?".format(to=monitor.tableOutbox), params);
+    c.executemany("DELETE FROM {st} WHERE id = ?".format(st=monitor.tableSchedules), params);
+    self.scheduleMap = None;
+
+  # Applies the changes of import-schedules. The inserted schedules keep their
+  # id where they have one. The deleted ones lose their reports.
+  def applyScheduleChanges(self, c, inserts, updates, deleteIds):
+    monitor = self.monitor;
+    c.executemany("""
+      INSERT INTO {st} (id, Title, Interval, SourceHost, DestinationHost, SourceDir, DestinationDir, Type)
+      VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+      """.format(st=monitor.tableSchedules),
+      [(s.id, s.title, s.interval, s.sourceHost, s.destinationHost, s.sourceDir, s.destinationDir, s.type) for s in inserts]);
+    c.executemany("""
+      UPDATE {st} SET Title = ?, Interval = ?, SourceHost = ?, DestinationHost = ?, SourceDir = ?, DestinationDir = ?, Type = ?
+      WHERE id = ?
+      """.format(st=monitor.tableSchedules),
+      [(s.title, s.interval, s.sourceHost, s.destinationHost, s.sourceDir, s.destinationDir, s.type, s.id) for s in updates]);
+    self.deleteSchedules(c, deleteIds, True);
+    self.scheduleMap = None;
+
+  # Returns the Report, or None if there is no report with that id.
+  def getReport(self, reportId):
+    row = self.monitor.conn.execute("SELECT id, Schedule, date, Result, duration FROM {tn} WHERE id = ?".format(tn=self.monitor.tableReports), (reportId,)).fetchone();
+    if(row == None):
+      return None;
+    return Report(*row);
+
+  def countReports(self, scheduleId):
+    return self.monitor.conn.execute("SELECT count(*) FROM {tn} WHERE Schedule = ?".format(tn=self.monitor.tableReports), (scheduleId,)).fetchone()[0];
+
+  # Deletes a report with its message. The daily status is updated by the caller.
+  def deleteReport(self, c, reportId):
+    self.monitor.unindexMessages(c, [reportId]);
+    c.execute("DELETE FROM {tm} WHERE Report = ?".format(tm=self.monitor.tableMessages), (reportId,));
+    c.execute("DELETE FROM {tn} WHERE id = ?".format(tn=self.monitor.tableReports), (reportId,));
+
+# Records, for --profile, the wall time of the profiled methods of
+# NekBackupMonitor and of every SQL statement. The time of a method includes
+# the methods it calls. Statements are grouped with their literals replaced by
+# ?, and the time spent fetching their rows is added to them.
+class Profiler:
+
+  def __init__(self):
+    self.startTime = time.perf_counter();
+    # name -> [calls, seconds]
+    self.phases = {};
+    # normalized SQL -> [calls, seconds]
+    self.statements = {};
+    self.normalized = {};
+
+  def record(self, table, key, seconds, calls=1):
+    entry = table.setdefault(key, [0, 0.0]);
+    entry[0] = entry[0] + calls;
+    entry[1] = entry[1] + seconds;
+
+  # Adds the phases and statements of the profile of a worker process.
+  def merge(self, phases, statements):
+    for table, workerTable in [(self.phases, phases), (self.statements, statements)]:
+      for key, (calls, seconds) in workerTable.items():
+        self.record(table, key, seconds, calls);
+
+  def timed(self, name, method):
+    profiler = self;
+
+    def wrapper(*args, **kwargs):
+      start = time.perf_counter();
+      try:
+        return method(*args, **kwargs);
+      finally:
+        profiler.record(profiler.phases, name, time.perf_counter() - start);
+    return wrapper;
+
+  # Replaces the given methods of the monitor with timed ones.
+  def instrument(self, monitor, names):
+    for name in names:
+      setattr(monitor, name, self.timed(name, getattr(monitor, name)));
+
+  def normalize(self, sql):
+    import re;
+
+    statement = self.normalized.get(sql);
+    if(statement == None):
+      statement = ' '.join(sql.split());
+      statement = re.sub(r"'(?:[^']|'')*'", '?', statement);
+      statement = re.sub(r"(?<![\w.])-?\d+(?:\.\d+)?\b", '?', statement);
+      self.normalized[sql] = statement;
+    return statement;
+
+  # Returns a sqlite3.Connection subclass whose statements are recorded.
+  def connectionClass(self):
+    profiler = self;
+
+    class ProfiledCursor(sqlite3.Cursor):
+      statement = None;
+
+      def timeStatement(self, method, sql, parameters):
+        self.statement = profiler.normalize(sql);
+        start = time.perf_counter();
+        try:
+          return method(sql, parameters);
+        finally:
+          profiler.record(profiler.statements, self.statement, time.perf_counter() - start);
+
+      def timeFetch(self, method, *args):
+        start = time.perf_counter();
+        try:
+          return method(*args);
+        finally:
+          if(self.statement != None):
+            profiler.record(profiler.statements, self.statement, time.perf_counter() - start, 0);
+
+      def execute(self, sql, parameters=()):
+        return self.timeStatement(super().execute, sql, parameters);
+
+      def executemany(self, sql, parameters):
+        return self.timeStatement(super().executemany, sql, parameters);
+
+      def fetchone(self):
+        return self.timeFetch(super().fetchone);
+
+      def fetchmany(self, *args):
+        return self.timeFetch(super().fetchmany, *args);
+
+      def fetchall(self):
+        return self.timeFetch(super().fetchall);
+
+      def __next__(self):
+        return self.timeFetch(super().__next__);
+
+    # Connection.execute doesn't go through an overridden cursor()
+    class ProfiledConnection(sqlite3.Connection):
+
+      def cursor(self, factory=ProfiledCursor):
+        return super().cursor(factory);
+
+      def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters);
+
+      def executemany(self, sql, parameters):
+        return self.cursor().executemany(sql, parameters);
+
+      def commit(self):
+        start = time.perf_counter();
+        try:
+          super().commit();
+        finally:
+          profiler.record(profiler.statements, 'COMMIT', time.perf_counter() - start);
+
+    return ProfiledConnection;
+
+  # Prints the summary to stderr, or writes it as JSON if a file is given.
+  def report(self, command, jsonFile=None):
+    totalSeconds = time.perf_counter() - self.startTime;
+    phases = sorted(self.phases.items(), key=lambda item: item[1][1], reverse=True);
+    statements = sorted(self.statements.items(), key=lambda item: item[1][1], reverse=True);
+    sqlCalls = sum(entry[0] for name, entry in statements);
+    sqlSeconds = sum(entry[1] for name, entry in statements);
+
+    if(jsonFile != None):
+      profile = {
+        'command': command,
+        'total_seconds': round(totalSeconds, 6),
+        'phases': [{'name': name, 'calls': entry[0], 'seconds': round(entry[1], 6)} for name, entry in phases],
+        'sql': {
+          'calls': sqlCalls,
+          'seconds': round(sqlSeconds, 6),
+          'statements': [{'sql': sql, 'calls': entry[0], 'seconds': round(entry[1], 6)} for sql, entry in statements]
+        }
+      };
+      with open(jsonFile, 'w') as f:
+        json.dump(profile, f, indent=2);
+        f.write('\n');
+      return;
+
+    print("Profile of {c}: {s:.3f}s".format(c=command, s=totalSeconds), file=sys.stderr);
+    print("{n:<24} {c:>8} {s:>10}".format(n='Phase', c='Calls', s='Seconds'), file=sys.stderr);
+    for name, entry in phases:
+      print("{n:<24} {c:>8} {s:>10.4f}".format(n=name, c=entry[0], s=entry[1]), file=sys.stderr);
+    print("SQL: {c} statements, {s:.4f}s".format(c=sqlCalls, s=sqlSeconds), file=sys.stderr);
+    print("{c:>8} {s:>10}  {q}".format(c='Calls', s='Seconds', q='Statement'), file=sys.stderr);
+    for sql, entry in statements:
+      if(len(sql) > 100):
+        sql = sql[:97] + '...';
+      print("{c:>8} {s:>10.4f}  {q}".format(c=entry[0], s=entry[1], q=sql), file=sys.stderr);
+
+# Writes rows, dicts with the given fields, to stdout one by one as they come:
+# as one JSON array (json), one JSON object per line (ndjson) or as CSV with a
+# header line, where list values are joined with ';'.
+class RowWriter:
+
+  def __init__(self, outputFormat, fieldNames, out=None):
+    self.outputFormat = outputFormat;
+    self.fieldNames = fieldNames;
+    self.out = out or sys.stdout;
+    self.numberOfRows = 0;
+    if(outputFormat == 'csv'):
+      import csv;
+      self.csvWriter = csv.writer(self.out);
+      self.csvWriter.writerow(fieldNames);
+    elif(outputFormat == 'json'):
+      self.out.write('[');
+
+  def write(self, row):
+    if(self.outputFormat == 'csv'):
+      self.csvWriter.writerow([';'.join(str(v) for v in row[name]) if isinstance(row[name], list) else row[name] for name in self.fieldNames]);
+    elif(self.outputFormat == 'ndjson'):
+      self.out.write(json.dumps(row) + '\n');
+    else:
+      if(self.numberOfRows > 0):
+        self.out.write(',');
+      self.out.write('\n' + json.dumps(row));
+    self.numberOfRows = self.numberOfRows + 1;
+
+  def close(self):
+    if(self.outputFormat == 'json'):
+      self.out.write('\n]\n');
+    self.out.flush();
+
+class DeliveryError(Exception):
+  pass
+
+# Delivers each email with its own `sendmail -t -oi` process.
+class SendmailDelivery:
+
+  def __init__(self):
+    import shutil;
+
+    # check if sendmail exists
+    if shutil.which("sendmail") == None:
+      raise DeliveryError("sendmail does not exist");
+
+  def send(self, msg):
+    from subprocess import Popen, PIPE;
+
+    # Send the message via our own SMTP server, but don't include the
+    # envelope header.
+    p = Popen(["sendmail", "-t", "-oi"], stdin=PIPE, universal_newlines=True)
+    p.communicate(msg.as_string())
+    if(p.returncode != 0):
+      raise DeliveryError("sendmail failed with exit code {c}".format(c=p.returncode));
+
+  def close(self):
+    pass
+
+# Delivers the emails to an SMTP relay over one connection that is opened on
+# the first email and kept for the following ones. A failed send is retried
+# on a new connection, with backoff, unless the relay rejected it permanently.
+class SmtpDelivery:
+  retryDelay = 1.0
+  retryMaxDelay = 30.0
+
+  def __init__(self, host, port, security, user, password, timeout, retries):
+    self.host = host;
+    self.port = port;
+    self.security = security;
+    self.user = user;
+    self.password = password;
+    self.timeout = timeout;
+    self.retries = retries;
+    self.smtp = None;
+
+  def connect(self):
+    import smtplib;
+    import ssl;
+
+    if(self.security == 'ssl'):
+      smtp = smtplib.SMTP_SSL(self.host, self.port, timeout=self.timeout, context=ssl.create_default_context());
+    else:
+      smtp = smtplib.SMTP(self.host, self.port, timeout=self.timeout);
+      if(self.security == 'starttls'):
+        smtp.starttls(context=ssl.create_default_context());
+    if(self.user):
+      smtp.login(self.user, self.password);
+    self.smtp = smtp;
+
+  def send(self, msg):
+    import smtplib;
+
+    delay = self.retryDelay;
+    for attempt in range(self.retries + 1):
+      try:
+        if(self.smtp == None):
+          self.connect();
+        self.smtp.send_message(msg);
+        return;
+      except smtplib.SMTPRecipientsRefused as e:
+        raise DeliveryError("The SMTP relay refused the recipients: " + str(e.recipients));
+      except smtplib.SMTPResponseException as e:
+        self.close();
+        if(e.smtp_code >= 500):
+          raise DeliveryError("The SMTP relay rejected the email: {c} {m}".format(c=e.smtp_code, m=e.smtp_error));
+        error = e;
+      except (smtplib.SMTPException, OSError) as e:
+        # e.g. the relay closed the idle connection
+        self.close();
+        error = e;
+
+      if(attempt < self.retries):
+        time.sleep(delay);
+        delay = min(delay * 2, self.retryMaxDelay);
+
+    raise DeliveryError("Failed to send the email to {h}: {e}".format(h=self.host, e=error));
+
+  def close(self):
+    if(self.smtp != None):
+      try:
+        self.smtp.quit();
+      except Exception:
+        pass;
+      self.smtp = None;
+
+# The work of a process of check --sites: evaluates a site with the settings
+# of settingsFile. Returns the result of evaluateSite and, with profile, the
+# phases and statements of the worker's profile.
+def evaluateSiteInWorker(settingsFile, siteName, sqliteFile, d1, needAnomalies, profile):
+  monitor = NekBackupMonitor();
+  monitor.settings_file = settingsFile;
+  if(profile == True):
+    monitor.profiler = Profiler();
+  result = monitor.evaluateSite(siteName, sqliteFile, d1, needAnomalies);
+  if(monitor.profiler == None):
+    return result, None;
+  return result, (monitor.profiler.phases, monitor.profiler.statements);
+
+# The work of a process of the range check: evaluates a block of days with a
+# NekBackupMonitor and database connection of its own.
+def evaluateDaysInWorker(sqliteFile, schedules, days, dayStatus, earlyTolerance):
+  monitor = NekBackupMonitor();
+  monitor.sqlite_file = sqliteFile;
+  try:
+    return monitor.evaluateDays(schedules, days, dayStatus, earlyTolerance);
+  finally:
+    if(monitor._conn != None):
+      monitor._conn.close();
 
 class bcolors:
   HEADER = '\033[95m'
@@ -877,4 +4042,4 @@ class ReportResult(Enum):
   DONE_BUT_VERIFICATION_ERROR = 3
   
 if __name__ == '__main__':
-  NekBackupMonitor()
+  NekBackupMonitor().run()
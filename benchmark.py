@@ -0,0 +1,281 @@
+#!/usr/bin/python3
+
+# Benchmarks the command paths of NekBackupMonitor at several data sizes.
+#
+# For every scale a scratch directory gets a copy of NekBackupMonitor.py, its
+# own settings.conf and a database filled with synthetic data: schedules with
+# mixed cron intervals and reports at their run times, with a realistic mix of
+# results and durations and some large messages. Then every command is run as
+# a separate process, as cron and the backup jobs run it, and timed. The
+# results are written as JSON, and --compare prints them next to the results
+# of an earlier run, e.g. of the previous version.
+#
+#   ./benchmark.py --scales 1000,100000 -o results.json
+#   ./benchmark.py --scales 1000,100000 --compare results.json
+
+import argparse;
+import datetime;
+import json;
+import os;
+import random;
+import shutil;
+import sqlite3;
+import statistics;
+import subprocess;
+import sys;
+import tempfile;
+import time;
+
+scriptPath = os.path.dirname(os.path.abspath(__file__));
+
+# (cron interval, share of the schedules, run times of a day as (hour, minute)
+# or None for the hour of the schedule, weekday or None for every day)
+scheduleTemplates = [
+  ('0 {hour} * * *', 0.6, None, None),
+  ('30 */6 * * *', 0.2, [(0, 30), (6, 30), (12, 30), (18, 30)], None),
+  ('15 * * * *', 0.1, [(hour, 15) for hour in range(24)], None),
+  ('0 {hour} * * 0', 0.1, None, 6),
+];
+
+# report result -> share of the reports
+resultShares = [(1, 0.60), (2, 0.30), (0, 0.07), (3, 0.03)];
+
+settingsTemplate = """[General]
+ToEmail = bench@example.com
+FromEmail = bench@example.com
+SendEmailImmediatelyOnErrorReport = no
+""";
+
+class Benchmark(object):
+
+  def __init__(self, args):
+    self.args = args;
+    self.random = random.Random(args.seed);
+
+  # Creates the scratch directory of a scale, with the schema created by the
+  # script itself. Returns the loaded NekBackupMonitor module of the copy.
+  def createScratch(self, workDir):
+    import importlib.util;
+
+    os.makedirs(workDir, exist_ok=True);
+    shutil.copy(os.path.join(scriptPath, 'NekBackupMonitor.py'), workDir);
+    with open(os.path.join(workDir, 'settings.conf'), 'w') as f:
+      f.write(settingsTemplate);
+
+    spec = importlib.util.spec_from_file_location('NekBackupMonitorCopy', os.path.join(workDir, 'NekBackupMonitor.py'));
+    module = importlib.util.module_from_spec(spec);
+    spec.loader.exec_module(module);
+    return module;
+
+  def makeMessage(self, size):
+    lines = [];
+    length = 0;
+    while(length < size):
+      line = "{t} rsync: sent {s} bytes  received {r} bytes  {b:.2f} bytes/sec file {n}/{f}.dat".format(
+                t=datetime.datetime.now().strftime('%H:%M:%S'), s=self.random.randint(1, 10**9), r=self.random.randint(1, 10**6),
+                b=self.random.uniform(1, 10**8), n=self.random.randint(1, 10**5), f=self.random.getrandbits(32));
+      lines.append(line);
+      length = length + len(line) + 1;
+    return "\n".join(lines)[:size];
+
+  # Yields the reports of a schedule, newest first, at its run times from
+  # yesterday backwards, with about 2% of the runs missing.
+  def scheduleReports(self, scheduleId, runTimes, weekday, numberOfReports):
+    baseDuration = self.random.uniform(60, 7200);
+    day = datetime.datetime.now().replace(hour=0, minute=0, second=0, microsecond=0) - datetime.timedelta(days=1);
+    numberOfGenerated = 0;
+    while(numberOfGenerated < numberOfReports):
+      if(weekday == None or day.weekday() == weekday):
+        for hour, minute in reversed(runTimes):
+          if(numberOfGenerated >= numberOfReports):
+            break;
+          if(self.random.random() < 0.02):
+            continue;
+          date = day.replace(hour=hour, minute=minute) + datetime.timedelta(seconds=self.random.randint(0, 120));
+          result = self.random.choices([r for r, share in resultShares], [share for r, share in resultShares])[0];
+          duration = baseDuration * self.random.lognormvariate(0, 0.25);
+          if(result == 0):
+            duration = duration * self.random.uniform(0, 0.5);
+          yield {'scheduleid': scheduleId, 'date': int(date.timestamp()), 'result': result, 'duration': int(duration)};
+          numberOfGenerated = numberOfGenerated + 1;
+      day = day - datetime.timedelta(days=1);
+
+  # Fills the database with numberOfSchedules schedules and numberOfReports
+  # reports, in transactions of 50000 reports, and builds the daily status.
+  def generate(self, module, numberOfSchedules, numberOfReports):
+    monitor = module.NekBackupMonitor();
+    conn = monitor.conn;
+    c = conn.cursor();
+
+    schedules = [];
+    for scheduleId in range(1, numberOfSchedules + 1):
+      interval, share, runTimes, weekday = self.random.choices(scheduleTemplates, [t[1] for t in scheduleTemplates])[0];
+      hour = self.random.randint(0, 23);
+      if(runTimes == None):
+        runTimes = [(hour, 0)];
+      schedules.append((scheduleId, interval.format(hour=hour), runTimes, weekday));
+    c.executemany("""
+      INSERT INTO schedules (id, Title, Interval, SourceHost, DestinationHost, SourceDir, DestinationDir, Type)
+      VALUES (?, ?, ?, ?, ?, ?, ?, 1)
+      """, [(scheduleId, 'backup-{i}'.format(i=scheduleId), interval, 'host-{h}'.format(h=scheduleId % 50),
+             'storage-{h}'.format(h=scheduleId % 5), '/data/{i}'.format(i=scheduleId), '/backup/{i}'.format(i=scheduleId))
+            for scheduleId, interval, runTimes, weekday in schedules]);
+    conn.commit();
+
+    reportId = 0;
+    chunk = [];
+    for index, (scheduleId, interval, runTimes, weekday) in enumerate(schedules):
+      # the reports are spread evenly over the schedules
+      share = numberOfReports // numberOfSchedules + (1 if index < numberOfReports % numberOfSchedules else 0);
+      for report in self.scheduleReports(scheduleId, runTimes, weekday, share):
+        reportId = reportId + 1;
+        report['id'] = reportId;
+        chunk.append(report);
+        if(len(chunk) >= 50000):
+          self.insertChunk(monitor, conn, chunk);
+          chunk = [];
+    self.insertChunk(monitor, conn, chunk);
+
+    monitor.beginWrite(c);
+    monitor.rebuildDayStatus(conn);
+    conn.commit();
+    conn.execute('PRAGMA wal_checkpoint(TRUNCATE)');
+    conn.close();
+
+  def insertChunk(self, monitor, conn, chunk):
+    c = conn.cursor();
+    monitor.beginWrite(c);
+    c.executemany('INSERT INTO reports (id, Schedule, date, Result, duration) VALUES (:id, :scheduleid, :date, :result, :duration)', chunk);
+    for report in chunk:
+      draw = self.random.random();
+      if(draw < self.args.large_message_ratio):
+        monitor.storeMessage(c, report['id'], self.makeMessage(self.args.large_message_size), None);
+      elif(draw < self.args.large_message_ratio + self.args.message_ratio):
+        monitor.storeMessage(c, report['id'], self.makeMessage(2048), None);
+    conn.commit();
+
+  # The timed commands as (name, arguments, stdin, number of runs). The
+  # destructive ones come last.
+  def commands(self, workDir):
+    noSocket = os.path.join(workDir, 'no-server.sock');
+    now = str(int(time.time()));
+    largeMessage = self.makeMessage(self.args.large_message_size).encode('utf-8');
+    yearAgo = (datetime.datetime.now() - datetime.timedelta(days=365)).strftime("%Y-%m-%d");
+    repeat = self.args.repeat;
+    return [
+      ('add', ['add', '-s', '1', '-t', now, '-r', 'done', '-d', '60', '-m', 'benchmark', '--socket', noSocket], None, repeat),
+      ('add-large-message', ['add', '-s', '1', '-t', now, '-r', 'failed', '--stdin-message', '--socket', noSocket], largeMessage, repeat),
+      ('check', ['check', '-b', '1'], None, repeat),
+      ('check-range-year', ['check', '--from', yearAgo, '--format', 'csv'], None, repeat),
+      ('list-reports-day', ['list-reports', '-b', '1'], None, repeat),
+      ('list-reports-page', ['list-reports', '-s', '1', '-l', '100'], None, repeat),
+      ('list-reports-week-ndjson', ['list-reports', '-b', '7', '--format', 'ndjson'], None, repeat),
+      ('list-report-tail', ['list-reports', '-r', '1', '--tail', '200'], None, repeat),
+      ('search-reports', ['search-reports', 'rsync', '-l', '20'], None, repeat),
+      ('search-reports-filtered', ['search-reports', '--match', '"bytes/sec file"', '-r', 'failed', '-b', '30', '--format', 'ndjson'], None, repeat),
+      ('stats', ['stats'], None, repeat),
+      ('export-metrics', ['export-metrics'], None, repeat),
+      ('delete-schedule', ['delete-schedule', '2'], b'y\n', 1),
+    ];
+
+  def timeCommand(self, workDir, arguments, stdin, repeat):
+    timings = [];
+    for run in range(repeat):
+      startTime = time.perf_counter();
+      completed = subprocess.run([sys.executable, os.path.join(workDir, 'NekBackupMonitor.py')] + arguments,
+                                 input=stdin, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE);
+      timings.append(time.perf_counter() - startTime);
+      if(completed.returncode != 0):
+        return {'runs': timings, 'returncode': completed.returncode,
+                'error': completed.stderr.decode('utf-8', errors='replace').strip()[-500:]};
+    return {'runs': timings, 'median': statistics.median(timings), 'min': min(timings), 'max': max(timings), 'returncode': 0};
+
+  def runScale(self, numberOfReports):
+    numberOfSchedules = self.args.schedules or min(2000, max(10, numberOfReports // 1000));
+    workDir = os.path.join(self.args.work_dir, 'scale-{n}'.format(n=numberOfReports));
+    if(os.path.exists(workDir)):
+      shutil.rmtree(workDir);
+
+    print("Scale {n} reports, {s} schedules: generating...".format(n=numberOfReports, s=numberOfSchedules), file=sys.stderr);
+    startTime = time.perf_counter();
+    self.generate(self.createScratch(workDir), numberOfSchedules, numberOfReports);
+    scaleResult = {'reports': numberOfReports, 'schedules': numberOfSchedules,
+                   'generate_seconds': time.perf_counter() - startTime,
+                   'database_bytes': os.path.getsize(os.path.join(workDir, 'NekBackupMonitor.db')),
+                   'commands': {}};
+
+    for name, arguments, stdin, repeat in self.commands(workDir):
+      result = self.timeCommand(workDir, arguments, stdin, repeat);
+      scaleResult['commands'][name] = result;
+      if(result['returncode'] == 0):
+        print("  {name:<26} {t:9.3f} s".format(name=name, t=result['median']), file=sys.stderr);
+      else:
+        print("  {name:<26} FAILED: {e}".format(name=name, e=result['error']), file=sys.stderr);
+
+    if(self.args.keep == False):
+      shutil.rmtree(workDir);
+    return scaleResult;
+
+  def run(self):
+    results = {
+      'benchmark': 'NekBackupMonitor',
+      'commit': self.gitCommit(),
+      'started': datetime.datetime.now().isoformat(timespec='seconds'),
+      'python': sys.version.split()[0],
+      'sqlite': sqlite3.sqlite_version,
+      'seed': self.args.seed,
+      'scales': [self.runScale(numberOfReports) for numberOfReports in self.args.scales],
+    };
+
+    resultsText = json.dumps(results, indent=2);
+    if(self.args.output):
+      with open(self.args.output, 'w') as f:
+        f.write(resultsText + "\n");
+    else:
+      print(resultsText);
+
+    if(self.args.compare):
+      with open(self.args.compare) as f:
+        self.printComparison(json.load(f), results);
+
+  def gitCommit(self):
+    try:
+      completed = subprocess.run(['git', '-C', scriptPath, 'rev-parse', '--short', 'HEAD'], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL);
+    except OSError:
+      return None;
+    return completed.stdout.decode('utf-8').strip() or None;
+
+  # Prints the median of every command of both results and their ratio, for
+  # the scales that both have.
+  def printComparison(self, baseResults, results):
+    baseScales = dict((scale['reports'], scale) for scale in baseResults['scales']);
+    templateColumns = "{scale:>10} {name:<26} {base:>10} {new:>10} {ratio:>7}";
+    print(templateColumns.format(scale="Reports", name="Command", base=str(baseResults.get('commit')), new=str(results.get('commit')), ratio="Ratio"), file=sys.stderr);
+    for scale in results['scales']:
+      baseScale = baseScales.get(scale['reports']);
+      if(baseScale == None):
+        continue;
+      for name, result in scale['commands'].items():
+        baseResult = baseScale['commands'].get(name);
+        if(baseResult == None or baseResult.get('median') == None or result.get('median') == None):
+          continue;
+        print(templateColumns.format(scale=scale['reports'], name=name, base="{t:.3f}".format(t=baseResult['median']),
+                                     new="{t:.3f}".format(t=result['median']), ratio="{r:.2f}".format(r=result['median'] / baseResult['median'])), file=sys.stderr);
+
+def main():
+  parser = argparse.ArgumentParser(prog='benchmark.py', description='Times the commands of NekBackupMonitor on synthetic databases of several sizes.');
+  parser.add_argument('--scales', type=lambda value: [int(n) for n in value.split(',')], default=[1000, 100000], help='Comma separated numbers of reports, e.g. 1000,100000,10000000. Default is 1000,100000.');
+  parser.add_argument('--schedules', type=int, help='Number of schedules. Defaults to one per 1000 reports, between 10 and 2000.');
+  parser.add_argument('--repeat', type=int, default=5, help='Runs of each command. The median is reported. Default is 5.');
+  parser.add_argument('--message-ratio', type=float, default=0.01, help='Share of the reports with a 2 KB message. Default is 0.01.');
+  parser.add_argument('--large-message-ratio', type=float, default=0.0005, help='Share of the reports with a large message. Default is 0.0005.');
+  parser.add_argument('--large-message-size', type=int, default=1024 * 1024, help='Size of the large messages in bytes. Default is 1 MB.');
+  parser.add_argument('--seed', type=int, default=1, help='Seed of the data generator. Default is 1.');
+  parser.add_argument('-o', '--output', type=str, help='Write the JSON results to this file instead of stdout.');
+  parser.add_argument('--compare', type=str, help='JSON results of an earlier run to compare with.');
+  parser.add_argument('--work-dir', type=str, default=os.path.join(tempfile.gettempdir(), 'nekbackupmonitor-benchmark'), help='Directory of the scratch databases.');
+  parser.add_argument('--keep', action="store_true", help='Keep the scratch databases.');
+  Benchmark(parser.parse_args()).run();
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,90 @@
+#!/usr/bin/python3
+
+# Checks that check still gives the verdict of a pruned day from the daily
+# status, also for a schedule that runs more than once a day.
+#
+#   python3 -m unittest discover tests
+
+import argparse;
+import datetime;
+import os;
+import shutil;
+import sys;
+import tempfile;
+import unittest;
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))));
+from NekBackupMonitor import NekBackupMonitor, Schedule, ReportResult;
+
+class PruneCheckTest(unittest.TestCase):
+
+  def setUp(self):
+    self.directory = tempfile.mkdtemp();
+    with open(os.path.join(self.directory, 'settings.conf'), 'w') as f:
+      f.write("""
+[General]
+ToEmail = admin@example.com
+FromEmail = monitor@example.com
+SendEmailImmediatelyOnErrorReport = no
+""");
+
+    monitor = self.openMonitor();
+    c = monitor.conn.cursor();
+    monitor.beginWrite(c);
+    self.scheduleId = monitor.repository.addSchedule(c, Schedule(None, 'hourly', '0 * * * *', 'db1', 'nas', '/var/lib/db', '/backup/db', 1));
+    monitor.conn.commit();
+
+    today = datetime.datetime.now().replace(hour=0, minute=0, second=0, microsecond=0);
+    # every run of the day reported
+    self.completeDay = today - datetime.timedelta(days=40);
+    for hour in range(24):
+      monitor.storeReport(self.scheduleId, int(monitor.totimestamp(self.completeDay + datetime.timedelta(hours=hour, minutes=5))), ReportResult.DONE, 60, None);
+    # a single failed run, with a message that fills many pages
+    self.failedDay = today - datetime.timedelta(days=39);
+    monitor.storeReport(self.scheduleId, int(monitor.totimestamp(self.failedDay + datetime.timedelta(hours=3, minutes=5))), ReportResult.ERROR, 60, 'disk full\n' + os.urandom(200000).hex());
+
+    monitor.pruneReports(argparse.Namespace(days=30, batch_size=None, vacuum=False, no_vacuum=True));
+
+  def tearDown(self):
+    shutil.rmtree(self.directory);
+
+  def openMonitor(self):
+    monitor = NekBackupMonitor();
+    monitor.currentPath = self.directory;
+    monitor.sqlite_file = os.path.join(self.directory, 'NekBackupMonitor.db');
+    monitor.settings_file = os.path.join(self.directory, 'settings.conf');
+    return monitor;
+
+  def evaluate(self, day):
+    monitor = self.openMonitor();
+    try:
+      self.assertEqual(monitor.conn.execute('SELECT COUNT(*) FROM {tn}'.format(tn=monitor.tableReports)).fetchone()[0], 0);
+      statuses = dict((schedule.id, status) for schedule, status in monitor.evaluateDay(day));
+      return statuses[self.scheduleId];
+    finally:
+      monitor.conn.close();
+
+  def test_pruned_day_with_all_runs(self):
+    status = self.evaluate(self.completeDay);
+    self.assertEqual(len(status['runs']), 24);
+    self.assertEqual(status['result'], 'OK');
+    self.assertTrue(status['isOK']);
+
+  def test_pruned_day_with_a_failed_run(self):
+    status = self.evaluate(self.failedDay);
+    self.assertEqual(status['result'], 'ERROR');
+    self.assertFalse(status['isOK']);
+
+  def test_pruned_space_is_given_back(self):
+    monitor = self.openMonitor();
+    try:
+      # new databases use incremental vacuum, without prune --vacuum
+      self.assertEqual(monitor.conn.execute('PRAGMA auto_vacuum').fetchone()[0], 2);
+      self.assertGreater(monitor.conn.execute('PRAGMA freelist_count').fetchone()[0], 0);
+      monitor.vacuum(monitor.conn.cursor(), False);
+      self.assertEqual(monitor.conn.execute('PRAGMA freelist_count').fetchone()[0], 0);
+    finally:
+      monitor.conn.close();
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,235 @@
+#!/usr/bin/python3
+
+# Checks the SMTP delivery of the error emails against a stand-in SMTP server
+# that runs in the test process and keeps the emails it receives.
+#
+#   python3 -m unittest discover tests
+
+import email;
+import email.policy;
+import os;
+import shutil;
+import socketserver;
+import sys;
+import tempfile;
+import threading;
+import time;
+import unittest;
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))));
+from NekBackupMonitor import NekBackupMonitor, Schedule, ReportResult, DeliveryError;
+
+# Speaks just enough SMTP for smtplib: EHLO/HELO, MAIL, RCPT, DATA, RSET,
+# NOOP and QUIT. With rejectCode set, DATA is answered with that code. The
+# next tempFailures emails are answered with 421 and the connection is closed,
+# as is a connection that has delivered dropAfter emails, like a relay that
+# closes idle connections.
+class StandInSmtpHandler(socketserver.StreamRequestHandler):
+
+  def reply(self, line):
+    self.wfile.write((line + '\r\n').encode('ascii'));
+
+  def handle(self):
+    self.server.connections = self.server.connections + 1;
+    self.reply('220 localhost stand-in SMTP server');
+    envelope = {'from': None, 'to': []};
+    numberOfEmails = 0;
+    for line in self.rfile:
+      command = line.decode('ascii').rstrip('\r\n');
+      verb = command[:4].upper();
+      if(verb == 'EHLO' or verb == 'HELO'):
+        self.reply('250 localhost');
+      elif(verb == 'MAIL'):
+        envelope = {'from': command.split(':', 1)[1].strip(), 'to': []};
+        self.reply('250 OK');
+      elif(verb == 'RCPT'):
+        envelope['to'].append(command.split(':', 1)[1].strip());
+        self.reply('250 OK');
+      elif(verb == 'DATA'):
+        self.reply('354 End data with <CR><LF>.<CR><LF>');
+        data = [];
+        for dataLine in self.rfile:
+          if(dataLine == b'.\r\n'):
+            break;
+          # undo the dot stuffing
+          if(dataLine.startswith(b'.')):
+            dataLine = dataLine[1:];
+          data.append(dataLine);
+        if(self.server.tempFailures > 0):
+          self.server.tempFailures = self.server.tempFailures - 1;
+          self.reply('421 Service not available, closing the connection');
+          return;
+        if(self.server.rejectCode != None):
+          self.reply('{c} Rejected by the stand-in'.format(c=self.server.rejectCode));
+        else:
+          self.server.received.append((envelope['from'], envelope['to'], b''.join(data)));
+          self.reply('250 OK');
+          numberOfEmails = numberOfEmails + 1;
+          if(self.server.dropAfter != None and numberOfEmails >= self.server.dropAfter):
+            return;
+      elif(verb == 'RSET' or verb == 'NOOP'):
+        self.reply('250 OK');
+      elif(verb == 'QUIT'):
+        self.reply('221 Bye');
+        return;
+      else:
+        self.reply('502 Command not implemented');
+
+class StandInSmtpServer(socketserver.ThreadingTCPServer):
+  daemon_threads = True;
+  allow_reuse_address = True;
+
+  def __init__(self):
+    super().__init__(('127.0.0.1', 0), StandInSmtpHandler);
+    # (envelope from, envelope recipients, message bytes) of each email
+    self.received = [];
+    self.rejectCode = None;
+    self.tempFailures = 0;
+    self.dropAfter = None;
+    self.connections = 0;
+
+class SmtpDeliveryTest(unittest.TestCase):
+
+  def setUp(self):
+    self.server = StandInSmtpServer();
+    threading.Thread(target=self.server.serve_forever, daemon=True).start();
+
+    self.directory = tempfile.mkdtemp();
+    with open(os.path.join(self.directory, 'settings.conf'), 'w') as f:
+      f.write("""
+[General]
+ToEmail = admin@example.com
+FromEmail = monitor@example.com
+SendEmailImmediatelyOnErrorReport = yes
+
+[Email]
+Delivery = smtp
+SmtpHost = 127.0.0.1
+SmtpPort = {port}
+SmtpSecurity = none
+SmtpTimeout = 5
+SmtpRetries = 2
+""".format(port=self.server.server_address[1]));
+
+    self.monitor = NekBackupMonitor();
+    self.monitor.sqlite_file = os.path.join(self.directory, 'NekBackupMonitor.db');
+    self.monitor.settings_file = os.path.join(self.directory, 'settings.conf');
+    # retry right away
+    self.monitor.getMailer().retryDelay = 0.01;
+
+    c = self.monitor.conn.cursor();
+    self.monitor.beginWrite(c);
+    self.scheduleId = self.monitor.repository.addSchedule(c, Schedule(None, 'nightly', 1, 'web1', 'nas', '/var/www', '/backup/www', 1));
+    # one email per destination host
+    self.otherScheduleIds = [self.monitor.repository.addSchedule(c, Schedule(None, 'nightly ' + host, 1, 'web1', host, '/var/www', '/backup/www', 1))
+                             for host in ['tape', 'offsite']];
+    self.monitor.conn.commit();
+
+  def tearDown(self):
+    self.monitor.closeMailer();
+    self.monitor.conn.close();
+    self.server.shutdown();
+    self.server.server_close();
+    shutil.rmtree(self.directory);
+
+  def addErrorReport(self, message, scheduleId=None):
+    return self.monitor.storeReport(scheduleId or self.scheduleId, int(time.time()), ReportResult.ERROR, 60, message);
+
+  def countOutbox(self):
+    return self.monitor.conn.execute('SELECT COUNT(*) FROM {to}'.format(to=self.monitor.tableOutbox)).fetchone()[0];
+
+  def receivedEmails(self):
+    # the emails are sent before flushNotifications returns, QUIT may still
+    # be on its way
+    self.monitor.closeMailer();
+    return [(sender, recipients, email.message_from_bytes(data, policy=email.policy.default))
+            for sender, recipients, data in self.server.received];
+
+  def test_digest_of_one_destination_host(self):
+    firstId = self.addErrorReport('rsync: connection refused\nrsync error: code 10');
+    secondId = self.addErrorReport('disk full');
+
+    self.assertEqual(self.monitor.flushNotifications(sendAll=True), 1);
+
+    emails = self.receivedEmails();
+    self.assertEqual(len(emails), 1);
+    sender, recipients, msg = emails[0];
+    self.assertEqual(sender, '<monitor@example.com>');
+    self.assertEqual(recipients, ['<admin@example.com>']);
+    self.assertEqual(msg['Subject'], 'Backup errors for 2 reports on nas');
+    self.assertEqual(msg['To'], 'admin@example.com');
+
+    body = msg.get_body(('plain',)).get_content().splitlines();
+    self.assertEqual(body[0].split(), ['ID', 'Schedule', '(id)', 'Date', 'Result']);
+    self.assertEqual([line.split()[:3] for line in body[1:3]], [[str(firstId), 'nightly', '(1)'], [str(secondId), 'nightly', '(1)']]);
+    self.assertEqual(body[1].split()[-1], 'ERROR');
+    self.assertIn("--- Report {id}, last 20 lines of the message ---".format(id=firstId), body);
+    self.assertEqual(body[body.index("--- Report {id}, last 20 lines of the message ---".format(id=secondId)) + 1], 'disk full');
+    self.assertIn('rsync error: code 10', body);
+
+    self.assertEqual(self.countOutbox(), 0);
+
+  def test_single_error_report(self):
+    self.addErrorReport('rsync: connection refused');
+
+    self.assertEqual(self.monitor.flushNotifications(sendAll=True), 1);
+
+    emails = self.receivedEmails();
+    self.assertEqual(len(emails), 1);
+    msg = emails[0][2];
+    self.assertEqual(msg['Subject'], 'Backup error for nightly');
+    self.assertEqual(msg.get_body(('plain',)).get_content().rstrip('\n'), 'rsync: connection refused');
+
+  def test_rejected_email_stays_in_the_outbox(self):
+    self.addErrorReport('disk full');
+    self.server.rejectCode = 554;
+
+    with self.assertRaises(DeliveryError):
+      self.monitor.flushNotifications(sendAll=True);
+    self.assertEqual(self.receivedEmails(), []);
+    self.assertEqual(self.countOutbox(), 1);
+
+    # the claim is released, the next flush sends it
+    self.server.rejectCode = None;
+    self.assertEqual(self.monitor.flushNotifications(sendAll=True), 1);
+    self.assertEqual(len(self.receivedEmails()), 1);
+    self.assertEqual(self.countOutbox(), 0);
+
+  def test_one_connection_for_several_emails(self):
+    for scheduleId in [self.scheduleId] + self.otherScheduleIds:
+      self.addErrorReport('disk full', scheduleId);
+
+    self.assertEqual(self.monitor.flushNotifications(sendAll=True), 3);
+
+    emails = self.receivedEmails();
+    self.assertEqual(sorted(msg['Subject'] for sender, recipients, msg in emails),
+                     ['Backup error for nightly', 'Backup error for nightly offsite', 'Backup error for nightly tape']);
+    self.assertEqual(self.server.connections, 1);
+    self.assertEqual(self.countOutbox(), 0);
+
+  def test_retry_after_temporary_error(self):
+    self.addErrorReport('disk full');
+    self.server.tempFailures = 1;
+
+    self.assertEqual(self.monitor.flushNotifications(sendAll=True), 1);
+
+    emails = self.receivedEmails();
+    self.assertEqual(len(emails), 1);
+    self.assertEqual(emails[0][2]['Subject'], 'Backup error for nightly');
+    # the 421 closed the first connection
+    self.assertEqual(self.server.connections, 2);
+    self.assertEqual(self.countOutbox(), 0);
+
+  def test_reconnect_after_dropped_connection(self):
+    for scheduleId in [self.scheduleId] + self.otherScheduleIds:
+      self.addErrorReport('disk full', scheduleId);
+    self.server.dropAfter = 2;
+
+    self.assertEqual(self.monitor.flushNotifications(sendAll=True), 3);
+
+    self.assertEqual(len(self.receivedEmails()), 3);
+    self.assertEqual(self.server.connections, 2);
+    self.assertEqual(self.countOutbox(), 0);
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,73 @@
+#!/usr/bin/python3
+
+# Checks that stats flags the runs of a lasting slowdown, which it can only do
+# when its baseline is taken from before the window of the runs.
+#
+#   python3 -m unittest discover tests
+
+import argparse;
+import contextlib;
+import datetime;
+import io;
+import json;
+import os;
+import shutil;
+import sys;
+import tempfile;
+import unittest;
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))));
+from NekBackupMonitor import NekBackupMonitor, Schedule, ReportResult;
+
+class StatsBaselineTest(unittest.TestCase):
+
+  def setUp(self):
+    self.directory = tempfile.mkdtemp();
+    with open(os.path.join(self.directory, 'settings.conf'), 'w') as f:
+      f.write("""
+[General]
+ToEmail = admin@example.com
+FromEmail = monitor@example.com
+SendEmailImmediatelyOnErrorReport = no
+
+[Stats]
+BaselineDays = 30
+""");
+
+    self.monitor = NekBackupMonitor();
+    self.monitor.sqlite_file = os.path.join(self.directory, 'NekBackupMonitor.db');
+    self.monitor.settings_file = os.path.join(self.directory, 'settings.conf');
+
+    c = self.monitor.conn.cursor();
+    self.monitor.beginWrite(c);
+    self.slowerId = self.monitor.repository.addSchedule(c, Schedule(None, 'slower', '0 12 * * *', 'db1', 'nas', '/var/lib/db', '/backup/db', 1));
+    self.steadyId = self.monitor.repository.addSchedule(c, Schedule(None, 'steady', '0 12 * * *', 'web1', 'nas', '/var/www', '/backup/www', 1));
+    self.monitor.conn.commit();
+
+    # the daily runs of the 30 days before the 7 days of stats take about 10
+    # minutes. From then on the runs of one schedule take 30 minutes.
+    today = datetime.datetime.now().replace(hour=12, minute=0, second=0, microsecond=0);
+    for day in range(36, -1, -1):
+      date = int(self.monitor.totimestamp(today - datetime.timedelta(days=day)));
+      usual = 600 + (day % 3) * 10;
+      self.monitor.storeReport(self.slowerId, date, ReportResult.DONE, usual if day >= 7 else 1800, None);
+      self.monitor.storeReport(self.steadyId, date, ReportResult.DONE, usual, None);
+
+  def tearDown(self):
+    self.monitor.conn.close();
+    shutil.rmtree(self.directory);
+
+  def test_step_change_in_duration(self):
+    out = io.StringIO();
+    with contextlib.redirect_stdout(out):
+      self.monitor.showStats(argparse.Namespace(days=7, schedule=None, format='json'));
+    statsBySchedule = dict((row['schedule_id'], row) for row in json.loads(out.getvalue()));
+
+    self.assertEqual(statsBySchedule[self.slowerId]['runs'], 7);
+    self.assertEqual(statsBySchedule[self.slowerId]['p50'], 1800);
+    # every run of the slowdown is unusual, not only the first one
+    self.assertEqual(len(statsBySchedule[self.slowerId]['anomalies']), 7);
+    self.assertEqual(statsBySchedule[self.steadyId]['anomalies'], []);
+
+if __name__ == '__main__':
+  unittest.main()